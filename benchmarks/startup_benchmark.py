@@ -0,0 +1,59 @@
+"""
+Startup benchmark of entry points, argument parsing and version/help paths must stay under the time budget
+and must not import heavy libraries.
+
+usage: python benchmarks/startup_benchmark.py [--budget 0.5] [--repeat 5]
+"""
+import os
+import statistics
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["geopandas", "osmium", "overpy", "shapely", "pandas", "numpy"]
+CASES = [
+    ["get_data.py", "-v"],
+    ["get_data.py", "-h"],
+    ["gen_geo_polygon.py", "-h"],
+]
+# Run entry point in-process, then report heavy modules being imported.
+IMPORT_CHECK = """
+import runpy, sys
+sys.argv = {argv!r}
+try:
+    runpy.run_path({script!r}, run_name="__main__")
+except SystemExit:
+    pass
+print(",".join(m for m in {heavy!r} if m in sys.modules), file=sys.stderr)
+"""
+
+
+def run_case(argv, repeat):
+    timings = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable, *argv], cwd=ROOT_PATH, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        timings.append(time.perf_counter() - start_time)
+    check = subprocess.run([sys.executable, "-c", IMPORT_CHECK.format(argv=argv, script=os.path.join(ROOT_PATH, argv[0]), heavy=HEAVY_MODULES)],
+                           cwd=ROOT_PATH, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    imported = [i for i in check.stderr.strip().splitlines()[-1:] if i]
+    return statistics.median(timings), imported
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--budget", type=float, default=0.5, help="Median seconds allowed per invocation.")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    failed = False
+    for argv in CASES:
+        median, imported = run_case(argv, args.repeat)
+        status = "OK"
+        if median > args.budget or imported:
+            status = "FAIL"
+            failed = True
+        print(f"{status} {' '.join(argv):<28} median {median:.3f}s budget {args.budget:.3f}s heavy imports: {imported[0] if imported else '-'}")
+    sys.exit(1 if failed else 0)
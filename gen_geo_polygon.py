@@ -1,99 +1,217 @@
+import json
+import os
+import shutil
 from argparse import ArgumentParser
-import geopandas
-import shapely
-from shapely import wkt
-from src.enum import HofnType, National
-import pandas
+from src.config import set_config_path
 
 VERSION = 3
 DEBUG_VERSION = 0
 
+HEADER = ["POLYGON_ID", "POLYGON_NAME", "POLYGON_STR", "HOFN_TYPE", "ROAD_LEVEL"]
 
-def get_geometry_rounding_limit(file: geopandas.GeoDataFrame):
-    
-    data = file.copy(deep=True)
+
+def round_geometry(geometry: "geopandas.GeoSeries", rounding_precision) -> "geopandas.GeoSeries":
+    import geopandas
+    import shapely
+    return geopandas.GeoSeries(shapely.from_wkt(shapely.to_wkt(geometry.values, rounding_precision=rounding_precision)), index=geometry.index)
+
+
+def get_geometry_rounding_limit(file: "geopandas.GeoDataFrame"):
     i = 5  # rounding precision must be larger than 5 for accuracy issue
     while i <= 7:
-        data["geometry"] = data.geometry.apply(lambda geometry: wkt.loads(wkt.dumps(geometry, rounding_precision=5)))
-        is_valid = all(data["geometry"].is_valid) if data["geometry"][0].geom_type == "Polygon" else all(data["geometry"].is_simple)
+        geometry = round_geometry(file.geometry, 5)
+        is_valid = all(geometry.is_valid) if geometry.iloc[0].geom_type == "Polygon" else all(geometry.is_simple)
         if is_valid:
             return i
         else:
             return -1
 
 
+def get_part_path(nation, hofn_type, extension):
+    return f"data/output/{nation}/NT2_GEO_POLYGON.{hofn_type}.part.{extension}"
+
+
+def get_source_paths(nation, hofn_type) -> list:
+    """
+    Tables of hofn type, partitions listed in manifest.json if its output is partitioned, else the single tsv.
+    """
+    from src.enum import HofnType
+    type_path = f"data/output/{nation}/{HofnType(hofn_type).name}"
+    if os.path.exists(f"{type_path}/manifest.json"):
+        with open(f"{type_path}/manifest.json", "r") as stream:
+            return [f"{type_path}/{partition['path']}" for partition in json.load(stream)["partitions"]]
+    return [f"{type_path}/{HofnType(hofn_type).name}.tsv"]
+
+
+def process_table(file: "geopandas.GeoDataFrame", mcc, hofn_type, polygon_ids: set):
+    """
+    Generate POLYGON_ID, validate and round one table of hofn type, POLYGON_IDs of tables processed before are in polygon_ids.
+    Return table of HEADER columns, None if validation failed.
+    """
+    import pandas
+    import shapely
+
+    file["POLYGON_ID"] = f"{mcc}01{'0' + hofn_type if int(hofn_type) < 10 else hofn_type}" + file["POLYGON_ID"].astype(str)  # Set polygon_id
+    file.loc[file['POLYGON_NAME'].isnull(), "POLYGON_NAME"] = "UNKNOWN"
+    # 1. NO multi
+    multi_polygon_df = file[file.geometry.geom_type == "MultiPolygon"]
+    multi_linestring_df = file[file.geometry.geom_type == "MultiLineString"]
+    if multi_polygon_df.size or multi_linestring_df.size:
+        print("===========================================================")
+        print("multi polygon dataframe: ")
+        print(multi_polygon_df, end="\n\n")
+        print("===========================================================")
+        print(multi_linestring_df, end="\n\n")
+        print("Found multi-geometry showing above, please check", flush=True)  # Worker is terminated after failure.
+        return None
+    # 2.NO POLYGON_ID duplicate
+    duplicated = file["POLYGON_ID"].duplicated() | file["POLYGON_ID"].isin(polygon_ids)
+    if any(duplicated):
+        print("=========================================")
+        print(file.loc[duplicated]["POLYGON_ID"], end="\n\n")
+        print("Found duplicated polygon_id showing above, please check", flush=True)
+        return None
+    polygon_ids.update(file["POLYGON_ID"])
+    # 3. WKT coords round to 4 decimal place
+    if hofn_type in ["1", "2", "5", "10", "11"]:
+        precision_limit = get_geometry_rounding_limit(file)
+        if precision_limit != -1:
+            file["geometry"] = round_geometry(file.geometry, precision_limit)
+            print(f"{hofn_type} apply rounding precision {precision_limit}.")
+        else:
+            print(f"{hofn_type} no rounding, using original decimal points")
+            pass
+    else:
+        file["geometry"] = round_geometry(file.geometry, 5)
+    # 4. check POLYGON_STR is valid.
+    if hofn_type in ["1", "5", "10", "11"]:
+        if not all(file["geometry"].is_valid):
+            invalid = file.is_valid
+            print("=========================================")
+            print(file.loc[~invalid][["POLYGON_ID", "geometry"]], end="\n\n")
+            print("Found invalid polygon showing above, please check", flush=True)
+            return None
+    elif hofn_type == "2":
+        if not all(file["geometry"].is_simple):
+            invalid = file.is_simple
+            print("=========================================")
+            print(file.loc[~invalid][["POLYGON_ID", "geometry"]], end="\n\n")
+            print("Found invalid linestring showing above, please check", flush=True)
+            return None
+    file = pandas.DataFrame(file).rename(columns={"geometry": "POLYGON_STR"})
+    file["POLYGON_STR"] = shapely.to_wkt(file["POLYGON_STR"].values)
+    # Fixed columns for streaming all types into one table, missing HOFN_TYPE and ROAD_LEVEL of building are left blank.
+    return file.reindex(columns=HEADER)
+
+
+def process_hofn_type(mcc, nation, hofn_type, DEBUG_CSV=False):
+    """
+    Load, generate POLYGON_ID, validate and round one hofn type, write it as header-less part files.
+    Partitioned output is processed one partition at a time. Return part paths, None if validation failed.
+    """
+    import geopandas
+    import pandas
+
+    print(f"Current Hofn type: {hofn_type}")
+    part_paths = [get_part_path(nation, hofn_type, "tsv")] + ([get_part_path(nation, hofn_type, "csv")] if DEBUG_CSV else [])
+    for part_path in part_paths:
+        open(part_path, "w").close()
+    polygon_ids = set()
+    for source_path in get_source_paths(nation, hofn_type):
+        file = pandas.read_csv(source_path, sep="\t")
+        file = geopandas.GeoDataFrame(file, geometry=geopandas.GeoSeries.from_wkt(file["geometry"]))
+        file = process_table(file, mcc, hofn_type, polygon_ids)
+        if file is None:
+            return None
+        file.to_csv(part_paths[0], sep="\t", index=False, header=False, mode="a")
+        if DEBUG_CSV:
+            file.to_csv(part_paths[1], index=False, header=False, mode="a")
+    print(f"{hofn_type} pass multi-type, unique id and polygon validation")
+    return part_paths
+
+
+def write_geo_index(tsv_path, index_path, mcc, chunk_size=100000):
+    """
+    Packed spatial index of NT2_GEO_POLYGON.tsv for point look ups, see src/geo_index.py. TSV is read chunk by chunk.
+    Blank HOFN_TYPE is taken from POLYGON_ID, mcc 01 hofn type (two digits) way id, blank ROAD_LEVEL is 0.
+    """
+    import numpy
+    import pandas
+    import shapely
+    from src.geo_index import write_index
+    columns = {"POLYGON_ID": [], "HOFN_TYPE": [], "ROAD_LEVEL": [], "geometry": []}
+    for chunk in pandas.read_csv(tsv_path, sep="\t", usecols=["POLYGON_ID", "POLYGON_STR", "HOFN_TYPE", "ROAD_LEVEL"],
+                                 dtype={"POLYGON_ID": numpy.int64}, chunksize=chunk_size):
+        columns["POLYGON_ID"].append(chunk["POLYGON_ID"].values)
+        hofn_types = chunk["POLYGON_ID"].astype(str).str[len(mcc) + 2:len(mcc) + 4].astype(numpy.int64)
+        columns["HOFN_TYPE"].append(pandas.to_numeric(chunk["HOFN_TYPE"], errors="coerce").fillna(hofn_types).values)
+        columns["ROAD_LEVEL"].append(pandas.to_numeric(chunk["ROAD_LEVEL"], errors="coerce").fillna(0).values)
+        columns["geometry"].append(shapely.from_wkt(chunk["POLYGON_STR"].values))
+    if not columns["geometry"]:
+        columns = {column: [numpy.empty(0)] for column in columns.keys()}
+    write_index(index_path, *[numpy.concatenate(values) for values in columns.values()])
+
+
 if __name__ == "__main__":
 
     parser = ArgumentParser()
     parser.add_argument("mcc", type=str, help="mcc")
     parser.add_argument("hofn_types", type=str, help="format: 'HofnType1 HofnType2' ...")
     parser.add_argument("--get_data", const=True, default=False, nargs="?")  # Set as a flag
+    parser.add_argument("--config", type=str, help="Config file path, default config.yaml next to gen_geo_polygon.py.")
+    parser.add_argument("--workers", type=int, help="Hofn types processed in parallel, default number of cpu.")
+    parser.add_argument("--debug_csv", help="Also write NT2_GEO_POLYGON.csv for debug purpose.", action="store_true")
+    parser.add_argument("--no_index", help="Do not write spatial index NT2_GEO_POLYGON.idx.", action="store_true")
     args = parser.parse_args()
+    if args.config:
+        set_config_path(args.config)
+
+    # Heavy libraries are imported in workers after parsing, keep help path fast.
+    import multiprocessing
+    from src.enum import National
+
     mcc = args.mcc
     nation = National.get_country_by_mcc(mcc)
     hofn_types = args.hofn_types.split()
+    workers = max(min(args.workers or multiprocessing.cpu_count(), len(hofn_types)), 1)
 
-    files = {hofn_type: pandas.read_csv(f"data/output/{nation}/{HofnType(hofn_type).name}/{HofnType(hofn_type).name}.tsv", sep="\t") for hofn_type in hofn_types}
-    for hofn_type, file in files.items():
-        file["geometry"] = file.apply(lambda row: wkt.loads(row["geometry"]), axis=1)
-        files[hofn_type] = geopandas.GeoDataFrame(file)
-    nt2_geo_polygon = pandas.DataFrame(columns=["POLYGON_ID", "POLYGON_NAME", "POLYGON_STR", "HOFN_TYPE", "ROAD_LEVEL"])
-    # Validation:
-    for hofn_type, file in files.items():
-        print(f"Current Hofn type: {hofn_type}")
-        file["POLYGON_ID"] = file.apply(lambda row: f"{mcc}01{'0' + hofn_type if int(hofn_type) < 10 else hofn_type}{row['POLYGON_ID']}", axis=1)  # Set polygon_id
-        file.loc[file['POLYGON_NAME'].isnull(), "POLYGON_NAME"] = "UNKNOWN"
-        # 1. NO multi
-        multi_polygon_df = file[file.geometry.apply(lambda x: x.type == "MultiPolygon")]
-        multi_linestring_df = file[file.geometry.apply(lambda x: x.type == "MultiLineString")]
-        if multi_polygon_df.size or multi_linestring_df.size:
-            print("===========================================================")
-            print("multi polygon dataframe: ")
-            print(multi_polygon_df, end="\n\n")
-            print("===========================================================")
-            print(multi_linestring_df, end="\n\n")
-            print("Found multi-geometry showing above, please check")
-            exit()
-        print(f"{hofn_type} pass multi-type validation")
-        # 2.NO POLYGON_ID duplicate
-        if any(file["POLYGON_ID"].duplicated()):
-            duplicate_in_student = file.duplicated(subset=['POLYGON_ID'])
-            print("=========================================")
-            print(file.loc[duplicate_in_student]["POLYGON_ID"], end="\n\n")
-            print("Found duplicated polygon_id showing above, please check")
-            exit()
-        print(f"{hofn_type} pass unique id validation")
-        # 3. WKT coords round to 4 decimal place
-        if hofn_type in ["1", "2", "5", "10", "11"]:
-            precision_limit = get_geometry_rounding_limit(file)
-            if precision_limit != -1:
-                file["geometry"] = file.apply(lambda row: shapely.wkt.loads(shapely.wkt.dumps(row["geometry"], rounding_precision=precision_limit)), axis=1)
-                print(f"{hofn_type} apply rounding precision {precision_limit}.")
-            else:
-                print(f"{hofn_type} no rounding, using original decimal points")
-                pass
-        else:
-            file["geometry"] = file.apply(lambda row: shapely.wkt.loads(shapely.wkt.dumps(row["geometry"], rounding_precision=5)), axis=1)
-            print(f"{hofn_type} rounding precision is set to default {5}")
-        # 4. check POLYGON_STR is valid.
-        if hofn_type in ["1", "5", "10", "11"]:
-            if not all(file["geometry"].is_valid):
-                invalid = file.is_valid
-                print("=========================================")
-                print(file.loc[~invalid][["POLYGON_ID", "geometry"]], end="\n\n")
-                print("Found invalid polygon showing above, please check")
-                exit()
-        elif hofn_type == "2":
-            if not all(file["geometry"].is_simple):
-                invalid = file.is_simple
-                print("=========================================")
-                print(file.loc[~invalid][["POLYGON_ID", "geometry"]], end="\n\n")
-                print("Found invalid linestring showing above, please check")
+    # Types are loaded, validated and rounded in workers into part files, parts are appended in order to one table,
+    # no process holds all types at once. Tables are written to .tmp files and replaced after all types passed validation,
+    # so a failure leaves the tables of the last run.
+    output_paths = {"tsv": f"data/output/{nation}/NT2_GEO_POLYGON.tsv"}
+    if args.debug_csv:
+        output_paths["csv"] = f"data/output/{nation}/NT2_GEO_POLYGON.csv"  # For debug purpose.
+    pool = multiprocessing.Pool(workers)
+    results = [pool.apply_async(process_hofn_type, (mcc, nation, hofn_type, args.debug_csv)) for hofn_type in hofn_types]
+    pool.close()
+    outputs = {extension: open(f"{path}.tmp", "w") for extension, path in output_paths.items()}
+    try:
+        for extension, stream in outputs.items():
+            stream.write(("\t" if extension == "tsv" else ",").join(HEADER) + "\n")
+        for hofn_type, result in zip(hofn_types, results):
+            part_paths = result.get()
+            if part_paths is None:
+                pool.terminate()
                 exit()
-        print(f"{hofn_type} pass polygon validation")
-        file = file.rename(columns={"geometry": "POLYGON_STR"})
-        nt2_geo_polygon = pandas.concat([nt2_geo_polygon, file])
-    nt2_geo_polygon.to_csv(f"data/output/{nation}/NT2_GEO_POLYGON.csv", index=False)  # For debug purpose.
-    nt2_geo_polygon.to_csv(f"data/output/{nation}/NT2_GEO_POLYGON.tsv", sep="\t", index=False)
+            for extension, part_path in zip(output_paths.keys(), part_paths):
+                with open(part_path, "r") as part:
+                    shutil.copyfileobj(part, outputs[extension])
+                os.remove(part_path)
+        for extension, stream in outputs.items():
+            stream.close()
+            os.replace(f"{output_paths[extension]}.tmp", output_paths[extension])
+    finally:
+        for extension, stream in outputs.items():
+            stream.close()
+            if os.path.exists(f"{output_paths[extension]}.tmp"):
+                os.remove(f"{output_paths[extension]}.tmp")
+        for hofn_type in hofn_types:
+            for extension in output_paths.keys():
+                if os.path.exists(get_part_path(nation, hofn_type, extension)):
+                    os.remove(get_part_path(nation, hofn_type, extension))
+    pool.join()
+    if not args.no_index:
+        write_geo_index(output_paths["tsv"], f"data/output/{nation}/NT2_GEO_POLYGON.idx", mcc)
+        print(f"Spatial index: data/output/{nation}/NT2_GEO_POLYGON.idx")
     print("Generate nt2 geo poloygon done.")
     exit()
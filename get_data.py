@@ -1,80 +1,132 @@
 import logging
+import logging.config
 import os
+import sys
 import traceback
 from datetime import date, datetime
 import yaml
-import src.lines as lines
-import src.rings as rings
-import src.buildings as buildings
 from argparse import ArgumentParser
 
-from src.enum import Tag, National,HofnType
+from src.config import get_config, set_config_path, RESOURCE_PATH
 
 VERSION = 3
 DEBUG_VERSION = 0
 
 if __name__ == "__main__":
-    ###############################################
-    # READ CONFIG
-    config = dict()
-    try:
-        with open('config.yaml', 'r') as stream:
-            config = yaml.safe_load(stream)
-    except:
-        pass
-    rings_mode = config.get("mode").get("rings")
-    lines_mode = config.get("mode").get("lines")
-    DEBUGGING = config.get("debug")
-    ALL_OFFLINE = config.get("all_offline")
-
     ###############################################
     # PROGRAM ARGUMENTS
+    # Heavy libraries (geopandas, osmium, shapely ...) are imported by the stage being run, keep parsing fast.
     parser = ArgumentParser()
     # REQUIRED
     parser.add_argument("input", type=str, help="Input osm.pbf file path.", nargs="?")
-    parser.add_argument("mcc", type=str, help="mcc", nargs="?")
+    parser.add_argument("mcc", type=str, help="mcc, format: mcc1,mcc2,... to extract several nations from one file in one pass.", nargs="?")
     # parser.add_argument("nation", type=str, help="Nation name.")
     parser.add_argument("hofn_type", type=str, help="Process hofn type, Output file name", nargs="?")
     # OPTIONAL
     parser.add_argument("-v", "--version", help="Check current version", action="store_true")
+    parser.add_argument("--config", type=str, help="Config file path, default config.yaml next to get_data.py.")
     parser.add_argument("--limit_relation_id", type=str, help="If set, limit relation id will be changed from nation to id set.")
     parser.add_argument("--divide", type=str, help="format: id1, id2, id3 ..., if not set, all lines will not be divide.", nargs="+")
     parser.add_argument("--tags", type=str, help="format: tag_name1 search_value1 tag_name2 search_value2 ..., if not set, use default tags in config", nargs="+")
+    parser.add_argument("--memory_budget", type=float, help="MB per feature table, run in streaming mode and spill features to disk, override config.")
+    parser.add_argument("--force_stages", type=str, help="format: stage1 stage2 ..., rerun stages and stages after them even if checkpointed.", nargs="+")
+    parser.add_argument("--skip_stages", type=str, help="format: stage1 stage2 ..., skip stages, e.g. output, result of previous stage is passed through.", nargs="+")
+    parser.add_argument("--workers", type=int, help="Worker processes of parallel stages, override config.")
+    parser.add_argument("--serial", help="Run parallel stages in one process, for debugging.", action="store_true")
+    parser.add_argument("--serve", help="Run as resident extraction service, keep data of input and mcc in memory.", action="store_true")
+    parser.add_argument("--host", type=str, help="Service host, default 127.0.0.1", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="Service port, default 8765", default=8765)
+    parser.add_argument("--socket", type=str, help="Serve on unix socket path instead of host and port.")
+    parser.add_argument("--preload", type=str, help="format: HofnType1 HofnType2 ..., load at service start.", nargs="+")
+    parser.add_argument("--estimate", type=str, help="format: HofnType1 HofnType2 ..., estimate counts, memory and runtime from a sample of input blocks "
+                                                     "and recommend settings, without running, all types if empty.", nargs="*")
+    parser.add_argument("--bbox", type=float, help="format: min_lon min_lat max_lon max_lat, only extract, merge and output within the box, "
+                                                   "for development, the subset extract is cached.", nargs=4)
+    parser.add_argument("--within_wkt", type=str, help="WKT polygon, only extract, merge and output within it, for development, the subset extract is cached.")
     args = parser.parse_args()
     if args.version:
         print(f'{VERSION}.{DEBUG_VERSION}')
         exit()
-    
+
+    ###############################################
+    # READ CONFIG
+    if args.config:
+        set_config_path(args.config)
+    config = get_config()
+    rings_mode = config.get("mode").get("rings")
+    lines_mode = config.get("mode").get("lines")
+    DEBUGGING = config.get("debug")
+    ALL_OFFLINE = config.get("all_offline")
+    EXTRACT_CACHE = config.get("extract_cache")
+    MEMORY_BUDGET = int((args.memory_budget if args.memory_budget is not None else config.get("memory_budget") or 0) * 1024 * 1024)
+    SPILL_PATH = config.get("spill_path")
+    CHECKPOINT_PATH = config.get("checkpoint")
+    SNAP_DISTANCE = config.get("snap_distance")
+    TILE_SIZE = config.get("tile_size")
+    SIMPLIFY = config.get("simplify")
+    HILBERT_ORDER = config.get("hilbert_order")
+    if args.estimate is not None:
+        from src.enum import Tag, National, HofnType
+        from src.estimate import main as estimate
+        hofn_types = args.estimate or ([args.hofn_type] if args.hofn_type else [])
+        modes = [HofnType(i).name for i in hofn_types] if hofn_types else \
+            [i for i in rings_mode + lines_mode + ["building"] if i in Tag.__members__ and Tag[i].value]
+        keep_relation_ids = [National[National.get_country_by_mcc(mcc)].get_relation_id() for mcc in args.mcc.split(",")] if args.mcc else None
+        estimate(args.input, modes, config, args.workers, keep_relation_ids)
+        sys.exit(0)
+    from src.executor import set_executor
+    from src.writer import close_writer
+    executor = set_executor(args.workers, args.serial)
+    FORCE_STAGES = args.force_stages
+    SKIP_STAGES = args.skip_stages
+
+    from src.enum import Tag, National, HofnType
+
     #######################################
     # Loading program arguments
     input_path = args.input
-    nation = National.get_country_by_mcc(args.mcc)
+    nations = [National.get_country_by_mcc(mcc) for mcc in args.mcc.split(",")]
+    if len(nations) > 1 and (args.limit_relation_id or args.divide or args.serve or MEMORY_BUDGET):
+        parser.error("Several mccs can not be used with --limit_relation_id, --divide, --serve or memory budget.")
+    if args.bbox and args.within_wkt:
+        parser.error("--bbox and --within_wkt can not be used together.")
+    if (args.bbox or args.within_wkt) and args.serve:
+        parser.error("--bbox and --within_wkt can not be used with --serve.")
+    # Subset of limit area as WKT, it clips limit areas, so reading boxes, merging and output only cover the subset.
+    WITHIN = None
+    if args.bbox or args.within_wkt:
+        import shapely
+        try:
+            within = shapely.box(*args.bbox) if args.bbox else shapely.from_wkt(args.within_wkt)
+        except shapely.errors.ShapelyError as e:
+            parser.error(f"Invalid --within_wkt: {e}")
+        if within.geom_type not in ("Polygon", "MultiPolygon") or within.is_empty:
+            parser.error("--bbox or --within_wkt must be a non-empty polygon.")
+        WITHIN = within.wkt
+    nation = nations[0]
     limit_relation_id = args.limit_relation_id if args.limit_relation_id else National[nation].get_relation_id()
     divide = args.divide
     hofn_type = args.hofn_type
-    mode = HofnType(hofn_type).name
+    mode = HofnType(hofn_type).name if not args.serve else "service"
     output_path = f"{config.get('path').get('output')}/{nation}/{mode}"
-    if os.path.isdir(output_path) is not True:
-        os.makedirs(output_path)
+    # Each nation keeps its own output directory, nation -> (limit relation id, output path).
+    nation_outputs = {item: (National[item].get_relation_id(), f"{config.get('path').get('output')}/{item}/{mode}") for item in nations}
+    for _, nation_output_path in nation_outputs.values():
+        if os.path.isdir(nation_output_path) is not True and not args.serve:
+            os.makedirs(nation_output_path)
 
     # Grouping tags
     if args.tags:
-        tags = {}
-        tmp = 0
-        while tmp < len(args.tags) - 1:
-            tag = args.tags[tmp]
-            value = args.tags[tmp + 1]
-            tags[args.tags[tmp]] = args.tags[tmp + 1]
-            tmp += 2
+        tags = Tag.group_arguments(args.tags)
     else:
-        tags = Tag[mode].value  # default value
+        tags = Tag[mode].value if not args.serve else None  # default value
 
     # road LEVEL_DICT
     highways_level = config.get("highways")
     ##########################################################################
     # DEBUG config
     try:
-        with open('src/resource/logback.yaml', 'r') as stream:
+        with open(f'{RESOURCE_PATH}/logback.yaml', 'r') as stream:
             log_config = yaml.safe_load(stream)
             log_path = f"{config.get('path').get('log')}/{mode}"
             if not os.path.isdir(log_path):
@@ -95,19 +147,65 @@ if __name__ == "__main__":
     logging.info(f"MODE: {mode}")
     logging.info(f"INPUT FILE PATH: {input_path}")
     logging.info(f"OUTPUT FILE PATH: {output_path}")
-    logging.info(f"PROCESSING NATION: {nation}")
+    logging.info(f"PROCESSING NATION: {', '.join(nations)}")
     logging.info(f"RELATION ID OF LIMIT AREA: {limit_relation_id}")
     logging.info(f"SEARCH TAG WITH VALUE: {tags}")
     logging.info(f"REMERGE AND DIVIDE: {True}") if divide else True
     logging.info(f"DEBUGGING: {DEBUGGING}") if DEBUGGING else True
+    logging.info(f"EXTRACT CACHE: {EXTRACT_CACHE}") if EXTRACT_CACHE else True
+    logging.info(f"SUBSET: {WITHIN}") if WITHIN else True
+    logging.info(f"MEMORY BUDGET: {MEMORY_BUDGET / 1024 / 1024} MB, SPILL PATH: {SPILL_PATH}") if MEMORY_BUDGET else True
+    logging.info(f"CHECKPOINT PATH: {CHECKPOINT_PATH}, FORCE STAGES: {FORCE_STAGES}, SKIP STAGES: {SKIP_STAGES}") if CHECKPOINT_PATH else True
+    logging.info(f"WORKERS: {executor.workers}{' (serial)' if executor.serial else ''}")
     logging.info("--------------------------------------------")
+    executor.start()  # Before any background write, workers are forked once with logging configured.
+    if args.serve:
+        from src.service import ExtractionService, serve
+        service = ExtractionService(input_path, nation, limit_relation_id, ALL_OFFLINE=ALL_OFFLINE, DEBUGGING=DEBUGGING, EXTRACT_CACHE=EXTRACT_CACHE)
+        service.load(args.preload or [])
+        serve(service, host=args.host, port=args.port, socket_path=args.socket)
+        executor.close()
+        close_writer()
+        sys.exit(0)
+    ##########################################################################
+    # Read the small filtered extract instead of the whole nation file, keep limit relation for offline limit area.
+    # A subset always reads its extract, only objects of the subset are kept, so development reruns take seconds.
+    if EXTRACT_CACHE or WITHIN:
+        from src.utils import ExtractUtils
+        input_path = ExtractUtils.get_filtered_extract(input_path, mode, tags, [limit_relation_id for limit_relation_id, _ in nation_outputs.values()], WITHIN)
+    ##########################################################################
+    # Several nations share one pass on file, features are routed to each nation's limit area.
+    if len(nations) > 1:
+        if mode in rings_mode:
+            import src.rings as rings
+            rings.main_nations(input_path, nation_outputs, mode, tags, DEBUGGING, ALL_OFFLINE, CHECKPOINT_PATH, FORCE_STAGES, SKIP_STAGES, SIMPLIFY, HILBERT_ORDER, WITHIN)
+        elif mode in lines_mode:
+            import src.lines as lines
+            lines.main_nations(input_path, nation_outputs, mode, tags, DEBUGGING, highways_level if mode == "highway" else None, ALL_OFFLINE, SPILL_PATH,
+                               CHECKPOINT_PATH, FORCE_STAGES, SKIP_STAGES, SNAP_DISTANCE, SIMPLIFY, HILBERT_ORDER, WITHIN)
+        elif mode == "building":
+            import src.buildings as buildings
+            buildings.main_nations(input_path, nation_outputs, DEBUGGING, ALL_OFFLINE, CHECKPOINT_PATH, FORCE_STAGES, SKIP_STAGES, TILE_SIZE, HILBERT_ORDER, WITHIN)
+        executor.close()
+        close_writer()
+        sys.exit(0)
     ##########################################################################
     if mode in rings_mode:
-        rings.main(input_path=input_path, output_path=output_path, nation=nation, limit_relation_id=limit_relation_id, mode=mode, tags=tags, DEBUGGING=DEBUGGING, ALL_OFFLINE=ALL_OFFLINE)
+        import src.rings as rings
+        rings.main(input_path=input_path, output_path=output_path, nation=nation, limit_relation_id=limit_relation_id, mode=mode, tags=tags, DEBUGGING=DEBUGGING, ALL_OFFLINE=ALL_OFFLINE, MEMORY_BUDGET=MEMORY_BUDGET, SPILL_PATH=SPILL_PATH,
+                   CHECKPOINT_PATH=CHECKPOINT_PATH, FORCE_STAGES=FORCE_STAGES, SKIP_STAGES=SKIP_STAGES, SIMPLIFY=SIMPLIFY, HILBERT_ORDER=HILBERT_ORDER, WITHIN=WITHIN)
     elif mode in lines_mode:
+        import src.lines as lines
         if mode == "highway":
-            lines.main(input_path=input_path, output_path=output_path, nation=nation, limit_relation_id=limit_relation_id, mode=mode, tags=tags, DIVIDE=divide, LEVEL_DICT=highways_level, DEBUGGING=DEBUGGING, ALL_OFFLINE=ALL_OFFLINE)
+            lines.main(input_path=input_path, output_path=output_path, nation=nation, limit_relation_id=limit_relation_id, mode=mode, tags=tags, DIVIDE=divide, LEVEL_DICT=highways_level, DEBUGGING=DEBUGGING, ALL_OFFLINE=ALL_OFFLINE, MEMORY_BUDGET=MEMORY_BUDGET, SPILL_PATH=SPILL_PATH,
+                       CHECKPOINT_PATH=CHECKPOINT_PATH, FORCE_STAGES=FORCE_STAGES, SKIP_STAGES=SKIP_STAGES, SNAP_DISTANCE=SNAP_DISTANCE, SIMPLIFY=SIMPLIFY, HILBERT_ORDER=HILBERT_ORDER, WITHIN=WITHIN)
         else:
-            lines.main(input_path=input_path, output_path=output_path, nation=nation, limit_relation_id=limit_relation_id, mode=mode, tags=tags, DIVIDE=divide, DEBUGGING=DEBUGGING, ALL_OFFLINE=ALL_OFFLINE)
+            lines.main(input_path=input_path, output_path=output_path, nation=nation, limit_relation_id=limit_relation_id, mode=mode, tags=tags, DIVIDE=divide, DEBUGGING=DEBUGGING, ALL_OFFLINE=ALL_OFFLINE, MEMORY_BUDGET=MEMORY_BUDGET, SPILL_PATH=SPILL_PATH,
+                       CHECKPOINT_PATH=CHECKPOINT_PATH, FORCE_STAGES=FORCE_STAGES, SKIP_STAGES=SKIP_STAGES, SNAP_DISTANCE=SNAP_DISTANCE, SIMPLIFY=SIMPLIFY, HILBERT_ORDER=HILBERT_ORDER, WITHIN=WITHIN)
     elif mode == "building":
-        buildings.main(input_path, output_path, nation, limit_relation_id, DEBUGGING, ALL_OFFLINE)
+        import src.buildings as buildings
+        buildings.main(input_path, output_path, nation, limit_relation_id, DEBUGGING, ALL_OFFLINE, MEMORY_BUDGET, SPILL_PATH, CHECKPOINT_PATH, FORCE_STAGES, SKIP_STAGES, TILE_SIZE,
+                       HILBERT_ORDER, WITHIN)
+    executor.close()
+    close_writer()  # Wait for background writes of outputs.
+    sys.exit(0)
@@ -1,10 +1,8 @@
 # %%
 import geopandas
 import pandas
-import overpy
 import sys
 sys.setrecursionlimit(2000)
-from shapely.geometry import Point, LineString, Polygon
 from src.utils import LineUtils, brute_force_merge
 # NT2_GEO_POLYGON = pandas.read_csv(f"{FILE_PATH}/NT2_GEO_POLYGON.tsv", sep="\t")
 # NT2_GEO_POLYGON.to_csv(f"{FILE_PATH}/NT2_GEO_POLYGON.csv", index=False)
@@ -12,29 +10,11 @@ COUNTRY = "Mexico"
 MODE = "coastline"
 FILE_PATH = f"./data/output/{COUNTRY}/{MODE}"
 
-# %%
-def get_way_geometry_from_overpy(way_id):
-    api = overpy.Overpass()
-    query_message = \
-    f"""
-    way({way_id}); 
-    out body;
-    >;
-    out skel qt;
-    """
-    result = api.query(query_message)
-    for key, way in enumerate(result.ways):
-        linestring_coords = []
-        for node in way.nodes:
-            linestring_coords.append(Point(node.lon, node.lat))
-        lineStrings = LineString(linestring_coords)
-
-    return lineStrings
-
-
 # %% Get addtional way
 way_id = [341831948, 1014234098, 419777872, 22480747, 1085734436, 488754881, 253306499, 787243277, 1009003835, 1009003836]
-ways = [get_way_geometry_from_overpy(i) for i in way_id]
+ways = LineUtils.get_ways_geometry_from_overpy(way_id)
+way_id = list(ways.keys())
+ways = list(ways.values())
 df = geopandas.GeoDataFrame(ways,columns=["geometry"])
 df["POLYGON_ID"] = way_id
 df["POLYGON_NAME"] = "UNKNOWN"
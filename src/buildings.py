@@ -1,43 +1,49 @@
+import json
 import logging
+import os
 import time
 from typing import Dict
 
 import geopandas
 import osmium
 import pandas
-import multiprocessing
 import numpy
-from shapely import wkt
+import shapely
 from shapely.geometry import MultiPolygon, Polygon
 from shapely.ops import polygonize
 from src.enum import Tag
-from src.utils import LimitAreaUtils, RingUtils,MPUtils, BuildingUtils
+from src.models import FeatureTable
+from src.pipeline import Pipeline
+from src.executor import get_executor
+from src.reader import apply_file
+from src.writer import get_writer
+from src.utils import LimitAreaUtils, RingUtils,MPUtils, BuildingUtils, ExtractRelationHandler, BoxFilter, HilbertUtils
 from itertools import repeat
-wktfab = osmium.geom.WKTFactory()
-cpu_count = int(numpy.where(multiprocessing.cpu_count() > 20, 20, multiprocessing.cpu_count() - 1))
+wkbfab = osmium.geom.WKBFactory()
 
 class BuildingHandler(osmium.SimpleHandler):
 
-    def __init__(self, tags):
+    def __init__(self, tags, memory_budget=None, spill_path=None, member_ids=None, box_filter=None):
         super().__init__()
-        self.way_buildings = []
-        self.way_dict = {}
+        self.way_buildings = FeatureTable(columns=("POLYGON_NAME", "HEIGHT", "LEVEL"), memory_budget=memory_budget, spill_path=spill_path)
+        self.way_dict = FeatureTable(columns=("POLYGON_NAME", "HEIGHT", "LEVEL"))  # Look up by id, get Way view.
         self.relation_dict = {}
         self.tags = tags
+        self.member_ids = member_ids  # If set, only keep relation member ways in way_dict.
+        self.box_filter = box_filter  # Reject ways and areas outside limit area boxes before creating geometry.
 
     def area(self, area):
         try:
             if area.tags.get("building") or area.tags.get("type") == "building":
                 ring_id = area.orig_id()
                 ring_name = area.tags.get("name") if area.tags.get("name") else "UNKNOWN"  # create new string object
-                ring_geometry = wkt.loads(wktfab.create_multipolygon(area))
                 ring_height = area.tags.get("height") if area.tags.get("height") else "UNKNOWN"
                 ring_level = area.tags.get("building:levels") if area.tags.get("building:levels") else "UNKNOWN"
                 if area.from_way():
-                    # All area from way is one polygon (len(geometry) == 1)
-                    ring_geometry = list(ring_geometry)[0]  # Extract polygon from multipolygon
-                    building = Building(polygon_id=ring_id, polygon_name=ring_name, geometry=ring_geometry, height=ring_height, level=ring_level)
-                    self.way_buildings.append(building)
+                    if self.box_filter is not None and not self.box_filter.is_area_inside(area):
+                        return
+                    # All area from way is one polygon, extracted from multipolygon after reading.
+                    self.way_buildings.append(ring_id, bytes.fromhex(wkbfab.create_multipolygon(area)), POLYGON_NAME=ring_name, HEIGHT=ring_height, LEVEL=ring_level)
         except:
             pass
 
@@ -49,10 +55,17 @@ class BuildingHandler(osmium.SimpleHandler):
                 self.relation_dict[relation.id].append({"id": member.ref, "role": member.role, "type": member.type})
 
     def way(self, way):
-        way_geometry = wkt.loads(wktfab.create_linestring(way))
-        self.way_dict[way.id] = {"id": way.id, "name": way.tags.get("name") if way.tags.get("name") else "UNKNOWN", "geometry": way_geometry,
-                                 "height": way.tags.get("height") if way.tags.get("height") else "UNKNOWN",
-                                 "level": way.tags.get("building:levels") if way.tags.get("building:levels") else "UNKNOWN"}
+        if self.member_ids is not None and way.id not in self.member_ids:
+            return
+        if self.box_filter is not None and not self.box_filter.is_way_inside(way):
+            return
+        try:
+            way_wkb = bytes.fromhex(wkbfab.create_linestring(way))
+        except:
+            return
+        self.way_dict.append(way.id, way_wkb, POLYGON_NAME=way.tags.get("name") if way.tags.get("name") else "UNKNOWN",
+                             HEIGHT=way.tags.get("height") if way.tags.get("height") else "UNKNOWN",
+                             LEVEL=way.tags.get("building:levels") if way.tags.get("building:levels") else "UNKNOWN")
 
 
 class Building:
@@ -78,55 +91,65 @@ def get_relation_member_data_building(relation_dict: Dict, way_dict: Dict, tags:
             way = way_dict.get(way_id, False)
             if way is False:
                 continue
-            name = way.get("name")
             role = member.get("role")
             if role == '':
                 role = "outer"
             if way:
                 ring_rel_members_dict.get("relation_id").append(relation_id)
                 ring_rel_members_dict.get("way_id").append(way_id)
-                ring_rel_members_dict.get("name").append(way.get("name"))
-                ring_rel_members_dict.get("geometry").append(way.get("geometry"))
+                ring_rel_members_dict.get("name").append(way.name)
+                ring_rel_members_dict.get("geometry").append(way.geometry)
                 ring_rel_members_dict.get("role").append(role)
                 ring_rel_members_dict.get("type").append(member.get("type"))
-                ring_rel_members_dict.get("height").append(way.get("height"))
-                ring_rel_members_dict.get("level").append(way.get("level"))
+                ring_rel_members_dict.get("height").append(way.height)
+                ring_rel_members_dict.get("level").append(way.level)
             else:
                 pass
     return ring_rel_members_dict
 
 
-# %%
-def main(input_path, output_path, nation, limit_relation_id, DEBUGGING=False, ALL_OFFLINE=True):
-    start_time = time.time()
-    logging.info("[1/2] Getting data from .osm.pbf . ")
-    if ALL_OFFLINE:
-        limit_area = LimitAreaUtils.get_limit_relation_geom(input_path, limit_relation_id)
-    else:
-        limit_area = LimitAreaUtils.get_relation_polygon_with_overpy(limit_relation_id)
+HEADER = ["POLYGON_ID", "POLYGON_NAME", "geometry", "HEIGHT", "LEVEL"]
 
-    building_handler = BuildingHandler(Tag["building"].value)
-    building_handler.apply_file(input_path, idx="flex_mem", locations=True)
-    relation_dict = building_handler.relation_dict
-    way_dict = building_handler.way_dict
 
-    # %%
-    way_buildings = building_handler.way_buildings
-    way_buildings_in_limit_area = []
-    for way_building in way_buildings:
-        if way_building.geometry.within(limit_area):
-            way_buildings_in_limit_area.append(Building(way_building.polygon_id, way_building.polygon_name, way_building.geometry, way_building.height, way_building.level))
-    header = ["POLYGON_ID", "POLYGON_NAME", "geometry", "HEIGHT", "LEVEL"]
-    way_buildings_gdf = geopandas.GeoDataFrame([[building.polygon_id, building.polygon_name, building.geometry, building.height, building.level] for building in way_buildings_in_limit_area], columns=header)
-    way_buildings_gdf.to_file(f"{output_path}/way_buildings.geojson", driver="GeoJSON") if DEBUGGING else None
-    # %%
-    logging.info("[2/2] Extract inner from outer and get all the part and outline as polygons.")
+def read(input_path, memory_budget=None, spill_path=None, limit_area=None) -> tuple:
+    """
+    With memory_budget, way buildings are spilled to disk and only relation member ways are kept for look up,
+    which takes one more pass on relations. With limit_area, ways and areas outside its boxes are skipped.
+    """
+    tags = Tag["building"].value
+    member_ids = None
+    if memory_budget:
+        relation_handler = ExtractRelationHandler(tags, set())
+        relation_handler.apply_file(input_path)
+        member_ids = relation_handler.way_ids
+    box_filter = BoxFilter.from_limit_area(limit_area) if limit_area is not None else None
+    building_handler = BuildingHandler(tags, memory_budget, spill_path, member_ids, box_filter)
+    apply_file(building_handler, input_path, spill_path)
+    return building_handler.way_buildings, building_handler.relation_dict, building_handler.way_dict
+
+
+def prepare(way_buildings, relation_dict, way_dict, limit_area) -> tuple:
+    """
+    Limit way buildings and relation members with limit area, group relation members by role.
+    """
+    way_buildings_gdf = prepare_ways(way_buildings.to_geodataframe(), limit_area)
+    return way_buildings_gdf, prepare_relations(relation_dict, way_dict, limit_area)
+
+
+def prepare_ways(way_buildings_gdf, limit_area) -> geopandas.GeoDataFrame:
+    way_buildings_gdf = way_buildings_gdf[HEADER]
+    way_buildings_gdf["geometry"] = way_buildings_gdf.geometry.apply(lambda geometry: geometry.geoms[0])  # Extract polygon from multipolygon
+    return way_buildings_gdf[way_buildings_gdf.geometry.within(limit_area)].reset_index(drop=True)
+
+
+def prepare_relations(relation_dict, way_dict, limit_area) -> dict:
     relation_member_dict = get_relation_member_data_building(relation_dict=relation_dict, way_dict=way_dict, tags=["outer", "inner", "", "outline", "part"])
+    if not relation_member_dict["relation_id"]:  # No relations in small subsets, an empty GeoDataFrame has no geometry column.
+        return dict()
     relation_member_data: geopandas.GeoDataFrame = geopandas.GeoDataFrame(relation_member_dict)
     relation_member_data = LimitAreaUtils.prepare_data(relation_member_data, limit_area.wkt)
     relation_member_dict = relation_member_data.to_dict("index")
-    
-    # %%
+
     temp = dict()
     for member in relation_member_dict.values():
         if not list(polygonize(member.get("geometry"))):
@@ -147,44 +170,241 @@ def main(input_path, output_path, nation, limit_relation_id, DEBUGGING=False, AL
             temp.get(relation_id).get("outer").append(building)
         else:  # ONLY for debug purpose.
             temp.get(relation_id).get("other").append(building)
-    relation_member_dict = temp
-
-    logging.info("Group data completed, start to merge.")
-    # %%
-    # pool = multiprocessing.Pool(cpu_count)
-    # manager = multiprocessing.Manager()
-    # polygon_id_used_table = manager.list()
-
-    # # Avoid duplicate POLYGON_ID (WAY_ID)
-    # polygon_id_used_table += list(way_buildings_gdf["POLYGON_ID"].values)
+    return temp
 
-    # relation_member_sub_dicts = [item for item in MPUtils.chunks(relation_member_dict, int(len(relation_member_dict) / cpu_count))]
-    # pool.starmap(BuildingUtils.get_building_rings_merged_results, zip(relation_member_sub_dicts, repeat(polygon_id_used_table), repeat("building")))
-    # pool.close()
 
-    # relation_member_dict = {k:Building(polygon_id=v["POLYGON_ID"], polygon_name=v["POLYGON_NAME"], height=v["height"], level=v["height"], geometry=v["geometry"]) for x in relation_member_sub_dicts for k,v in x.items()}
-    # logging.info("Merge completed, start to extract.")
-    # %%
-    relation_result = geopandas.GeoDataFrame(columns=header)
+def merge(relation_member_dict) -> geopandas.GeoDataFrame:
+    """
+    Clip inners from outers in each relation, parts and outlines are kept as they are.
+    Relations run in parallel by tile in process_shards.
+    """
+    relation_result = geopandas.GeoDataFrame(columns=HEADER)
     for relation_id, relation in relation_member_dict.items():
 
         outers = relation.get("outer")
         inners = relation.get("inner")
         others = relation.get("other")
 
-        outers_gdf = geopandas.GeoDataFrame([[outer.polygon_id, outer.polygon_name, outer.geometry, outer.height, outer.level] for outer in outers], columns=header)
-        inners_gdf = geopandas.GeoDataFrame([[inner.polygon_id, inner.polygon_name, inner.geometry, inner.height, inner.level] for inner in inners], columns=header)
-        others_gdf = geopandas.GeoDataFrame([[other.polygon_id, other.polygon_name, other.geometry, other.height, other.level] for other in others], columns=header)
+        outers_gdf = geopandas.GeoDataFrame([[outer.polygon_id, outer.polygon_name, outer.geometry, outer.height, outer.level] for outer in outers], columns=HEADER)
+        inners_gdf = geopandas.GeoDataFrame([[inner.polygon_id, inner.polygon_name, inner.geometry, inner.height, inner.level] for inner in inners], columns=HEADER)
+        others_gdf = geopandas.GeoDataFrame([[other.polygon_id, other.polygon_name, other.geometry, other.height, other.level] for other in others], columns=HEADER)
         if outers and inners:
             outers_gdf_clipped = geopandas.overlay(outers_gdf, inners_gdf, how="difference")
             relation_result = pandas.concat([relation_result, outers_gdf_clipped])
         if others:
             relation_result = pandas.concat([relation_result, others_gdf])
-    logging.info("Extraction completed, start to output file.")
+    return relation_result
+
+
+def get_tiles(bounds: numpy.ndarray, tile_size) -> list:
+    """
+    (column, row) of tile_size degree tiles containing the centers of bounds.
+    """
+    centers = numpy.stack([(bounds[:, 0] + bounds[:, 2]) / 2, (bounds[:, 1] + bounds[:, 3]) / 2], axis=1) if len(bounds) else numpy.empty((0, 2))
+    return list(map(tuple, numpy.floor(centers / tile_size).astype(numpy.int64).tolist()))
+
+
+def get_shards(way_buildings, relation_dict, way_dict, limit_area, tile_size, hilbert_order=False) -> list:
+    """
+    Shard buildings by tile, relations are placed by bounds of their member ways so they are not split.
+    Return [(tile, way buildings, relation dict, member way table, limit area clipped to the shard)] sorted by tile,
+    or by Hilbert index of tiles with hilbert_order.
+    """
+    way_buildings_gdf = way_buildings.to_geodataframe()
+    way_bounds = shapely.bounds(way_buildings_gdf.geometry.values)
+    member_bounds = shapely.bounds(way_dict.get_geometries().values)
+    shards = dict()  # tile -> [way building rows, relation dict, member way rows]
+    for row, tile in enumerate(get_tiles(way_bounds, tile_size)):
+        shards.setdefault(tile, [[], dict(), set()])[0].append(row)
+    relations = []
+    for relation_id, members in relation_dict.items():
+        indices = [view.index for view in (way_dict.get(member.get("id")) for member in members) if view is not None]
+        if indices:  # Relations without member ways in limit boxes have nothing to build.
+            relations.append((relation_id, members, indices))
+    relation_bounds = numpy.array([[*member_bounds[indices, :2].min(axis=0), *member_bounds[indices, 2:].max(axis=0)] for _, _, indices in relations]).reshape(-1, 4)
+    for (relation_id, members, indices), tile in zip(relations, get_tiles(relation_bounds, tile_size)):
+        shard = shards.setdefault(tile, [[], dict(), set()])
+        shard[1][relation_id] = members
+        shard[2].update(indices)
+    tiles = sorted(shards.keys())
+    if hilbert_order and tiles:
+        tiles = [tiles[i] for i in HilbertUtils.get_order(shapely.points(numpy.array(tiles, dtype=numpy.float64)))]
+    # Clip limit area to bounds of everything in the shard, workers test only against their part of it.
+    shard_bounds = [numpy.concatenate([way_bounds[shards[tile][0]], member_bounds[sorted(shards[tile][2])]]) for tile in tiles]
+    boxes = shapely.box(*numpy.array([[*bounds[:, :2].min(axis=0), *bounds[:, 2:].max(axis=0)] for bounds in shard_bounds]).reshape(-1, 4).T)
+    limit_areas = shapely.intersection(limit_area, shapely.buffer(boxes, 1e-7, join_style="mitre"))
+    return [(tile, way_buildings_gdf.iloc[shards[tile][0]].reset_index(drop=True), shards[tile][1], way_dict.take(sorted(shards[tile][2])), shard_limit_area)
+            for tile, shard_limit_area in zip(tiles, limit_areas) if not shard_limit_area.is_empty]  # Tiles outside limit area have nothing to build.
+
+
+def process_shard(tile, way_buildings_gdf, relation_dict, way_dict, limit_area) -> tuple:
+    """
+    Worker of one shard, limit way buildings and assemble relation buildings, return both.
+    """
+    way_buildings_gdf = prepare_ways(way_buildings_gdf, limit_area)
+    relation_result = merge(prepare_relations(relation_dict, way_dict, limit_area)) if relation_dict else geopandas.GeoDataFrame(columns=HEADER)
+    logging.debug(f"Tile {tile}: {len(way_buildings_gdf)} way buildings, {len(relation_result)} relation buildings.")
+    return way_buildings_gdf, relation_result
+
+
+def process_shards(shards) -> list:
+    """
+    Process shards in executor, return [(tile, way buildings, relation buildings)] in tile order so output does not depend on workers.
+    """
+    results = get_executor().starmap(process_shard, shards)
+    return [(shard[0], *result) for shard, result in zip(shards, results)]
+
+
+def write_manifest(manifest: dict, path):
+    with open(f"{path}.tmp", "w") as stream:
+        json.dump(manifest, stream, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+class PartitionWriter:
+    """
+    Write buildings of each tile to its own partition file under output_path/partitions, a tile written again is appended to,
+    and list partitions with their bbox and row count in output_path/manifest.json on close, in tile order,
+    or Hilbert order of tiles with hilbert_order. Empty tiles are not written, partitions of previous runs are removed.
+    With hilbert_order, buildings are written in Hilbert order of their bbox centers.
+    Files are written in background by the artifact writer, the manifest last.
+    """
+    def __init__(self, output_path, DEBUGGING=False, tile_size=None, hilbert_order=False):
+        self.output_path = output_path
+        self.DEBUGGING = DEBUGGING
+        self.tile_size = tile_size
+        self.hilbert_order = hilbert_order
+        self.extension = "geojson" if DEBUGGING else "tsv"
+        self.partitions = dict()  # tile -> partition of manifest
+        partition_path = f"{output_path}/partitions"
+        if not os.path.isdir(partition_path):
+            os.makedirs(partition_path)
+        for name in os.listdir(partition_path):  # Tiles of previous run may differ.
+            if name.startswith("buildings."):
+                os.remove(f"{partition_path}/{name}")
+        if os.path.exists(f"{output_path}/manifest.json"):
+            os.remove(f"{output_path}/manifest.json")
+
+    def write(self, tile, result):
+        if result.empty:
+            return
+        result = HilbertUtils.sort(result) if self.hilbert_order else result
+        partition = self.partitions.get(tile)
+        path = f"partitions/buildings.{tile[0]}_{tile[1]}.{self.extension}"
+        writer = get_writer()
+        if self.DEBUGGING:
+            writer.to_file(result, f"{self.output_path}/{path}", driver="GeoJSON", mode="a" if partition else "w")
+        else:
+            writer.to_csv(result, f"{self.output_path}/{path}", sep="\t", index=False, mode="a" if partition else "w", header=not partition)
+        bbox = [float(i) for i in result.total_bounds]
+        if partition:
+            partition["bbox"] = [*numpy.minimum(partition["bbox"][:2], bbox[:2]).tolist(), *numpy.maximum(partition["bbox"][2:], bbox[2:]).tolist()]
+            partition["rows"] += len(result)
+        else:
+            self.partitions[tile] = {"path": path, "tile": list(tile), "bbox": bbox, "rows": len(result)}
+
+    def write_tiles(self, result):
+        """
+        Split buildings by tiles containing their bbox centers and write each tile, used in streaming mode and by the service.
+        """
+        result = geopandas.GeoDataFrame(result[HEADER], geometry="geometry").reset_index(drop=True)
+        rows = dict()
+        for row, tile in enumerate(get_tiles(shapely.bounds(result.geometry.values).reshape(-1, 4), self.tile_size)):
+            rows.setdefault(tile, []).append(row)
+        for tile in sorted(rows.keys()):
+            self.write(tile, result.iloc[rows[tile]])
+
+    def close(self) -> dict:
+        tiles = sorted(self.partitions.keys())
+        if self.hilbert_order and tiles:
+            tiles = [tiles[i] for i in HilbertUtils.get_order(shapely.points(numpy.array(tiles, dtype=numpy.float64)))]
+        partitions = [self.partitions[tile] for tile in tiles]
+        manifest = {"tile_size": self.tile_size, "columns": HEADER, "rows": sum(partition["rows"] for partition in partitions), "partitions": partitions}
+        get_writer().submit(write_manifest, manifest, f"{self.output_path}/manifest.json")  # After the partitions it lists.
+        logging.info(f"Output {manifest['rows']} buildings in {len(partitions)} partitions, manifest: {self.output_path}/manifest.json")
+        return manifest
+
+
+def output_partitions(results, output_path, DEBUGGING=False, tile_size=None, hilbert_order=False):
+    """
+    Write buildings of each tile of results to its own partition with PartitionWriter.
+    """
+    partition_writer = PartitionWriter(output_path, DEBUGGING, tile_size, hilbert_order)
+    for tile, way_buildings_gdf, relation_result in results:
+        partition_writer.write(tile, geopandas.GeoDataFrame(pandas.concat([way_buildings_gdf, relation_result], ignore_index=True)[HEADER], geometry="geometry"))
+    partition_writer.close()
+
+
+def stream(input_path, output_path, limit_area, DEBUGGING=False, MEMORY_BUDGET=None, SPILL_PATH=None, HILBERT_ORDER=False, TILE_SIZE=0.25):
+    """
+    Limit way buildings chunk by chunk and append them to partitions of their tiles, then merge and append relation buildings.
+    """
+    way_buildings, relation_dict, way_dict = read(input_path, MEMORY_BUDGET, SPILL_PATH, limit_area)
+    logging.info(f"Way buildings spilled into {len(way_buildings.chunks)} chunks.")
+    partition_writer = PartitionWriter(output_path, DEBUGGING, TILE_SIZE, HILBERT_ORDER)
+    for way_buildings_gdf in way_buildings.iter_geodataframes():
+        partition_writer.write_tiles(prepare_ways(way_buildings_gdf, limit_area))
+    way_buildings.close()
+    logging.info("[2/2] Extract inner from outer and get all the part and outline as polygons.")
+    partition_writer.write_tiles(merge(prepare_relations(relation_dict, way_dict, limit_area)))
+    partition_writer.close()
+
+
+# %%
+def main(input_path, output_path, nation, limit_relation_id, DEBUGGING=False, ALL_OFFLINE=True, MEMORY_BUDGET=None, SPILL_PATH=None,
+         CHECKPOINT_PATH=None, FORCE_STAGES=None, SKIP_STAGES=None, TILE_SIZE=0.25, HILBERT_ORDER=False, WITHIN=None):
+    logging.info("[1/2] Getting data from .osm.pbf . ")
+    if MEMORY_BUDGET:
+        limit_area = LimitAreaUtils.get_limit_area(input_path, limit_relation_id, ALL_OFFLINE, WITHIN)
+        stream(input_path, output_path, limit_area, DEBUGGING, MEMORY_BUDGET, SPILL_PATH, HILBERT_ORDER, TILE_SIZE)
+        logging.info("Program completed.")
+        return
+    # Stages are checkpointed under CHECKPOINT_PATH, a rerun resumes from the first changed stage.
+    pipeline = Pipeline(input_path, CHECKPOINT_PATH, FORCE_STAGES, SKIP_STAGES, name=f"building.{limit_relation_id}")
+    pipeline.add("limit_area", lambda: LimitAreaUtils.get_limit_area(input_path, limit_relation_id, ALL_OFFLINE, WITHIN),
+                 params={"limit_relation_id": limit_relation_id, "ALL_OFFLINE": ALL_OFFLINE, "WITHIN": WITHIN})
+    pipeline.add("read", lambda limit_area: read(input_path, limit_area=limit_area), inputs=["limit_area"])
+    # Buildings and their relations are sharded by tile, each shard is limited and merged in its own worker.
+    pipeline.add("prepare", lambda read_result, limit_area: get_shards(*read_result, limit_area, TILE_SIZE, HILBERT_ORDER), inputs=["read", "limit_area"],
+                 params={"TILE_SIZE": TILE_SIZE, "HILBERT_ORDER": HILBERT_ORDER})
     # %%
-    relation_result.to_file(f"{output_path}/relation_buildings.geojson", driver="GeoJSON") if DEBUGGING else None
+    def merge_stage(shards):
+        logging.info(f"[2/2] Extract inner from outer and get all the part and outline as polygons in {len(shards)} tiles.")
+        results = process_shards(shards)
+        logging.info("Extraction completed, start to output file.")
+        return results
+    pipeline.add("merge", merge_stage, inputs=["prepare"], params={"version": 2})  # Bump version when result format changes.
 
     # %%
-    result = pandas.concat([way_buildings_gdf, relation_result])
-    result.to_file(f"{output_path}/buildings.geojson", driver="GeoJSON") if DEBUGGING else result.to_csv(f"{output_path}/buildings.tsv", sep="\t")
+    # Output is partitioned by tile, consumers load only partitions they need from manifest.json.
+    pipeline.add("output", lambda results: output_partitions(results, output_path, DEBUGGING, TILE_SIZE, HILBERT_ORDER), inputs=["merge"],
+                 params={"output_path": output_path, "DEBUGGING": DEBUGGING, "HILBERT_ORDER": HILBERT_ORDER}, persist=False, skippable=True)
+    pipeline.run("output")
+    logging.info("Program completed.")
+
+
+def main_nations(input_path, nations: dict, DEBUGGING=False, ALL_OFFLINE=True, CHECKPOINT_PATH=None, FORCE_STAGES=None, SKIP_STAGES=None, TILE_SIZE=0.25,
+                 HILBERT_ORDER=False, WITHIN=None):
+    """
+    Extract buildings of several nations, nation -> (limit relation id, output path), from one pass on a large file.
+    Buildings are sharded per nation, tiles outside a nation's limit area are dropped.
+    """
+    limit_relation_ids = {nation: limit_relation_id for nation, (limit_relation_id, _) in nations.items()}
+    logging.info(f"[1/2] Getting data of {list(nations.keys())} from .osm.pbf . ")
+    pipeline = Pipeline(input_path, CHECKPOINT_PATH, FORCE_STAGES, SKIP_STAGES, name=f"building.{'-'.join(nations.keys())}")
+    pipeline.add("limit_area", lambda: LimitAreaUtils.get_limit_areas(input_path, limit_relation_ids, ALL_OFFLINE, WITHIN),
+                 params={"limit_relation_ids": limit_relation_ids, "ALL_OFFLINE": ALL_OFFLINE, "WITHIN": WITHIN})
+    pipeline.add("read", lambda limit_areas: read(input_path, limit_area=LimitAreaUtils.get_combined_area(limit_areas)), inputs=["limit_area"])
+    for nation, (_, output_path) in nations.items():
+        pipeline.add(f"prepare.{nation}", lambda read_result, limit_areas, nation=nation: get_shards(*read_result, limit_areas[nation], TILE_SIZE, HILBERT_ORDER),
+                     inputs=["read", "limit_area"], params={"TILE_SIZE": TILE_SIZE, "HILBERT_ORDER": HILBERT_ORDER})
+
+        def merge_stage(shards, nation=nation):
+            logging.info(f"[2/2] Extract inner from outer and get all the part and outline as polygons of {nation} in {len(shards)} tiles.")
+            return process_shards(shards)
+        pipeline.add(f"merge.{nation}", merge_stage, inputs=[f"prepare.{nation}"], params={"version": 2})
+        pipeline.add(f"output.{nation}", lambda results, output_path=output_path: output_partitions(results, output_path, DEBUGGING, TILE_SIZE, HILBERT_ORDER),
+                     inputs=[f"merge.{nation}"], params={"output_path": output_path, "DEBUGGING": DEBUGGING, "HILBERT_ORDER": HILBERT_ORDER}, persist=False, skippable=True)
+    for nation in nations.keys():
+        pipeline.run(f"output.{nation}")
     logging.info("Program completed.")
@@ -0,0 +1,38 @@
+import os
+
+import yaml
+
+CONFIG_ENV = "OSM_OFFLINE_PARSER_CONFIG"
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.yaml")
+RESOURCE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resource")
+
+config_path = None
+config = None
+
+
+def set_config_path(path):
+    """
+    Override config path, also exported to environment so spawned workers load the same config.
+    """
+    global config_path, config
+    config_path = os.path.abspath(path)
+    os.environ[CONFIG_ENV] = config_path
+    config = None
+
+
+def get_config_path() -> str:
+    return config_path or os.environ.get(CONFIG_ENV) or DEFAULT_CONFIG_PATH
+
+
+def get_config() -> dict:
+    """
+    Load config once, lazily, from --config, environment variable or config.yaml next to the program.
+    """
+    global config
+    if config is None:
+        path = get_config_path()
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Config file {path} not found, set it with --config or {CONFIG_ENV}.")
+        with open(path, 'r') as stream:
+            config = yaml.safe_load(stream)
+    return config
@@ -0,0 +1,274 @@
+import os
+import time
+
+import numpy
+import osmium
+
+from src.executor import Executor
+from src.reader import get_blocks
+from src.utils import is_tags_matched, ExtractUtils
+
+SAMPLE_BLOCKS = 64
+# Single core costs of stages in microseconds (per feature, per coordinate) and whether the stage runs on workers,
+# calibrated with a synthetic nation file, scaled by the way callback speed measured while sampling.
+STAGE_COSTS = {
+    "rings": {"read": (32, 3.9, False), "prepare": (24, 0, True), "merge": (260, 0, True), "polygonize": (28, 0, True), "output": (10, 1, False)},
+    "lines": {"read": (32, 3.9, True), "prepare": (45, 0, False), "merge": (27, 0, False), "output": (10, 1, False)},
+    "highway": {"read": (32, 3.9, True), "prepare": (45, 0, False), "merge": (520, 0, True), "output": (10, 1, False)},
+    "building": {"read": (32, 3.9, False), "prepare": (9, 0, True), "merge": (22, 0, True), "output": (15, 0, False)},
+}
+EXTRACT_OBJECT_COST = 4.6  # Microseconds per python callback of extract passes.
+EXTRACT_NODE_COST = 2.0  # Microseconds per node reference collected by extract.
+REFERENCE_WAY_SECONDS = 1.0e-5  # Sampling seconds per way callback on the calibration machine.
+BYTES_PER_COORDINATE = 170  # Peak over stages, tables, data frames and copies included.
+BYTES_PER_FEATURE = 450
+EXTRACT_ID_BYTES = 70  # Python int in a set.
+MIN_MEMORY_BUDGET = 64 * 1024 * 1024  # Smallest feature table of streaming mode worth recommending.
+PROCESS_BYTES = 130 * 1024 * 1024  # Interpreter with geopandas and osmium, main process and each worker.
+INDEX_TYPES = {"sparse": 16, "dense": 8}  # Bytes per node id of sparse arrays, per id up to the max node id of dense arrays.
+
+
+class SampleHandler(osmium.SimpleHandler):
+    """
+    Count ways and relations of sampled blocks, in total and of those matching tags of each mode.
+    Node ids are taken from way ends only, node count is read from the location index.
+    """
+    def __init__(self, mode_tags: dict):
+        super().__init__()
+        self.mode_tags = mode_tags
+        self.counts = {"ways": 0, "way_nodes": 0, "relations": 0, "relation_ways": 0}
+        self.mode_counts = {mode: dict.fromkeys(self.counts, 0) for mode in mode_tags}
+        self.max_node_id = 0
+
+    def way(self, way):
+        nodes = len(way.nodes)
+        self.counts["ways"] += 1
+        self.counts["way_nodes"] += nodes
+        if nodes:
+            self.max_node_id = max(self.max_node_id, way.nodes[0].ref, way.nodes[-1].ref)
+        for mode, tags in self.mode_tags.items():
+            if is_tags_matched(way.tags, tags):
+                self.mode_counts[mode]["ways"] += 1
+                self.mode_counts[mode]["way_nodes"] += nodes
+
+    def relation(self, relation):
+        ways = sum(1 for member in relation.members if member.type == "w")
+        self.counts["relations"] += 1
+        self.counts["relation_ways"] += ways
+        for mode, tags in self.mode_tags.items():
+            if is_tags_matched(relation.tags, tags):
+                self.mode_counts[mode]["relations"] += 1
+                self.mode_counts[mode]["relation_ways"] += ways
+
+
+def get_sample(blocks, count) -> list:
+    """
+    Systematic sample of block positions with probability proportional to size, (position, times selected).
+    All blocks are taken once if there are no more than count.
+    """
+    if len(blocks) <= count:
+        return [(position, 1) for position in range(len(blocks))]
+    starts = numpy.array([start for start, _ in blocks])
+    spacing = (blocks[-1][1] - blocks[0][0]) / count
+    positions = blocks[0][0] + spacing * (numpy.arange(count) + 0.5)
+    positions, times = numpy.unique(numpy.searchsorted(starts, positions, side="right") - 1, return_counts=True)
+    return [(int(position), int(selected)) for position, selected in zip(positions, times)]
+
+
+def read_block(stream, header_data, block, mode_tags: dict, entities=osmium.osm.ALL) -> tuple:
+    """
+    Decode one block, (handler with counts of its ways and relations, node count, seconds).
+    """
+    start, end = block
+    stream.seek(start)
+    handler = SampleHandler(mode_tags)
+    index = osmium.index.create_map("sparse_mem_array")
+    locations = osmium.NodeLocationsForWays(index)
+    locations.ignore_errors()  # Nodes of ways are mostly in other blocks.
+    reader = osmium.io.Reader(osmium.io.FileBuffer(header_data + stream.read(end - start), "pbf"), entities)
+    start_time = time.perf_counter()
+    try:
+        osmium.apply(reader, locations, handler)
+    finally:
+        reader.close()
+    return handler, index.used_memory() // INDEX_TYPES["sparse"], time.perf_counter() - start_time
+
+
+def get_sections(blocks, read) -> list:
+    """
+    Position ranges of node, way and relation blocks. Files are sorted by type, so the first block of ways and of relations
+    are found by binary search on the last type in a block, read(position) decodes a block.
+    """
+    bounds = [0]
+    for rank in (1, 2):
+        low, high = bounds[-1], len(blocks)
+        while low < high:
+            middle = (low + high) // 2
+            handler = read(middle)[0]
+            if (2 if handler.counts["relations"] else 1 if handler.counts["ways"] else 0) >= rank:
+                high = middle
+            else:
+                low = middle + 1
+        bounds.append(low)
+    bounds.append(len(blocks))
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def sample_file(input_path, mode_tags: dict, sample_blocks=SAMPLE_BLOCKS) -> dict:
+    """
+    Project object counts of the whole file from a sample of its blocks. Each section of node, way and relation blocks is
+    sampled on its own, at least a quarter of sample_blocks each, relations are few blocks at the end of file.
+    Counts of a block are weighted by section size over block size, so the sum is unbiased for a sample proportional to size.
+    Way callback speed of this machine is the fastest of a few way blocks, to scale the calibrated costs.
+    """
+    start_time = time.time()
+    header, blocks = get_blocks(input_path)
+    sizes = numpy.array([end - start for start, end in blocks])
+    counts = {"nodes": 0.0, "ways": 0.0, "way_nodes": 0.0, "relations": 0.0, "relation_ways": 0.0}
+    mode_counts = {mode: {"ways": 0.0, "way_nodes": 0.0, "relations": 0.0, "relation_ways": 0.0} for mode in mode_tags}
+    max_node_id, results = 0, dict()
+    with open(input_path, "rb") as stream:
+        stream.seek(header[0])
+        header_data = stream.read(header[1] - header[0])
+
+        def read(position):
+            if position not in results:
+                results[position] = read_block(stream, header_data, blocks[position], mode_tags)
+            return results[position]
+
+        sections = get_sections(blocks, read) if blocks else []
+        for first, last in sections:
+            if first == last:
+                continue
+            section_bytes = sizes[first:last].sum()
+            count = max(round(sample_blocks * section_bytes / sizes.sum()), sample_blocks // 4)
+            sample = get_sample(blocks[first:last], count)
+            selections = sum(selected for _, selected in sample)
+            for position, selected in sample:
+                handler, nodes, _ = read(first + position)
+                weight = selected * section_bytes / sizes[first + position] / selections
+                counts["nodes"] += nodes * weight
+                for key, value in handler.counts.items():
+                    counts[key] += value * weight
+                for mode, values in handler.mode_counts.items():
+                    for key, value in values.items():
+                        mode_counts[mode][key] += value * weight
+                max_node_id = max(max_node_id, handler.max_node_id)
+        way_seconds = []
+        for position in [position for position, (handler, _, _) in results.items() if handler.counts["ways"]][:8]:
+            handler, _, seconds = read_block(stream, header_data, blocks[position], dict(), osmium.osm.WAY)
+            way_seconds.append(seconds / handler.counts["ways"])
+    return {"bytes": os.path.getsize(input_path), "blocks": len(blocks), "sampled_blocks": len(results), "seconds": time.time() - start_time,
+            "counts": counts, "mode_counts": mode_counts, "max_node_id": max(max_node_id, int(counts["nodes"])),
+            "way_seconds": min(way_seconds) if way_seconds else REFERENCE_WAY_SECONDS}
+
+
+def get_index_bytes(index_type, nodes, max_node_id) -> float:
+    if index_type.startswith("dense"):
+        return INDEX_TYPES["dense"] * max_node_id
+    if index_type == "flex_mem":  # Switches to dense when it gets smaller.
+        return min(INDEX_TYPES["sparse"] * nodes, INDEX_TYPES["dense"] * max_node_id)
+    return INDEX_TYPES["sparse"] * nodes
+
+
+def estimate_mode(sample: dict, mode, kind, extract_cache, extract_cached, available_memory, memory_fraction, workers) -> dict:
+    """
+    Project memory and runtime of mode, recommend node location index type, workers and memory budget.
+    """
+    counts, mode_counts = sample["counts"], sample["mode_counts"][mode]
+    nodes_per_way = counts["way_nodes"] / counts["ways"] if counts["ways"] else 0
+    features = mode_counts["ways"] + mode_counts["relations"]
+    coordinates = mode_counts["way_nodes"] + mode_counts["relation_ways"] * nodes_per_way
+    # Stages read the extract, which only keeps nodes of matched ways, or the whole file.
+    nodes = coordinates if extract_cache else counts["nodes"]
+    feature_bytes = BYTES_PER_FEATURE * features + BYTES_PER_COORDINATE * coordinates
+    extract_bytes = EXTRACT_ID_BYTES * (coordinates + mode_counts["relation_ways"]) if extract_cache and not extract_cached else 0
+    budget = available_memory * memory_fraction if available_memory else None
+
+    def get_peak(index_bytes, workers):
+        stage_peak = PROCESS_BYTES + index_bytes + feature_bytes * (2 if workers > 1 else 1) + (workers - 1) * PROCESS_BYTES
+        return max(stage_peak, PROCESS_BYTES + extract_bytes)
+
+    index_type = "flex_mem"
+    index_bytes = get_index_bytes(index_type, nodes, sample["max_node_id"])
+    # Streaming does not shrink the index, keep it in a file when it takes over half of the budget.
+    if budget and PROCESS_BYTES + index_bytes > budget / 2:
+        dense = get_index_bytes("dense_file_array", nodes, sample["max_node_id"]) < get_index_bytes("sparse_file_array", nodes, sample["max_node_id"])
+        index_type = "dense_file_array" if dense else "sparse_file_array"
+        index_bytes = 0  # Paged in from file as needed.
+    memory_budget = 0
+    if budget and get_peak(index_bytes, 1) > budget:
+        # Streaming keeps a few tables of memory_budget each in memory, copied once more to workers.
+        while workers > 1 and (budget - PROCESS_BYTES * workers - index_bytes) / 2 < 4 * MIN_MEMORY_BUDGET:
+            workers -= 1
+        room = (budget - PROCESS_BYTES * workers - index_bytes) / (2 if workers > 1 else 1)
+        memory_budget = int(max(room / 4, MIN_MEMORY_BUDGET) / 1024 / 1024)
+        feature_bytes = min(feature_bytes, memory_budget * 4 * 1024 * 1024)
+    if budget:
+        while workers > 1 and get_peak(index_bytes, workers) > budget:
+            workers -= 1
+    factor = sample["way_seconds"] / REFERENCE_WAY_SECONDS
+    stages = dict()
+    if extract_cache and not extract_cached:
+        objects = counts["nodes"] + 2 * counts["ways"] + 2 * counts["relations"]
+        stages["extract"] = (EXTRACT_OBJECT_COST * objects + EXTRACT_NODE_COST * coordinates) / 1e6 * factor
+    for stage, (feature_cost, coordinate_cost, parallel) in STAGE_COSTS[kind].items():
+        stages[stage] = (feature_cost * features + coordinate_cost * coordinates) / 1e6 * factor / (workers if parallel else 1)
+    return {"mode": mode, "features": features, "coordinates": coordinates, "nodes": nodes, "index_bytes": get_index_bytes(index_type, nodes, sample["max_node_id"]),
+            "feature_bytes": feature_bytes, "peak_bytes": get_peak(index_bytes, workers), "stages": stages, "seconds": sum(stages.values()),
+            "index_type": index_type, "workers": workers, "memory_budget": memory_budget}
+
+
+def get_kind(mode, rings_mode, lines_mode) -> str:
+    if mode in rings_mode:
+        return "rings"
+    if mode in lines_mode:
+        return "highway" if mode == "highway" else "lines"
+    return "building"
+
+
+def format_count(value) -> str:
+    for unit, size in (("G", 1e9), ("M", 1e6), ("k", 1e3)):
+        if value >= size:
+            return f"{value / size:.1f}{unit}"
+    return f"{value:.0f}"
+
+
+def format_bytes(value) -> str:
+    for unit, size in (("GB", 1024 ** 3), ("MB", 1024 ** 2)):
+        if value >= size:
+            return f"{value / size:.1f} {unit}"
+    return f"{value / 1024:.1f} KB"
+
+
+def main(input_path, modes, config: dict, workers=None, keep_relation_ids=None, sample_blocks=SAMPLE_BLOCKS) -> list:
+    """
+    Dry run of modes on input_path, print projected counts, memory and runtime of each mode and recommended settings.
+    With keep_relation_ids (limit relations of nations), extracts already cached are not counted in runtime.
+    """
+    from src.enum import Tag
+    rings_mode, lines_mode = config.get("mode").get("rings"), config.get("mode").get("lines")
+    mode_tags = {mode: Tag[mode].value for mode in modes}
+    executor = Executor.from_config(config, workers)
+    available_memory = Executor.get_available_memory()
+    sample = sample_file(input_path, mode_tags, sample_blocks)
+    counts = sample["counts"]
+    print(f"Input {input_path}: {format_bytes(sample['bytes'])}, {sample['blocks']} blocks, {sample['sampled_blocks']} sampled "
+          f"in {sample['seconds']:.1f} seconds.")
+    print(f"Projected {format_count(counts['nodes'])} nodes, {format_count(counts['ways'])} ways, {format_count(counts['relations'])} relations, "
+          f"max node id {sample['max_node_id']}.")
+    print(f"Memory available {format_bytes(available_memory) if available_memory else 'unknown'}, fraction {executor.memory_fraction}, "
+          f"workers {executor.workers}.")
+    results = []
+    for mode in modes:
+        extract_cached = bool(config.get("extract_cache") and keep_relation_ids is not None and
+                              os.path.exists(ExtractUtils.get_extract_path(input_path, mode, Tag[mode].value, {int(i) for i in keep_relation_ids})))
+        result = estimate_mode(sample, mode, get_kind(mode, rings_mode, lines_mode), config.get("extract_cache"), extract_cached,
+                               available_memory, executor.memory_fraction, executor.workers)
+        print(f"[{mode}] {format_count(result['features'])} features, {format_count(result['coordinates'])} coordinates, "
+              f"node index {format_bytes(result['index_bytes'])} ({format_count(result['nodes'])} nodes), features {format_bytes(result['feature_bytes'])}, "
+              f"peak {format_bytes(result['peak_bytes'])}.")
+        print(f"[{mode}] about {result['seconds']:.0f} seconds: {', '.join(f'{stage} {seconds:.0f}s' for stage, seconds in result['stages'].items())}.")
+        print(f"[{mode}] recommend location_index: {result['index_type']}, --workers {result['workers']}, --memory_budget {result['memory_budget']}.")
+        results.append(result)
+    return results
@@ -0,0 +1,190 @@
+import logging
+import multiprocessing
+import os
+import sys
+from collections import deque
+from multiprocessing import shared_memory
+
+import numpy
+
+from src.config import get_config
+
+executor = None
+
+
+def get_memory_estimate(data) -> int:
+    """
+    Rough bytes of a task argument in a worker, pickled copy and rebuilt objects included.
+    """
+    import geopandas
+    import shapely
+    if isinstance(data, geopandas.GeoDataFrame):
+        geometries = data.geometry.values
+        return 3 * int(shapely.get_num_coordinates(geometries).sum() * 16 + len(data) * 200 + data.drop(columns=data.geometry.name).memory_usage(deep=False).sum())
+    if isinstance(data, numpy.ndarray):
+        return 2 * data.nbytes
+    if isinstance(data, dict):
+        return sum(get_memory_estimate(value) for value in data.values())
+    if isinstance(data, (list, tuple)):
+        return sys.getsizeof(data) + len(data) * 64 if not data or not isinstance(data[0], (dict, list, tuple, numpy.ndarray, geopandas.GeoDataFrame)) \
+            else sum(get_memory_estimate(value) for value in data)
+    if hasattr(data, "nbytes"):
+        return 2 * int(data.nbytes)
+    return sys.getsizeof(data)
+
+
+class Executor:
+    """
+    Process pool shared by parallel stages of lines, rings and buildings, kept warm across stages.
+    Tasks in flight are limited by workers and by available memory over the largest per-task memory estimate.
+    With serial, tasks run in this process, for debugging.
+    """
+    def __init__(self, workers=None, serial=False, memory_fraction=0.7):
+        self.workers = workers or self.get_default_workers()
+        self.serial = serial
+        self.memory_fraction = memory_fraction
+        self.pool = None
+
+    @classmethod
+    def from_config(cls, config: dict, workers=None, serial=False):
+        executor_config = config.get("executor") or dict()
+        return cls(workers or executor_config.get("workers"), serial or executor_config.get("serial", False), executor_config.get("memory_fraction", 0.7))
+
+    @staticmethod
+    def get_default_workers() -> int:
+        cpu_count = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else multiprocessing.cpu_count()
+        return max(min(cpu_count - 1, 20), 1)
+
+    @staticmethod
+    def get_available_memory():
+        """
+        MemAvailable of /proc/meminfo in bytes, None if not on linux.
+        """
+        try:
+            with open("/proc/meminfo", "r") as stream:
+                for line in stream:
+                    if line.startswith("MemAvailable:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    def get_workers(self, tasks, task_memory=None) -> int:
+        workers = min(self.workers, tasks)
+        available_memory = self.get_available_memory()
+        if task_memory and available_memory:
+            memory_workers = int(available_memory * self.memory_fraction // task_memory)
+            if memory_workers < workers:
+                logging.info(f"Workers limited to {max(memory_workers, 1)} by memory, {task_memory / 1024 / 1024:.1f} MB per task, "
+                             f"{available_memory / 1024 / 1024:.1f} MB available.")
+            workers = min(workers, memory_workers)
+        return max(workers, 1)
+
+    def start(self):
+        """
+        Fork the pool workers now, before the artifact writer thread starts, a fork while it holds GDAL or file locks
+        would leave them locked in the workers.
+        """
+        if not self.serial and self.workers > 1:
+            self.get_pool()
+
+    def get_pool(self):
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.workers)
+        return self.pool
+
+    def starmap(self, function, arguments, task_memory=None) -> list:
+        """
+        Ordered results of function(*argument) of each argument, task_memory in bytes is estimated from arguments if not given.
+        """
+        arguments = list(arguments)
+        if not arguments:
+            return []
+        if self.serial:
+            return [function(*argument) for argument in arguments]
+        if task_memory is None:
+            task_memory = max(get_memory_estimate(argument) for argument in arguments)
+        workers = self.get_workers(len(arguments), task_memory)
+        if workers == 1:
+            return [function(*argument) for argument in arguments]
+        pool = self.get_pool()
+        results = [None] * len(arguments)
+        pending = deque()
+        for index, argument in enumerate(arguments):
+            if len(pending) >= workers:
+                pending_index, result = pending.popleft()
+                results[pending_index] = result.get()
+            pending.append((index, pool.apply_async(function, argument)))
+        while pending:
+            pending_index, result = pending.popleft()
+            results[pending_index] = result.get()
+        return results
+
+    def map(self, function, iterable, task_memory=None) -> list:
+        return self.starmap(function, [(item,) for item in iterable], task_memory)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        self.pool = None
+
+
+class SharedGeometries:
+    """
+    Geometries as one contiguous WKB buffer with offsets in shared memory. Pickled as its name only,
+    workers attach to it and read row ranges, so geometry crosses process boundaries without pickling.
+    The creating process unlinks it on close.
+    """
+    def __init__(self, geometries):
+        import shapely
+        wkbs = shapely.to_wkb(numpy.asarray(geometries, dtype=object)) if len(geometries) else []
+        offsets = numpy.zeros(len(wkbs) + 1, dtype=numpy.int64)
+        offsets[1:] = numpy.cumsum([len(wkb) for wkb in wkbs])
+        self.count = len(wkbs)
+        self.memory = shared_memory.SharedMemory(create=True, size=int(offsets.nbytes + offsets[-1]))
+        self.name = self.memory.name
+        self.owner = True
+        self.memory.buf[:offsets.nbytes] = offsets.tobytes()
+        self.memory.buf[offsets.nbytes:offsets.nbytes + offsets[-1]] = b"".join(wkbs)
+
+    def __len__(self):
+        return self.count
+
+    def __getstate__(self):
+        return {"name": self.name, "count": self.count}
+
+    def __setstate__(self, state):
+        self.name, self.count, self.owner = state["name"], state["count"], False
+        self.memory = shared_memory.SharedMemory(name=self.name)
+
+    def get_geometries(self, start, end) -> numpy.ndarray:
+        import shapely
+        offsets = numpy.frombuffer(self.memory.buf, dtype=numpy.int64, count=self.count + 1)
+        base = offsets.nbytes
+        wkbs = [bytes(self.memory.buf[base + offsets[index]:base + offsets[index + 1]]) for index in range(start, end)]
+        del offsets  # Release the view, shared memory cannot be closed while it is exported.
+        return shapely.from_wkb(wkbs) if wkbs else numpy.empty(0, dtype=object)
+
+    def close(self):
+        if self.memory is None:
+            return
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+        self.memory = None
+
+
+def set_executor(workers=None, serial=False) -> Executor:
+    """
+    Configure the shared executor from config, workers and serial from CLI override config.
+    """
+    global executor
+    if executor is not None:
+        executor.close()
+    executor = Executor.from_config(get_config(), workers, serial)
+    return executor
+
+
+def get_executor() -> Executor:
+    return executor if executor is not None else set_executor()
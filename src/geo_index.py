@@ -0,0 +1,207 @@
+import json
+import math
+import os
+
+import numpy
+
+MAGIC = b"NT2GIDX1"
+NODE_SIZE = 16
+BATCH_SIZE = 100000  # Points per traversal batch, bounds memory of candidate pairs.
+
+
+def meters_to_degrees(meters) -> float:
+    return meters / 6371000 / math.pi * 180
+
+
+def get_str_order(bounds: numpy.ndarray, node_size=NODE_SIZE) -> numpy.ndarray:
+    """
+    Sort-tile-recursive order of boxes, by x center into vertical slices, by y center in each slice.
+    """
+    count = len(bounds)
+    if not count:
+        return numpy.empty(0, dtype=numpy.int64)
+    centers = (bounds[:, :2] + bounds[:, 2:]) / 2
+    slice_size = node_size * math.ceil(math.sqrt(math.ceil(count / node_size)))
+    order = numpy.argsort(centers[:, 0], kind="stable")
+    slices = numpy.arange(count) // slice_size
+    return order[numpy.lexsort((centers[order, 1], slices))]
+
+
+def get_levels(bounds: numpy.ndarray, node_size=NODE_SIZE) -> list:
+    """
+    Boxes of each tree level from leaves up, a node covers node_size consecutive boxes of the level below.
+    """
+    levels = [bounds]
+    while len(levels[-1]) > 1:
+        boxes = levels[-1]
+        starts = numpy.arange(0, len(boxes), node_size)
+        levels.append(numpy.column_stack([numpy.minimum.reduceat(boxes[:, 0], starts), numpy.minimum.reduceat(boxes[:, 1], starts),
+                                          numpy.maximum.reduceat(boxes[:, 2], starts), numpy.maximum.reduceat(boxes[:, 3], starts)]))
+    return levels
+
+
+def write_index(path, polygon_ids, hofn_types, road_levels, geometries):
+    """
+    Write a packed spatial index file of geometries: STR packed R-tree levels, WKB payloads with offsets and
+    POLYGON_ID, HOFN_TYPE and ROAD_LEVEL columns, rows are stored in tree order. Sections are 8-byte aligned arrays
+    listed in a json header, so the file is memory-mapped as is by GeoIndex.
+    """
+    import shapely
+    geometries = numpy.asarray(geometries, dtype=object)
+    bounds = shapely.bounds(geometries).reshape(-1, 4)
+    order = get_str_order(bounds)
+    bounds = bounds[order]
+    wkbs = shapely.to_wkb(geometries[order]) if len(order) else []
+    offsets = numpy.zeros(len(wkbs) + 1, dtype=numpy.int64)
+    offsets[1:] = numpy.cumsum([len(wkb) for wkb in wkbs])
+    sections = {
+        "polygon_id": numpy.asarray(polygon_ids, dtype=numpy.int64)[order],
+        "hofn_type": numpy.asarray(hofn_types, dtype=numpy.int16)[order],
+        "road_level": numpy.asarray(road_levels, dtype=numpy.int16)[order],
+        "offsets": offsets,
+        "wkb": numpy.frombuffer(b"".join(wkbs), dtype=numpy.uint8),
+    }
+    levels = get_levels(bounds) if len(bounds) else []
+    for level, boxes in enumerate(levels):
+        sections[f"level_{level}"] = numpy.ascontiguousarray(boxes, dtype=numpy.float64)
+    layout, position = dict(), 0
+    for name, data in sections.items():
+        layout[name] = {"offset": position, "dtype": data.dtype.str, "shape": list(data.shape)}
+        position += (data.nbytes + 7) // 8 * 8
+    header = json.dumps({"count": len(order), "node_size": NODE_SIZE, "levels": len(levels), "sections": layout}).encode("utf-8")
+    header += b" " * (-(len(MAGIC) + 8 + len(header)) % 8)
+    with open(f"{path}.tmp", "wb") as stream:
+        stream.write(MAGIC)
+        stream.write(len(header).to_bytes(8, "little"))
+        stream.write(header)
+        for data in sections.values():
+            stream.write(data.tobytes())
+            stream.write(b"\0" * (-data.nbytes % 8))
+    os.replace(f"{path}.tmp", path)
+
+
+class GeoIndex:
+    """
+    Read-only packed spatial index written by write_index, memory-mapped on first use, geometries are decoded
+    from WKB only for candidate rows and kept. Queries take arrays of x (lon) and y (lat) and run in batches.
+    Distances are in meters, converted to degrees on a sphere of radius 6371 km.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.buffer = None
+        self.sections = dict()
+        self.geometries = None
+
+    def load(self):
+        if self.buffer is not None:
+            return
+        buffer = numpy.memmap(self.path, dtype=numpy.uint8, mode="r")
+        if bytes(buffer[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"{self.path} is not a geo index file.")
+        length = int.from_bytes(bytes(buffer[len(MAGIC):len(MAGIC) + 8]), "little")
+        base = len(MAGIC) + 8 + length
+        header = json.loads(bytes(buffer[len(MAGIC) + 8:base]).decode("utf-8"))
+        for name, section in header["sections"].items():
+            dtype = numpy.dtype(section["dtype"])
+            count = int(numpy.prod(section["shape"]))
+            self.sections[name] = numpy.frombuffer(buffer, dtype=dtype, count=count, offset=base + section["offset"]).reshape(section["shape"])
+        self.count, self.node_size, self.levels = header["count"], header["node_size"], header["levels"]
+        self.geometries = numpy.empty(self.count, dtype=object)
+        self.buffer = buffer
+
+    def __len__(self):
+        self.load()
+        return self.count
+
+    @property
+    def polygon_ids(self) -> numpy.ndarray:
+        self.load()
+        return self.sections["polygon_id"]
+
+    @property
+    def hofn_types(self) -> numpy.ndarray:
+        self.load()
+        return self.sections["hofn_type"]
+
+    @property
+    def road_levels(self) -> numpy.ndarray:
+        self.load()
+        return self.sections["road_level"]
+
+    def get_geometries(self, rows) -> numpy.ndarray:
+        import shapely
+        self.load()
+        rows = numpy.asarray(rows, dtype=numpy.int64)
+        missing = numpy.unique(rows[shapely.is_missing(self.geometries[rows])])
+        if len(missing):
+            wkb, offsets = self.sections["wkb"], self.sections["offsets"]
+            self.geometries[missing] = shapely.from_wkb([wkb[offsets[row]:offsets[row + 1]].tobytes() for row in missing])
+        return self.geometries[rows]
+
+    def query_boxes(self, x, y, distance=0.0) -> tuple:
+        """
+        Pairs of (point, row) whose box is within distance (degrees) of the point, by descending the tree level by level.
+        """
+        self.load()
+        if not self.count:
+            return numpy.empty(0, dtype=numpy.int64), numpy.empty(0, dtype=numpy.int64)
+        points = numpy.arange(len(x))
+        nodes = numpy.zeros(len(x), dtype=numpy.int64)
+        for level in range(self.levels - 1, -1, -1):
+            boxes = self.sections[f"level_{level}"]
+            box = boxes[nodes]
+            inside = (box[:, 0] - distance <= x[points]) & (x[points] <= box[:, 2] + distance) & \
+                     (box[:, 1] - distance <= y[points]) & (y[points] <= box[:, 3] + distance)
+            points, nodes = points[inside], nodes[inside]
+            if level:
+                children = numpy.minimum(len(self.sections[f"level_{level - 1}"]) - nodes * self.node_size, self.node_size)
+                points = numpy.repeat(points, children)
+                nodes = numpy.repeat(nodes * self.node_size - numpy.cumsum(children) + children, children) + numpy.arange(children.sum())
+        return points, nodes
+
+    def query(self, x, y, distance=None, hofn_types=None) -> tuple:
+        """
+        Pairs of (point index, row) of polygons containing each point, or geometries within distance meters of it.
+        hofn_types limits rows to those types. Look up columns of rows with polygon_ids, hofn_types and road_levels.
+        """
+        import shapely
+        x, y = numpy.asarray(x, dtype=numpy.float64), numpy.asarray(y, dtype=numpy.float64)
+        degrees = meters_to_degrees(distance) if distance else 0.0
+        point_list, row_list = [], []
+        for start in range(0, len(x), BATCH_SIZE):
+            points, rows = self.query_boxes(x[start:start + BATCH_SIZE], y[start:start + BATCH_SIZE], degrees)
+            points += start
+            if hofn_types is not None:
+                keep = numpy.isin(self.hofn_types[rows], [int(i) for i in hofn_types])
+                points, rows = points[keep], rows[keep]
+            geometries = self.get_geometries(rows)
+            if distance:
+                hit = shapely.dwithin(geometries, shapely.points(x[points], y[points]), degrees)
+            else:
+                hit = shapely.contains_xy(geometries, x[points], y[points])
+            point_list.append(points[hit])
+            row_list.append(rows[hit])
+        if not point_list:
+            return numpy.empty(0, dtype=numpy.int64), numpy.empty(0, dtype=numpy.int64)
+        return numpy.concatenate(point_list), numpy.concatenate(row_list)
+
+    def nearest(self, x, y, max_distance, hofn_types=None) -> tuple:
+        """
+        Nearest row to each point within max_distance meters and its distance in meters, row -1 and distance nan if none.
+        """
+        import shapely
+        x, y = numpy.asarray(x, dtype=numpy.float64), numpy.asarray(y, dtype=numpy.float64)
+        points, rows = self.query(x, y, max_distance, hofn_types)
+        distances = shapely.distance(self.get_geometries(rows), shapely.points(x[points], y[points])) if len(rows) else numpy.empty(0)
+        nearest_rows = numpy.full(len(x), -1, dtype=numpy.int64)
+        nearest_distances = numpy.full(len(x), numpy.nan)
+        order = numpy.lexsort((distances, points))
+        first = order[numpy.r_[True, points[order][1:] != points[order][:-1]]] if len(order) else order
+        nearest_rows[points[first]] = rows[first]
+        nearest_distances[points[first]] = distances[first] / meters_to_degrees(1)
+        return nearest_rows, nearest_distances
+
+    def close(self):
+        self.sections = dict()
+        self.geometries = None
+        self.buffer = None
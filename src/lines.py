@@ -2,182 +2,380 @@
 import logging.config
 import logging
 import math
-import multiprocessing
-import sys
 import traceback
 import os
+from array import array
+from itertools import repeat
 import geopandas
 import osmium
 import pandas
-from shapely import wkt
-from src.utils import LimitAreaUtils, LineUtils
+from src.utils import LimitAreaUtils, LineUtils, MPUtils, BoxFilter, ExtractRelationHandler, SimplifyUtils, HilbertUtils, TagUtils, is_tags_matched
 from src.enum import Tag, HofnType
-from src.models import HofnData, RelationMember
-wkt_factory = osmium.geom.WKTFactory()
-cpu_count = multiprocessing.cpu_count() - 1 if multiprocessing.cpu_count() < 20 else 20
+from src.models import FeatureTable, RelationMember
+from src.pipeline import Pipeline
+from src.executor import get_executor
+from src.reader import apply_parallel, apply_file
+from src.writer import get_writer
 
 
 
 class LineHandler(osmium.SimpleHandler):
-    def __init__(self, tags, mode, level=None):
+    def __init__(self, tags, mode, level=None, memory_budget=None, spill_path=None, box_filter=None, member_ids=None, keep_tags=False):
         super().__init__()
-        self.lines = []
+        # With keep_tags, tags are matched as is_tags_matched and their values are kept, tag:<key> columns of lines, relation_tags of relations.
+        self.keep_tags = keep_tags
+        tag_columns = TagUtils.get_columns(tags) if keep_tags else []
+        self.lines = FeatureTable(columns=("POLYGON_NAME", "ROAD_LEVEL", *tag_columns), constants={"HOFN_TYPE": HofnType[mode].value},
+                                  memory_budget=memory_budget, spill_path=spill_path, fixed=True)
         self.relations = dict()
+        self.relation_tags = dict()
         self.tags = tags
         self.mode = mode
         self.level = level
+        self.box_filter = box_filter  # Reject ways outside limit area boxes before creating geometry.
+        self.member_ids = member_ids if member_ids is not None else set()  # Relation members are kept outside the boxes.
 
      # Tags: 1. Value 2. list 3. "" (purely take all the tags)
+    def is_matched(self, tags) -> bool:
+        if self.keep_tags:
+            return is_tags_matched(tags, self.tags)
+        return any([tags.get(key) in value if type(value) == list else tags.get(key) == value if value != "" else tags.get("key") for key, value in self.tags.items()])
+
     def relation(self, relation):
-        if any([relation.tags.get(key) in value if type(value) == list else relation.tags.get(key) == value if value != "" else relation.tags.get("key") for key, value in self.tags.items()]):
+        if self.is_matched(relation.tags):
+            if self.keep_tags:
+                self.relation_tags[relation.id] = {key: relation.tags.get(key) for key in self.tags.keys()}
             for member in relation.members:
                 if member.type == "w":
                     if not self.relations.get(relation.id, False):
                         self.relations[relation.id] = []
                     self.relations[relation.id].append(RelationMember(member.ref, member.type, member.role if member.role != "" else "outer"))
         
-    # Tags: 1. Value 2. list 3. "" (purely take all the tags)
     def way(self, w):
         line_id = w.id
         line_name = w.tags.get("name") if w.tags.get("name") else "UNKNOWN"
-        if any([w.tags.get(key) in value if type(value) == list else w.tags.get(key) == value if value != "" else w.tags.get("key") for key, value in self.tags.items()]):
-            line = wkt.loads(wkt_factory.create_linestring(w))
+        if self.is_matched(w.tags):
             level = self.level.get(w.tags.get(self.mode), False) if self.level else 0  # For LEVEL_DICT-need way
             if level is not False:
+                if self.box_filter is not None and line_id not in self.member_ids and not self.box_filter.is_way_inside(w):
+                    return
                 try:
-                    self.lines.append(HofnData(line_id, line_name, HofnType[self.mode].value, level, line))
+                    tag_values = TagUtils.get_values(w.tags, self.tags) if self.keep_tags else dict()
+                    self.lines.append(line_id, self.get_fixed_coords(w), POLYGON_NAME=line_name, ROAD_LEVEL=level, **tag_values)
                 except Exception as e:
                     traceback.print_exc()
 
+    @staticmethod
+    def get_fixed_coords(w) -> bytes:
+        """
+        int32 fixed-point coords from node locations, repeated nodes are removed as WKBFactory does.
+        """
+        coords = array("i")
+        for node in w.nodes:
+            location = node.location
+            if not location.valid():
+                raise osmium.InvalidLocationError(f"Invalid location of node {node.ref} in way {w.id}")
+            if len(coords) and coords[-2] == location.x and coords[-1] == location.y:
+                continue
+            coords.extend((location.x, location.y))
+        if len(coords) < 4:
+            raise ValueError(f"Way {w.id} has less than 2 locations")
+        return coords.tobytes()
 
 
-def main(input_path, output_path, nation, limit_relation_id, mode, tags, DEBUGGING=False, DIVIDE=None, LEVEL_DICT=None, ALL_OFFLINE=True):
-    IS_LEVEL = True if LEVEL_DICT else False
+
+HEADER = ["POLYGON_ID", "POLYGON_NAME", "HOFN_TYPE", "ROAD_LEVEL", "geometry"]
+
+
+def read(input_path, mode, tags, LEVEL_DICT=None, limit_area=None, spill_path=None) -> tuple:
+    """
+    Read lines and relation members matching tags from osm.pbf file, node locations of parallel reading are kept under spill_path.
+    """
+    lines, relations = read_table(input_path, mode, tags, LEVEL_DICT, spill_path=spill_path, limit_area=limit_area)
+    return lines.to_geodataframe()[HEADER], relations
+
+
+def read_table(input_path, mode, tags, LEVEL_DICT=None, memory_budget=None, spill_path=None, limit_area=None, keep_tags=False) -> tuple:
+    """
+    With limit_area, ways outside its boxes are skipped, highway relation members are collected in one more pass
+    on relations and always kept, since relations are merged before limiting.
+    With keep_tags, values of tags are kept for filtering in memory, see LineHandler, relation tags are returned third.
+    """
+    logging.info(f"Reading file from {input_path}")
+    box_filter = BoxFilter.from_limit_area(limit_area) if limit_area is not None else None
+    member_ids = None
+    if box_filter is not None and mode == "highway":
+        relation_handler = ExtractRelationHandler(tags, set(), way_ids=set())  # Sent to workers of apply_parallel.
+        relation_handler.apply_file(input_path)
+        member_ids = relation_handler.way_ids
+    if memory_budget:
+        line_handler = LineHandler(tags, mode, LEVEL_DICT, memory_budget, spill_path, box_filter, member_ids, keep_tags)
+        apply_file(line_handler, input_path, spill_path)
+        return (line_handler.lines, line_handler.relations) + ((line_handler.relation_tags,) if keep_tags else ())
+    # Blocks are decoded in parallel into tables concatenated in file order.
+    fields = ("lines", "relations") + (("relation_tags",) if keep_tags else ())
+    result = apply_parallel(input_path, LineHandler, {"tags": tags, "mode": mode, "level": LEVEL_DICT, "box_filter": box_filter, "member_ids": member_ids,
+                                                      "keep_tags": keep_tags}, fields, spill_path)
+    return tuple(result[field] for field in fields)
+
+
+def prepare(lines_df, relation_member_dict, limit_area, mode, hilbert_order=False, limit_relations=False) -> tuple:
+    """
+    Limit lines with limit area, and get relation members as GeoDataFrame in highway mode.
+    Relations of a nation keep all members, with limit_relations (subset runs) members are limited with limit area too.
+    With hilbert_order, lines are sorted by Hilbert index of their bbox centers, so chunks of workers are spatially compact.
+    """
+    data_from_way = LimitAreaUtils.prepare_data(lines_df, limit_area.wkt)
+    relations = prepare_relations(lines_df, relation_member_dict, mode, data_from_way["POLYGON_ID"].values if limit_relations else None)
+    return HilbertUtils.sort(data_from_way) if hilbert_order else data_from_way, relations
+
+
+def prepare_relations(lines_df, relation_member_dict, mode, inside_ids=None) -> dict:
+    """
+    With inside_ids, only these lines are kept as relation members.
+    """
+    relations = dict()
+    if mode == "highway" and relation_member_dict:  # No relations in small subsets.
+        logging.info("Getting data from relations.")
+        lines_by_id = lines_df.set_index("POLYGON_ID", drop=False)
+        inside_ids = set(inside_ids) if inside_ids is not None else None
+        # ONLY search for those match the tags
+        for relation_id, relation_members in relation_member_dict.items():
+            member_ids = [member.id for member in relation_members if member.id in lines_by_id.index and (inside_ids is None or member.id in inside_ids)]
+            if member_ids: # If there is no data in the relation, it will be ignored.
+                relations[relation_id] = lines_by_id.loc[member_ids].reset_index(drop=True) # GeoDataFrame for intersects use.
+    return relations
+
+
+def merge(data_from_way, relations, mode, levels, snap_distance=None, debug_path=None) -> geopandas.GeoDataFrame:
+    """
+    With snap_distance (meters), open chains of ring mode are joined at nearby endpoints before filtering small islands.
+    With debug_path, merged highway relations are also written to relations_result.geojson under it.
+    Lines are merged in read order, index labels kept by prepare, so sorting lines (hilbert_order) does not change merged lines or their ids.
+    """
+    data_from_way = data_from_way.sort_index()
     IS_RING = True if mode in ["coastline"] else False
     IS_FERRY = True if mode in ["ferry"] else False
-    levels = Tag.get_levels(mode, LEVEL_DICT) if IS_LEVEL else [0]
-    ###############################################################################################
-    # 1. GET DATA
-    if not DIVIDE:
-        logging.info("[1/2] Prepare line data from osm.pbf file.")
-        logging.info(f"Reading file from {input_path}")
-        # 1.1. Read osm.pbf file
-        line_handler = LineHandler(tags, mode, LEVEL_DICT)
-        line_handler.apply_file(input_path, idx="flex_mem", locations=True)
-        lines = line_handler.lines
-        relation_member_dict = line_handler.relations
-        del line_handler
-        ################################################################################################
-        
-        lines_df = geopandas.GeoDataFrame([vars(i) for i in lines])
-        lines_dict = lines_df.set_index("POLYGON_ID", drop=False).to_dict("index")
-        
-        logging.info("Getting data from relations.")
-        # 1.2. Get limit area
-        logging.info("Loading limit area geometry.")
-        if ALL_OFFLINE:
-            logging.info("Detect all offline mode on, using offline file to load limit area")
-            limit_area = LimitAreaUtils.get_limit_relation_geom(input_path, limit_relation_id)
-        else:
-            logging.info("Detect all offline mode off, using api to load limit area")
-            limit_area = LimitAreaUtils.get_relation_polygon_with_overpy(limit_relation_id)
-        
-        
-        ###############################################################################################
-        # 2. MERGE ALL LINE
-        logging.info("[2/2] Merge all the line.")
-        
-        # Highway mode
-        if mode == "highway":
-            logging.info("Merging way in same relation.")
-            # 2.1.2 Get relation data
-            relations = dict()
-            # ONLY search for those match the tags
-            for relation_id, relation_members in relation_member_dict.items():
-                hofn_datas = list(map(LineUtils.get_relation_data, relation_members, [lines_dict] * len(relation_members)))
-                hofn_datas = [i for i in hofn_datas if i is not None]
-                if hofn_datas: # If there is no data in the relation, it will be ignored.
-                    relations[relation_id] = hofn_datas
-            
-            relations =  {relation_id:geopandas.GeoDataFrame([vars(i) for i in relation_members]) for relation_id, relation_members in relations.items()} # Convert to GeoDataFrame for intersects use.
-            id_used_list = list()
-            relations_result = [LineUtils.get_merged_members(relation_members,levels,id_used_list) for relation_id,relation_members in relations.items()]
-            relations_result = sum(relations_result, []) # flatten the list from level 1 to 5
-            geopandas.GeoDataFrame(relations_result).to_file("relations_result.geojson", driver="GeoJSON")
-
-            # 2.2. concat relation result to lines from ways, and do one more time intersects merge.    
-            logging.info("Merging remaining lines from ways.")
-            data_from_way = LimitAreaUtils.prepare_data(lines_df, limit_area.wkt)
-            data_from_way = data_from_way[~data_from_way["POLYGON_ID"].isin(id_used_list)]
-            data = pandas.concat([data_from_way, geopandas.GeoDataFrame(relations_result)], ignore_index=True)
-            unmerged_way_split_by_level = [data[data["ROAD_LEVEL"] == level] for level in levels]
-            result = [LineUtils.merge_by_intersects(i) for i in unmerged_way_split_by_level if not i.empty]
-            result = sum(result, []) # flatten list from level1 to level5
-            
-        # other mode
-        else:
-            data_from_way = LimitAreaUtils.prepare_data(lines_df, limit_area.wkt)
-            data = data_from_way
-            unmerged_way_split_by_level = [data[data["ROAD_LEVEL"] == level] for level in levels]
-            result = [LineUtils.merge_by_intersects(i) for i in unmerged_way_split_by_level if not i.empty]
-            result = sum(result, []) # flatten list from level1 to level5
-        
-        logging.info("Merge completed.")
-        #############################################################################
-        # After merging, we need some operations with difference mode
-        # ONLY those linestring being ringed need to filter with area threshold
-        if IS_RING:
-            result = LineUtils.filter_small_island(result, area_threshold=40000)
-        merged = geopandas.GeoDataFrame(result)
-        if IS_FERRY:
-            merged["geometry"] = merged.geometry.apply(lambda geometry: geometry.buffer(15 / 6371000 / math.pi * 180))
-        merged.to_file(f"{output_path}/merged.geojson", driver="GeoJSON", index=False, encoding="utf-8")
+    # Highway mode
+    if mode == "highway":
+        logging.info("Merging way in same relation.")
+        # Relations sharing ways stay in one group, groups are merged in workers and used ids reconciled after.
+        relation_groups = LineUtils.get_relation_groups(relations)
+        relation_group_chunks = [[[MPUtils.to_coords_buffer(relations[relation_id]) for relation_id in relation_group] for relation_group in chunk]
+                                 for chunk in MPUtils.chunks_set(relation_groups, get_executor().workers) if chunk]
+        merged_relation_chunks = get_executor().starmap(LineUtils.merge_relation_groups, zip(relation_group_chunks, repeat(levels)))
+        id_used_list = sum([chunk_id_used_list for _, chunk_id_used_list in merged_relation_chunks], [])
+        relations_result = pandas.concat([MPUtils.from_coords_buffer(buffer) for buffer, _ in merged_relation_chunks], ignore_index=True) if merged_relation_chunks else geopandas.GeoDataFrame()
+        if debug_path and not relations_result.empty:
+            get_writer().to_file(relations_result, f"{debug_path}/relations_result.geojson", driver="GeoJSON")
 
+        # concat relation result to lines from ways, and do one more time intersects merge.
+        logging.info("Merging remaining lines from ways.")
+        data_from_way = data_from_way[~data_from_way["POLYGON_ID"].isin(id_used_list)]
+        data = pandas.concat([data_from_way, relations_result], ignore_index=True)
+        # Levels are independent, merge each level in workers.
+        result = LineUtils.merge_levels(data, levels, get_executor())
 
-    ###########################################################################################
-    # [OPTIONAL] 3. re-merge and DIVIDE
-    if DIVIDE:
-        threshold = 100.0
-        logging.info(f"[OPTIONAL]Extracting geometry, re-merge and DIVIDE with threshold {threshold} km.")
-        logging.info(f"Divide and re-merge POLYGON_ID: {DIVIDE}")
-        if os.path.exists(f"{output_path}/merged.geojson"):
-            merged = geopandas.read_file(f"{output_path}/merged.geojson")
-        else:
-            merged = geopandas.read_file(f"{output_path}/{mode}.tsv", sep="\t")
-        # Find all the line which length is larger than [user-set] km, DIVIDE it later.
-        lengthy_geometry_ids = DIVIDE
-        merged_result = []
-        # Divide all the lengthy (LENGTH >600km) geometry
-        logging.debug("Start re-merge and DIVIDE.")
-
-        unmerged = geopandas.read_file(f"{output_path}/unmerged.geojson")
-
-        for lengthy_id in lengthy_geometry_ids:
-            logging.debug(f"{lengthy_id} is being re-merged and divided.")
-            lengthy_geom = list(merged.loc[merged["POLYGON_ID"] == int(lengthy_id)]["geometry"])[0]
-            lengthy = LimitAreaUtils.prepare_data(unmerged, lengthy_geom.wkt)
-            logging.debug("Prepare completed. Start merge.")
-            lengthy_dict = lengthy.set_index(lengthy["POLYGON_ID"]).to_dict('index')
-            lengthy_merged_result = LineUtils.get_merged_and_divided(lengthy_dict, lengthy_geom, 100.0)
-            merged_result += lengthy_merged_result
-
-        merged = merged[~merged["POLYGON_ID"].isin(DIVIDE)]
-        merged = pandas.concat([geopandas.GeoDataFrame(merged_result), merged])
-
-
-
-        logging.info("Divide and re-merge completed.")
+    # other mode
+    else:
+        data = data_from_way
+        result = LineUtils.merge_levels(data, levels)
 
-    #####################################################################################
-    # OUTPUT
+    logging.info("Merge completed.")
+    #############################################################################
+    # After merging, we need some operations with difference mode
+    # ONLY those linestring being ringed need to filter with area threshold
+    if IS_RING:
+        result = LineUtils.close_gaps(result, snap_distance)
+        result = LineUtils.filter_small_island(result, area_threshold=40000)
+    merged = geopandas.GeoDataFrame(result) if len(result) else geopandas.GeoDataFrame(columns=HEADER, geometry="geometry")  # No lines in limit area.
+    if IS_FERRY:
+        merged["geometry"] = merged.geometry.apply(lambda geometry: geometry.buffer(15 / 6371000 / math.pi * 180))
+    return merged
+
+
+def divide(merged, unmerged, DIVIDE, threshold=100.0) -> geopandas.GeoDataFrame:
+    """
+    Re-merge lines of DIVIDE POLYGON_IDs from unmerged lines, divide them when longer than threshold km.
+    """
+    logging.info(f"[OPTIONAL]Extracting geometry, re-merge and DIVIDE with threshold {threshold} km.")
+    logging.info(f"Divide and re-merge POLYGON_ID: {DIVIDE}")
+    # Find all the line which length is larger than [user-set] km, DIVIDE it later.
+    lengthy_geometry_ids = DIVIDE
+    merged_result = []
+    # Divide all the lengthy (LENGTH >600km) geometry
+    logging.debug("Start re-merge and DIVIDE.")
+    for lengthy_id in lengthy_geometry_ids:
+        logging.debug(f"{lengthy_id} is being re-merged and divided.")
+        lengthy_geom = list(merged.loc[merged["POLYGON_ID"] == int(lengthy_id)]["geometry"])[0]
+        lengthy = LimitAreaUtils.prepare_data(unmerged, lengthy_geom.wkt)
+        logging.debug("Prepare completed. Start merge.")
+        lengthy_dict = lengthy.set_index(lengthy["POLYGON_ID"]).to_dict('index')
+        lengthy_merged_result = LineUtils.get_merged_and_divided(lengthy_dict, lengthy_geom, threshold)
+        merged_result += lengthy_merged_result
+
+    merged = merged[~merged["POLYGON_ID"].isin([int(i) for i in DIVIDE])]
+    merged = pandas.concat([geopandas.GeoDataFrame(merged_result), merged])
+    logging.info("Divide and re-merge completed.")
+    return merged
+
+
+def simplify(merged, mode, SIMPLIFY=None) -> geopandas.GeoDataFrame:
+    """
+    Simplify lines with tolerance of mode in SIMPLIFY, meters.
+    """
+    return SimplifyUtils.simplify(merged, SimplifyUtils.get_tolerance(SIMPLIFY, mode), mode)
+
+
+def output(merged, output_path, mode, DEBUGGING=False, append=False, hilbert_order=False):
+    """
+    With append, merged lines are appended to the output files written before, used in streaming mode.
+    With hilbert_order, lines are written in Hilbert order of their bbox centers.
+    Files are written in background by the artifact writer, flush it before reading them.
+    """
+    write_mode = "a" if append else "w"
+    merged = HilbertUtils.sort(merged) if hilbert_order else merged
+    writer = get_writer()
     if DEBUGGING:
-        merged.to_file(f"{output_path}/{mode}.geojson", driver="GeoJSON", encoding="utf-8", index=False)
+        writer.to_file(merged, f"{output_path}/{mode}.geojson", driver="GeoJSON", encoding="utf-8", index=False, mode=write_mode)
     else:
-        merged.to_csv(f"{output_path}/{mode}.tsv", sep="\t", index=False)
-        merged.to_file(f"{output_path}/{mode}.geojson", driver="GeoJSON", encoding="utf-8", index=False)
+        writer.to_csv(merged, f"{output_path}/{mode}.tsv", sep="\t", index=False, mode=write_mode, header=not append)
+        writer.to_file(merged, f"{output_path}/{mode}.geojson", driver="GeoJSON", encoding="utf-8", index=False, mode=write_mode)
 
     logging.info("==================================")
     logging.info(f"Output file to: {output_path}/{mode}.geojson") if not DEBUGGING else logging.debug(f"Output file to: {output_path}/{mode}.tsv")
-    sys.exit(0)
 
-# %%
+
+def stream(input_path, output_path, limit_area, mode, tags, levels, DEBUGGING=False, LEVEL_DICT=None, MEMORY_BUDGET=None, SPILL_PATH=None, SNAP_DISTANCE=None,
+           SIMPLIFY=None, HILBERT_ORDER=False, LIMIT_RELATIONS=False):
+    """
+    Limit lines chunk by chunk into level tables spilled to disk, only one level is loaded for merging at a time.
+    With LIMIT_RELATIONS (subset runs), relation members are limited with limit area too.
+    """
+    lines, relation_member_dict = read_table(input_path, mode, tags, LEVEL_DICT, MEMORY_BUDGET, SPILL_PATH, limit_area)
+    logging.info(f"Lines spilled into {len(lines.chunks)} chunks.")
+    member_ids = {member.id for relation_members in relation_member_dict.values() for member in relation_members} if mode == "highway" else set()
+    level_tables = {level: FeatureTable(columns=("POLYGON_NAME", "ROAD_LEVEL"), constants=lines.constants, memory_budget=MEMORY_BUDGET, spill_path=SPILL_PATH, fixed=True)
+                    for level in levels}
+    members = []
+    for lines_df in lines.iter_geodataframes():
+        lines_df = lines_df[HEADER]
+        if not LIMIT_RELATIONS:
+            members.append(lines_df[lines_df["POLYGON_ID"].isin(member_ids)])
+        lines_df = LimitAreaUtils.prepare_data(lines_df, limit_area.wkt).sort_index()  # Read order, as merge sorts lines in memory.
+        if LIMIT_RELATIONS:
+            members.append(lines_df[lines_df["POLYGON_ID"].isin(member_ids)])
+        for level, level_table in level_tables.items():
+            level_table.extend(lines_df[lines_df["ROAD_LEVEL"] == level])
+    lines.close()
+    relations = prepare_relations(pandas.concat(members, ignore_index=True), relation_member_dict, mode) if members else dict()
+
+    logging.info("[2/2] Merge all the line level by level.")
+    appended = False
+    for level, level_table in level_tables.items():
+        data_from_way = level_table.to_geodataframe()[HEADER]
+        level_table.close()
+        merged = merge(data_from_way, relations, mode, [level], SNAP_DISTANCE, output_path if DEBUGGING else None)
+        if merged.empty:
+            continue
+        if DEBUGGING:
+            get_writer().to_file(merged, f"{output_path}/merged.geojson", driver="GeoJSON", index=False, encoding="utf-8", mode="a" if appended else "w")
+        output(simplify(merged, mode, SIMPLIFY), output_path, mode, DEBUGGING, appended, HILBERT_ORDER)
+        appended = True
+
+
+def main(input_path, output_path, nation, limit_relation_id, mode, tags, DEBUGGING=False, DIVIDE=None, LEVEL_DICT=None, ALL_OFFLINE=True, MEMORY_BUDGET=None, SPILL_PATH=None,
+         CHECKPOINT_PATH=None, FORCE_STAGES=None, SKIP_STAGES=None, SNAP_DISTANCE=None, SIMPLIFY=None, HILBERT_ORDER=False, WITHIN=None):
+    IS_LEVEL = True if LEVEL_DICT else False
+    levels = Tag.get_levels(mode, LEVEL_DICT) if IS_LEVEL else [0]
+    if MEMORY_BUDGET and not DIVIDE:
+        logging.info("[1/2] Prepare line data from osm.pbf file in streaming mode.")
+        limit_area = LimitAreaUtils.get_limit_area(input_path, limit_relation_id, ALL_OFFLINE, WITHIN)
+        stream(input_path, output_path, limit_area, mode, tags, levels, DEBUGGING, LEVEL_DICT, MEMORY_BUDGET, SPILL_PATH, SNAP_DISTANCE, SIMPLIFY, HILBERT_ORDER,
+               WITHIN is not None)
+        return
+    # Stages are checkpointed under CHECKPOINT_PATH, a rerun with another DIVIDE resumes from divide.
+    pipeline = Pipeline(input_path, CHECKPOINT_PATH, FORCE_STAGES, SKIP_STAGES, name=f"{mode}.{limit_relation_id}")
+    ###############################################################################################
+    # 1. GET DATA
+    logging.info("[1/2] Prepare line data from osm.pbf file.")
+    # 1.1. Get limit area, its boxes filter ways when reading.
+    pipeline.add("limit_area", lambda: LimitAreaUtils.get_limit_area(input_path, limit_relation_id, ALL_OFFLINE, WITHIN),
+                 params={"limit_relation_id": limit_relation_id, "ALL_OFFLINE": ALL_OFFLINE, "WITHIN": WITHIN})
+    # 1.2. Read osm.pbf file
+    pipeline.add("read", lambda limit_area: read(input_path, mode, tags, LEVEL_DICT, limit_area, SPILL_PATH), inputs=["limit_area"],
+                 params={"mode": mode, "tags": tags, "LEVEL_DICT": LEVEL_DICT})
+    pipeline.add("prepare", lambda read_result, limit_area: prepare(*read_result, limit_area, mode, HILBERT_ORDER, WITHIN is not None), inputs=["read", "limit_area"],
+                 params={"mode": mode, "HILBERT_ORDER": HILBERT_ORDER})
+    ###############################################################################################
+    # 2. MERGE ALL LINE
+    def merge_stage(prepared):
+        logging.info("[2/2] Merge all the line.")
+        merged = merge(*prepared, mode, levels, SNAP_DISTANCE, output_path if DEBUGGING else None)
+        if DEBUGGING:
+            get_writer().to_file(merged, f"{output_path}/merged.geojson", driver="GeoJSON", index=False, encoding="utf-8")
+        return merged
+    pipeline.add("merge", merge_stage, inputs=["prepare"], params={"mode": mode, "levels": levels, "SNAP_DISTANCE": SNAP_DISTANCE})
+    ###########################################################################################
+    # [OPTIONAL] 3. re-merge and DIVIDE, lines from ways before merging are the unmerged lines.
+    pipeline.add("divide", lambda merged, prepared: divide(merged, prepared[0], DIVIDE) if DIVIDE else merged, inputs=["merge", "prepare"],
+                 params={"DIVIDE": DIVIDE}, persist=bool(DIVIDE), skippable=True)  # Without DIVIDE it passes merged through, nothing to save.
+    #####################################################################################
+    # OUTPUT
+    # Optional topology-preserving simplification, tolerance per mode in SIMPLIFY.
+    pipeline.add("simplify", lambda merged: simplify(merged, mode, SIMPLIFY), inputs=["divide"], params={"mode": mode, "SIMPLIFY": SIMPLIFY},
+                 persist=bool(SimplifyUtils.get_tolerance(SIMPLIFY, mode)), skippable=True)
+    pipeline.add("output", lambda merged: output(merged, output_path, mode, DEBUGGING, hilbert_order=HILBERT_ORDER), inputs=["simplify"],
+                 params={"output_path": output_path, "DEBUGGING": DEBUGGING, "HILBERT_ORDER": HILBERT_ORDER}, persist=False, skippable=True)
+    pipeline.run("output")
+
+
+def route(lines_df, relation_member_dict, limit_areas: dict, mode, hilbert_order=False, limit_relations=False) -> dict:
+    """
+    Route lines to every nation whose limit area they intersect, nation -> (lines, relations).
+    A highway relation goes to the nations of its member lines. With hilbert_order, lines of a nation are sorted as in prepare.
+    With limit_relations (subset runs), relations only keep member lines of the nation.
+    """
+    relations = prepare_relations(lines_df, relation_member_dict, mode)
+    routed = dict()
+    for nation, indices in LimitAreaUtils.get_nation_indices(lines_df.geometry.values, limit_areas).items():
+        data_from_way = HilbertUtils.sort(lines_df.iloc[indices]) if hilbert_order else lines_df.iloc[indices]
+        line_ids = set(data_from_way["POLYGON_ID"].values)
+        nation_relations = {relation_id: relation for relation_id, relation in relations.items() if line_ids.intersection(relation["POLYGON_ID"].values)}
+        if limit_relations:
+            nation_relations = {relation_id: relation[relation["POLYGON_ID"].isin(line_ids)].reset_index(drop=True) for relation_id, relation in nation_relations.items()}
+        routed[nation] = data_from_way, nation_relations
+        logging.info(f"{nation}: {len(data_from_way)} lines, {len(routed[nation][1])} relations.")
+    return routed
+
+
+def main_nations(input_path, nations: dict, mode, tags, DEBUGGING=False, LEVEL_DICT=None, ALL_OFFLINE=True, SPILL_PATH=None,
+                 CHECKPOINT_PATH=None, FORCE_STAGES=None, SKIP_STAGES=None, SNAP_DISTANCE=None, SIMPLIFY=None, HILBERT_ORDER=False, WITHIN=None):
+    """
+    Extract lines of several nations, nation -> (limit relation id, output path), from one pass on a large file.
+    Lines are read once within all limit areas and routed to nations, then merged and output per nation.
+    """
+    levels = Tag.get_levels(mode, LEVEL_DICT) if LEVEL_DICT else [0]
+    limit_relation_ids = {nation: limit_relation_id for nation, (limit_relation_id, _) in nations.items()}
+    pipeline = Pipeline(input_path, CHECKPOINT_PATH, FORCE_STAGES, SKIP_STAGES, name=f"{mode}.{'-'.join(nations.keys())}")
+    logging.info(f"[1/2] Prepare line data of {list(nations.keys())} from osm.pbf file.")
+    pipeline.add("limit_area", lambda: LimitAreaUtils.get_limit_areas(input_path, limit_relation_ids, ALL_OFFLINE, WITHIN),
+                 params={"limit_relation_ids": limit_relation_ids, "ALL_OFFLINE": ALL_OFFLINE, "WITHIN": WITHIN})
+    pipeline.add("read", lambda limit_areas: read(input_path, mode, tags, LEVEL_DICT, LimitAreaUtils.get_combined_area(limit_areas), SPILL_PATH),
+                 inputs=["limit_area"], params={"mode": mode, "tags": tags, "LEVEL_DICT": LEVEL_DICT})
+    pipeline.add("prepare", lambda read_result, limit_areas: route(*read_result, limit_areas, mode, HILBERT_ORDER, WITHIN is not None), inputs=["read", "limit_area"],
+                 params={"mode": mode, "HILBERT_ORDER": HILBERT_ORDER})
+    for nation, (_, output_path) in nations.items():
+        def merge_stage(routed, nation=nation, output_path=output_path):
+            logging.info(f"[2/2] Merge all the line of {nation}.")
+            merged = merge(*routed[nation], mode, levels, SNAP_DISTANCE, output_path if DEBUGGING else None)
+            if DEBUGGING:
+                get_writer().to_file(merged, f"{output_path}/merged.geojson", driver="GeoJSON", index=False, encoding="utf-8")
+            return merged
+        pipeline.add(f"merge.{nation}", merge_stage, inputs=["prepare"], params={"mode": mode, "levels": levels, "SNAP_DISTANCE": SNAP_DISTANCE})
+        pipeline.add(f"simplify.{nation}", lambda merged: simplify(merged, mode, SIMPLIFY), inputs=[f"merge.{nation}"], params={"mode": mode, "SIMPLIFY": SIMPLIFY},
+                     persist=bool(SimplifyUtils.get_tolerance(SIMPLIFY, mode)), skippable=True)
+        pipeline.add(f"output.{nation}", lambda merged, output_path=output_path: output(merged, output_path, mode, DEBUGGING, hilbert_order=HILBERT_ORDER),
+                     inputs=[f"simplify.{nation}"], params={"output_path": output_path, "DEBUGGING": DEBUGGING, "HILBERT_ORDER": HILBERT_ORDER}, persist=False, skippable=True)
+    for nation in nations.keys():
+        pipeline.run(f"output.{nation}")
@@ -1,13 +1,325 @@
+import json
+import os
+import shutil
+import tempfile
+from array import array
+
+import numpy
+
+COORDINATE_PRECISION = 10000000  # OSM locations are 1e-7 degree fixed-point integers.
+
+
+def to_fixed_lines(geometries) -> list:
+    """
+    LineStrings to list of int32 (N, 2) fixed-point coords arrays.
+    """
+    import shapely
+    if not len(geometries):
+        return []
+    coords, index = shapely.get_coordinates(numpy.asarray(geometries, dtype=object), return_index=True)
+    fixed = numpy.rint(coords * COORDINATE_PRECISION).astype(numpy.int32)
+    return numpy.split(fixed, numpy.cumsum(numpy.bincount(index, minlength=len(geometries)))[:-1])
+
+
+def from_fixed_lines(lines) -> numpy.ndarray:
+    """
+    Fixed-point coords arrays to array of LineStrings, vectorized.
+    """
+    import shapely
+    if not len(lines):
+        return numpy.empty(0, dtype=object)
+    coords = numpy.concatenate(lines) / COORDINATE_PRECISION
+    return shapely.linestrings(coords, indices=numpy.repeat(numpy.arange(len(lines)), [len(line) for line in lines]))
+
+
+class FeatureTable:
+    """
+    Columnar accumulator of handler features.
+    ids in typed array, string columns interned as categorical codes, geometry as contiguous WKB buffer with offsets.
+    When memory_budget (bytes) is reached, rows are flushed to on-disk chunks under spill_path, read them back with iter_tables.
+    With fixed, geometry buffer keeps LineString as int32 fixed-point coords instead of WKB.
+    """
+    def __init__(self, columns=("POLYGON_NAME", "ROAD_LEVEL"), constants=None, memory_budget=None, spill_path=None, fixed=False):
+        self.columns = tuple(columns)
+        self.fixed = fixed
+        self.memory_budget = memory_budget
+        self.spill_path = spill_path  # Root directory of spilled chunks, each table spills to its own sub directory.
+        self.spill_dir = None
+        self.chunks = []
+        self.constants = constants
+        self.reset()
+
+    def reset(self):
+        columns = self.columns
+        self.ids = array("q")
+        self.wkb = bytearray()
+        self.offsets = array("q", [0])
+        self.codes = {column: array("i") for column in columns}
+        self.categories = {column: dict() for column in columns}  # value -> code
+        self.values = {column: [] for column in columns}  # code -> value
+        self.id_index = None
+
+    @property
+    def constants(self):
+        return self._constants
+
+    @constants.setter
+    def constants(self, constants):
+        self._constants = constants if constants else dict()  # same value for all rows, e.g. HOFN_TYPE
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id):
+        return self.get(id) is not None
+
+    def __getitem__(self, id):
+        view = self.get(id)
+        if view is None:
+            raise KeyError(id)
+        return view
+
+    @property
+    def nbytes(self):
+        return self.ids.itemsize * len(self.ids) + len(self.wkb) + self.offsets.itemsize * len(self.offsets) + \
+               sum(codes.itemsize * len(codes) for codes in self.codes.values())
+
+    def append(self, id, wkb: bytes, **values):
+        self.ids.append(id)
+        self.wkb += wkb
+        self.offsets.append(len(self.wkb))
+        for column, codes in self.codes.items():
+            categories = self.categories[column]
+            value = values.get(column)
+            code = categories.get(value)
+            if code is None:
+                code = categories[value] = len(categories)
+                self.values[column].append(value)
+            codes.append(code)
+        self.id_index = None
+        if self.memory_budget and self.nbytes >= self.memory_budget:
+            self.spill()
+
+    def extend(self, data, id_column="POLYGON_ID"):
+        """
+        Append rows of GeoDataFrame, columns of the table are taken from the same named columns.
+        """
+        import shapely
+        columns = [column for column in self.columns if column in data.columns]
+        geometries = [line.tobytes() for line in to_fixed_lines(data.geometry.values)] if self.fixed else shapely.to_wkb(data.geometry.values)
+        for id, wkb, *values in zip(data[id_column].tolist(), geometries, *[data[column].tolist() for column in columns]):
+            self.append(int(id), wkb, **dict(zip(columns, values)))
+
+    def take(self, indices) -> "FeatureTable":
+        """
+        New table of rows at positions indices, only rows in memory are taken.
+        """
+        table = FeatureTable(self.columns, self.constants, fixed=self.fixed)
+        for index in indices:
+            table.append(self.ids[index], self.get_wkb(index), **{column: self.values[column][self.codes[column][index]] for column in self.columns})
+        return table
+
+    def append_table(self, other: "FeatureTable"):
+        """
+        Append rows of other table, e.g. tables read from ranges of a file in parallel, only rows in memory are appended.
+        Buffers are concatenated at once, category codes of other are remapped by a look up array of its values.
+        """
+        if not len(other):
+            return
+        self.ids.extend(other.ids)
+        base = len(self.wkb)
+        self.wkb += other.wkb[:other.offsets[-1]]
+        self.offsets.frombytes((numpy.frombuffer(other.offsets, dtype=numpy.int64)[1:] + base).tobytes())
+        for column in self.columns:
+            categories = self.categories[column]
+            for value in other.values[column]:
+                if value not in categories:
+                    categories[value] = len(categories)
+                    self.values[column].append(value)
+            mapping = numpy.array([categories[value] for value in other.values[column]], dtype=numpy.int32)
+            self.codes[column].frombytes(mapping[numpy.frombuffer(other.codes[column], dtype=numpy.int32)].tobytes())
+        self.id_index = None
+        if self.memory_budget and self.nbytes >= self.memory_budget:
+            self.spill()
+
+    def spill(self):
+        """
+        Flush rows in memory to an on-disk chunk.
+        """
+        if not len(self.ids):
+            return
+        if self.spill_dir is None:
+            if self.spill_path and not os.path.isdir(self.spill_path):
+                os.makedirs(self.spill_path)
+            self.spill_dir = tempfile.mkdtemp(prefix="feature_table_", dir=self.spill_path)
+        path = f"{self.spill_dir}/chunk-{len(self.chunks):05d}.npz"
+        arrays = {f"codes_{column}": numpy.frombuffer(codes, dtype=numpy.int32) for column, codes in self.codes.items()}
+        numpy.savez(path, ids=self.get_ids(), wkb=numpy.frombuffer(bytes(self.wkb), dtype=numpy.uint8),
+                    offsets=numpy.frombuffer(self.offsets, dtype=numpy.int64),
+                    values=numpy.frombuffer(json.dumps(self.values).encode("utf-8"), dtype=numpy.uint8), **arrays)
+        self.chunks.append(path)
+        self.reset()
+
+    def load_chunk(self, path) -> "FeatureTable":
+        table = FeatureTable(self.columns, self.constants, fixed=self.fixed)
+        with numpy.load(path) as chunk:
+            table.ids.frombytes(chunk["ids"].tobytes())
+            table.wkb = bytearray(chunk["wkb"].tobytes())
+            table.offsets = array("q", chunk["offsets"].tobytes())
+            table.values = json.loads(chunk["values"].tobytes().decode("utf-8"))
+            for column in self.columns:
+                table.codes[column].frombytes(chunk[f"codes_{column}"].tobytes())
+                table.categories[column] = {value: code for code, value in enumerate(table.values[column])}
+        return table
+
+    def iter_tables(self):
+        """
+        Yield spilled chunks one by one, then rows still in memory.
+        """
+        for path in self.chunks:
+            yield self.load_chunk(path)
+        if len(self.ids):
+            yield self.get_in_memory()
+
+    def get_in_memory(self) -> "FeatureTable":
+        """
+        Table sharing the buffers of rows in memory, without spilled chunks.
+        """
+        table = FeatureTable(self.columns, self.constants, fixed=self.fixed)
+        table.ids, table.wkb, table.offsets = self.ids, self.wkb, self.offsets
+        table.codes, table.categories, table.values = self.codes, self.categories, self.values
+        return table
+
+    def iter_geodataframes(self, id_column="POLYGON_ID"):
+        for table in self.iter_tables():
+            yield table.to_geodataframe(id_column)
+
+    def close(self):
+        """
+        Remove spilled chunks.
+        """
+        if self.spill_dir:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+        self.spill_dir = None
+        self.chunks = []
+
+    def get_ids(self) -> numpy.ndarray:
+        return numpy.frombuffer(self.ids, dtype=numpy.int64) if len(self.ids) else numpy.empty(0, dtype=numpy.int64)
+
+    def get_column(self, column):
+        import pandas
+        codes = numpy.frombuffer(self.codes[column], dtype=numpy.int32) if len(self.ids) else numpy.empty(0, dtype=numpy.int32)
+        return pandas.Categorical.from_codes(codes, categories=self.values[column])
+
+    def get_value(self, column, index):
+        if column in self.constants:
+            return self.constants[column]
+        return self.values[column][self.codes[column][index]]
+
+    def get_wkb(self, index) -> bytes:
+        return bytes(self.wkb[self.offsets[index]:self.offsets[index + 1]])
+
+    def get_fixed(self, index) -> numpy.ndarray:
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return numpy.frombuffer(self.wkb, dtype=numpy.int32, count=(end - start) // 4, offset=start).reshape(-1, 2)
+
+    def get_geometry(self, index):
+        if self.fixed:
+            return from_fixed_lines([self.get_fixed(index)])[0]
+        from shapely import wkb
+        return wkb.loads(self.get_wkb(index))
+
+    def get_wkbs(self) -> list:
+        wkb, offsets = memoryview(self.wkb), self.offsets
+        return [bytes(wkb[offsets[i]:offsets[i + 1]]) for i in range(len(self.ids))]
+
+    def get_geometries(self):
+        import geopandas
+        if self.fixed:
+            if not len(self.ids):
+                return geopandas.GeoSeries([], dtype="geometry")
+            coords = numpy.frombuffer(self.wkb, dtype=numpy.int32).reshape(-1, 2)
+            return geopandas.GeoSeries(from_fixed_lines(numpy.split(coords, numpy.frombuffer(self.offsets, dtype=numpy.int64)[1:-1] // 8)))
+        return geopandas.GeoSeries.from_wkb(self.get_wkbs())
+
+    def get(self, id, default=None):
+        """
+        Look up a row view by id, only rows in memory are looked up, do not set memory_budget on lookup tables.
+        """
+        if self.id_index is None:
+            ids = self.get_ids()
+            order = numpy.argsort(ids, kind="stable")
+            self.id_index = (ids[order], order)
+        sorted_ids, order = self.id_index
+        position = numpy.searchsorted(sorted_ids, id)
+        if position < len(sorted_ids) and sorted_ids[position] == id:
+            return FeatureView(self, int(order[position]))
+        return default
+
+    def to_geodataframe(self, id_column="POLYGON_ID"):
+        """
+        Columns are built from buffers directly, no per-row dict.
+        """
+        import geopandas
+        if self.chunks:
+            import pandas
+            return geopandas.GeoDataFrame(pandas.concat(list(self.iter_geodataframes(id_column)), ignore_index=True), geometry="geometry")
+        data = {id_column: self.get_ids()}
+        for column in self.codes.keys():
+            data[column] = self.get_column(column)
+        for column, value in self.constants.items():
+            data[column] = value
+        data["geometry"] = self.get_geometries()
+        return geopandas.GeoDataFrame(data, geometry="geometry")
+
+
+class FeatureView:
+    """
+    Thin view of one row in FeatureTable, attribute access is mapped to the table columns.
+    """
+    __slots__ = ("table", "index")
+    aliases = {"name": "POLYGON_NAME", "height": "HEIGHT", "level": "LEVEL"}
+
+    def __init__(self, table: FeatureTable, index):
+        self.table = table
+        self.index = index
+
+    @property
+    def id(self):
+        return self.table.ids[self.index]
+
+    @property
+    def geometry(self):
+        return self.table.get_geometry(self.index)
+
+    def __getattr__(self, name):
+        if name in self.__slots__:
+            raise AttributeError(name)
+        column = self.aliases.get(name, name)
+        if column in self.table.codes or column in self.table.constants:
+            return self.table.get_value(column, self.index)
+        raise AttributeError(name)
+
+    def __repr__(self):
+        return str(f"{self.id}@{self.name}")
+
+
 class HofnData:
     """
     Hofn output format data.
     """
+    __slots__ = ("POLYGON_ID", "POLYGON_NAME", "HOFN_TYPE", "ROAD_LEVEL", "geometry")
+
     def __init__(self, POLYGON_ID, POLYGON_NAME, HOFN_TYPE, ROAD_LEVEL, geometry):
         self.POLYGON_ID = POLYGON_ID
         self.POLYGON_NAME = POLYGON_NAME
         self.HOFN_TYPE = HOFN_TYPE
         self.ROAD_LEVEL = ROAD_LEVEL
         self.geometry = geometry
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
     def __repr__(self):
         return str(self.POLYGON_ID)
 
@@ -15,22 +327,15 @@ class RelationMember:
     """
     Relation member, which ref to pyosmium data.
     """
+    __slots__ = ("id", "type", "role")
+
     def __init__(self,id,type ,role):
         self.id = id
         self.type = type
-        self.role = role  
+        self.role = role
 
     def __repr__(self):
         return str(self.id)
 
-class Way:
-    """
-    Way geometry for look up purpose.
-    """
-    def __init__(self,id,name,geometry):
-        self.id = id
-        self.name = name
-        self.geometry = geometry
-    
-    def __repr__(self):
-        return str(f"{self.id}@{self.name}")
\ No newline at end of file
+# Way geometry for look up purpose, as view of FeatureTable(columns=("POLYGON_NAME",)).
+Way = FeatureView
@@ -0,0 +1,163 @@
+import hashlib
+import http.client
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+from urllib.parse import urlencode, urlsplit
+
+from shapely.geometry import LineString
+
+from src.config import get_config
+
+DEFAULT_URL = "https://overpass-api.de/api/interpreter"
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class OverpassError(Exception):
+    pass
+
+
+def get_runtime_error(data: bytes):
+    """
+    Runtime error in remark of a json response, e.g. query timed out or out of memory, the partial data must not be used.
+    """
+    try:
+        remark = json.loads(data).get("remark")
+    except (ValueError, AttributeError):
+        return None
+    return remark if remark and "runtime error" in remark else None
+
+
+class OverpassClient:
+    """
+    Overpass api client with connection reuse, batched concurrent queries, retry with exponential backoff
+    and on-disk response cache keyed by query text.
+    """
+    def __init__(self, url=DEFAULT_URL, cache_dir=None, max_workers=4, batch_size=200, max_retries=5, backoff=1.0, timeout=180):
+        self.url = url
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._local = threading.local()  # One keep-alive connection per thread.
+        if self.cache_dir and not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    @classmethod
+    def from_config(cls, config: dict):
+        overpass_config = config.get("overpass") or dict()
+        return cls(url=overpass_config.get("url", DEFAULT_URL),
+                   cache_dir=overpass_config.get("cache"),
+                   max_workers=overpass_config.get("max_workers", 4),
+                   batch_size=overpass_config.get("batch_size", 200),
+                   max_retries=overpass_config.get("max_retries", 5),
+                   backoff=overpass_config.get("backoff", 1.0))
+
+    def _get_connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            url = urlsplit(self.url)
+            connection_class = http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+            connection = connection_class(url.netloc, timeout=self.timeout)
+            self._local.connection = connection
+        return connection
+
+    def _reset_connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+        self._local.connection = None
+
+    def _get_cache_path(self, query):
+        return f"{self.cache_dir}/{hashlib.sha256(query.encode('utf-8')).hexdigest()}.json"
+
+    def _post(self, query) -> bytes:
+        url = urlsplit(self.url)
+        body = urlencode({"data": query})
+        headers = {"Content-Type": "application/x-www-form-urlencoded", "Connection": "keep-alive"}
+        for attempt in range(self.max_retries + 1):
+            try:
+                connection = self._get_connection()
+                connection.request("POST", url.path or "/", body=body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+                if response.status == 200:
+                    runtime_error = get_runtime_error(data)
+                    if runtime_error is None:
+                        return data
+                    logging.debug(f"Overpass responded {runtime_error}, attempt {attempt + 1}/{self.max_retries + 1}.")
+                elif response.status not in RETRY_STATUS:
+                    raise OverpassError(f"Overpass responded {response.status}: {data[:200]}")
+                else:
+                    logging.debug(f"Overpass responded {response.status}, attempt {attempt + 1}/{self.max_retries + 1}.")
+            except (http.client.HTTPException, OSError) as e:
+                logging.debug(f"Overpass connection error {e}, attempt {attempt + 1}/{self.max_retries + 1}.")
+                self._reset_connection()
+            if attempt < self.max_retries:
+                time.sleep(self.backoff * 2 ** attempt * (1 + random.random() / 2))
+        raise OverpassError(f"Overpass query failed after {self.max_retries + 1} attempts.")
+
+    def query_raw(self, query) -> bytes:
+        if self.cache_dir:
+            cache_path = self._get_cache_path(query)
+            if os.path.exists(cache_path):
+                with open(cache_path, "rb") as stream:
+                    return stream.read()
+        data = self._post(query)
+        if self.cache_dir:
+            tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as stream:
+                stream.write(data)
+            os.replace(tmp_path, cache_path)
+        return data
+
+    def query(self, query) -> "overpy.Result":
+        import overpy  # Only needed in online mode.
+        return overpy.Overpass().parse_json(self.query_raw(query))
+
+    def query_many(self, queries: List[str]) -> List["overpy.Result"]:
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(self.query, queries))
+
+    def get_ways(self, way_ids: List) -> Dict[int, LineString]:
+        """
+        Get way geometries with many way ids per request, return {way_id: LineString}.
+        """
+        way_ids = [int(i) for i in way_ids]
+        batches = [way_ids[i:i + self.batch_size] for i in range(0, len(way_ids), self.batch_size)]
+        queries = [f"""[out:json][timeout:{self.timeout}];
+        way(id:{",".join(str(i) for i in batch)});
+        out body;
+        >;
+        out skel qt;
+        """ for batch in batches]
+        ways = dict()
+        for result in self.query_many(queries):
+            for way in result.ways:
+                ways[way.id] = LineString([(float(node.lon), float(node.lat)) for node in way.nodes])
+        return {way_id: ways[way_id] for way_id in way_ids if way_id in ways}
+
+    def get_relation(self, relation_id) -> "overpy.Result":
+        return self.query(f"""[out:json][timeout:{self.timeout}];
+        rel({relation_id});
+        out body;
+        >;
+        out skel qt;
+        """)
+
+
+client = None
+
+
+def get_client() -> OverpassClient:
+    global client
+    if client is None:
+        client = OverpassClient.from_config(get_config())
+    return client
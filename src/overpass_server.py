@@ -0,0 +1,156 @@
+"""
+Local Overpass-compatible stand-in server, answer id queries from in-memory osm elements.
+Supported statements: node/way/rel by id (`way(1)`, `way(id:1,2,3)`), recurse down `>;` and `out` in json.
+
+usage: python -m src.overpass_server elements.json --port 8080
+"""
+import json
+import re
+import threading
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import parse_qs, urlsplit
+
+ELEMENT_TYPES = {"node": "node", "way": "way", "rel": "relation", "relation": "relation"}
+SET_PATTERN = re.compile(r"\b(node|way|rel|relation)\(\s*(?:id:)?\s*([\d,\s]+)\)")
+
+
+class OverpassStandInServer:
+    def __init__(self, elements: List[Dict], host="127.0.0.1", port=0, fail_first=0, remark_first=0):
+        self.elements = {(element["type"], element["id"]): element for element in elements}
+        self.fail_first = fail_first  # Respond 429 for first n requests, for retry testing.
+        self.remark_first = remark_first  # Then respond partial data with a runtime error remark for n requests, as a timed out query.
+        self.queries = []
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._get_handler_class())
+        self.thread = None
+
+    @classmethod
+    def from_json(cls, path, **kwargs):
+        with open(path, "r", encoding="utf-8") as stream:
+            return cls(json.load(stream)["elements"], **kwargs)
+
+    @classmethod
+    def from_pbf(cls, path, **kwargs):
+        import osmium
+
+        elements = []
+
+        class ElementHandler(osmium.SimpleHandler):
+            def node(self, node):
+                elements.append({"type": "node", "id": node.id, "lat": node.location.lat, "lon": node.location.lon, "tags": dict(node.tags)})
+
+            def way(self, way):
+                elements.append({"type": "way", "id": way.id, "nodes": [node.ref for node in way.nodes], "tags": dict(way.tags)})
+
+            def relation(self, relation):
+                members = [{"type": {"n": "node", "w": "way", "r": "relation"}[member.type], "ref": member.ref, "role": member.role}
+                           for member in relation.members]
+                elements.append({"type": "relation", "id": relation.id, "members": members, "tags": dict(relation.tags)})
+
+        ElementHandler().apply_file(path)
+        return cls(elements, **kwargs)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/api/interpreter"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def recurse_down(self, elements: List[Dict]) -> List[Dict]:
+        result, seen = [], set()
+        pending = list(elements)
+        while pending:
+            element = pending.pop(0)
+            if element["type"] == "way":
+                refs = [("node", ref) for ref in element["nodes"]]
+            elif element["type"] == "relation":
+                refs = [(member["type"], member["ref"]) for member in element["members"]]
+            else:
+                refs = []
+            for ref in refs:
+                child = self.elements.get(ref)
+                if child is not None and ref not in seen:
+                    seen.add(ref)
+                    result.append(child)
+                    pending.append(child)
+        return result
+
+    def answer(self, query) -> Dict:
+        elements = []
+        for element_type, ids in SET_PATTERN.findall(query):
+            for element_id in ids.replace(" ", "").split(","):
+                element = self.elements.get((ELEMENT_TYPES[element_type], int(element_id)))
+                if element is not None:
+                    elements.append(element)
+        if ">;" in query.replace(" ", ""):
+            # "out skel" of recursed elements, drop tags.
+            elements += [{k: v for k, v in element.items() if k != "tags"} for element in self.recurse_down(elements)]
+        return {"version": 0.6, "generator": "OSMOfflineParser stand-in", "elements": elements}
+
+    def _get_handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive
+
+            def _respond(self, query):
+                with server.lock:
+                    server.queries.append(query)
+                    failing = len(server.queries) <= server.fail_first
+                    remarking = not failing and len(server.queries) <= server.fail_first + server.remark_first
+                if failing:
+                    body, status = b"Too Many Requests", 429
+                elif remarking:
+                    answer = server.answer(query)
+                    answer["elements"] = answer["elements"][:1]
+                    answer["remark"] = "runtime error: Query timed out in \"query\" at line 3 after 1 seconds."
+                    body, status = json.dumps(answer).encode("utf-8"), 200
+                else:
+                    body, status = json.dumps(server.answer(query)).encode("utf-8"), 200
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                self._respond(parse_qs(self.rfile.read(length).decode("utf-8")).get("data", [""])[0])
+
+            def do_GET(self):
+                self._respond(parse_qs(urlsplit(self.path).query).get("data", [""])[0])
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("input", type=str, help="Overpass json (with elements) or osm.pbf file path.")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+    if args.input.endswith(".pbf"):
+        stand_in = OverpassStandInServer.from_pbf(args.input, host=args.host, port=args.port)
+    else:
+        stand_in = OverpassStandInServer.from_json(args.input, host=args.host, port=args.port)
+    print(f"Serving overpass stand-in at {stand_in.url}")
+    stand_in.httpd.serve_forever()
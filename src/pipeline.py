@@ -0,0 +1,187 @@
+import hashlib
+import inspect
+import json
+import logging
+import os
+import pickle
+import re
+import sys
+import time
+import types
+from typing import Callable, Dict, List
+
+FORMAT_VERSION = 1  # Bump when the artifact layout changes, artifacts of older versions are not loaded.
+SOURCE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Stage:
+    def __init__(self, name, function: Callable, inputs: List[str], params: Dict, persist=True, skippable=False):
+        self.name = name
+        self.function = function
+        self.inputs = inputs
+        self.params = params
+        self.persist = persist
+        self.skippable = skippable  # Result has the same shape as its first input, so it can be passed through.
+
+
+def get_code_version(function) -> str:
+    """
+    Hash of the source of function and of functions, classes and modules of this repo it refers to, transitively,
+    so editing a stage or a helper it calls changes the key.
+    """
+    def is_local(item):
+        module = sys.modules.get(item.__name__ if isinstance(item, types.ModuleType) else getattr(item, "__module__", None) or "")
+        path = getattr(module, "__file__", None) or ""
+        return os.path.abspath(path).startswith(SOURCE_PATH + os.sep) and "site-packages" not in path
+
+    def get_names(code) -> set:
+        names = set(code.co_names)
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                names |= get_names(const)
+        return names
+
+    sources, seen, pending = dict(), set(), [function]
+    while pending:
+        item = pending.pop()
+        while hasattr(item, "func"):  # functools.partial
+            item = item.func
+        item = getattr(item, "__func__", item)  # staticmethod, classmethod and bound methods
+        if id(item) in seen or not (isinstance(item, (types.FunctionType, type, types.ModuleType)) and is_local(item)):
+            continue
+        seen.add(id(item))
+        try:
+            source = inspect.getsource(item)
+        except (OSError, TypeError):
+            source = item.__code__.co_code.hex() if isinstance(item, types.FunctionType) else ""
+        sources[f"{getattr(item, '__module__', item.__name__)}.{getattr(item, '__qualname__', item.__name__)}"] = source
+        if isinstance(item, types.FunctionType):
+            pending.extend(item.__globals__[name] for name in get_names(item.__code__) if name in item.__globals__)
+            pending.extend(cell.cell_contents for cell in item.__closure__ or () if cell.cell_contents is not None)
+        elif isinstance(item, type):
+            pending.extend(vars(item).values())
+    return hashlib.sha1(json.dumps(sources, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+class Pipeline:
+    """
+    DAG of named stages, stage function is called with results of its input stages.
+    Results are persisted under checkpoint_path/name as artifacts keyed by source file, stage params, the code of the stage
+    and keys of input stages, so a rerun loads the latest unchanged stage and only runs what comes after it.
+    A new artifact of a stage replaces the older ones, and results are kept in memory only until their last consumer is done.
+    Forced stages and their downstream stages are always run, skipped stages pass their first input through,
+    only stages added as skippable can be skipped, and keys of skipped stages and their downstream stages differ from a normal run.
+    Stages repeated per nation are named stage.nation, forcing or skipping stage applies to all of them.
+    """
+    def __init__(self, source_path, checkpoint_path=None, force_stages=None, skip_stages=None, name="pipeline"):
+        self.source = self.get_fingerprint(source_path)
+        self.checkpoint_path = f"{checkpoint_path}/{name}.{os.path.basename(source_path)}" if checkpoint_path else None
+        self.force_stages = set(force_stages or [])
+        self.skip_stages = set(skip_stages or [])
+        self.stages: Dict[str, Stage] = dict()
+        self.results = dict()
+        self.consumers: Dict[str, set] = dict()  # Stages not done yet that take the result as input.
+        self.keys = dict()
+        if self.checkpoint_path and not os.path.isdir(self.checkpoint_path):
+            os.makedirs(self.checkpoint_path)
+
+    @staticmethod
+    def get_fingerprint(path) -> dict:
+        stat = os.stat(path)
+        return {"path": os.path.abspath(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def add(self, name, function: Callable, inputs=(), params=None, persist=True, skippable=False):
+        for input_name in inputs:
+            if input_name not in self.stages:
+                raise ValueError(f"Input stage {input_name} of {name} is not added.")
+        self.stages[name] = Stage(name, function, list(inputs), params or dict(), persist, skippable)
+        self.consumers[name] = set()
+        for input_name in inputs:
+            self.consumers[input_name].add(name)
+        return self
+
+    def validate(self):
+        unknown = (self.force_stages | self.skip_stages) - set(self.stages.keys()) - {self.get_base_name(name) for name in self.stages.keys()}
+        if unknown:
+            raise ValueError(f"Unknown stages {sorted(unknown)}, stages are {list(self.stages.keys())}.")
+        unskippable = {self.get_base_name(name) for name, stage in self.stages.items() if self.is_in(name, self.skip_stages) and not stage.skippable}
+        if unskippable:
+            raise ValueError(f"Stages {sorted(unskippable)} can not be skipped, their result differs from their input, "
+                             f"skippable stages are {[name for name, stage in self.stages.items() if stage.skippable]}.")
+
+    @staticmethod
+    def get_base_name(name) -> str:
+        return name.split(".")[0]
+
+    def is_in(self, name, stages) -> bool:
+        return name in stages or self.get_base_name(name) in stages
+
+    def get_key(self, name) -> str:
+        if name in self.keys:
+            return self.keys[name]
+        stage = self.stages[name]
+        key = {"stage": name, "params": stage.params, "inputs": [self.get_key(i) for i in stage.inputs], "source": self.source,
+               "code": get_code_version(stage.function), "format": FORMAT_VERSION}
+        if self.is_in(name, self.skip_stages):
+            key["skipped"] = True  # Downstream keys change with it, a result of a skipped run is never loaded by a normal run.
+        self.keys[name] = hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+        return self.keys[name]
+
+    def get_artifact_path(self, name) -> str:
+        return f"{self.checkpoint_path}/{name}.{self.get_key(name)}.pkl"
+
+    def is_forced(self, name) -> bool:
+        return self.is_in(name, self.force_stages) or any(self.is_forced(i) for i in self.stages[name].inputs)
+
+    def remove_superseded(self, name):
+        """
+        Remove older artifacts of stage, other stages named stage.nation are kept.
+        """
+        pattern = re.compile(rf"{re.escape(name)}\.[0-9a-f]{{16}}\.pkl")
+        artifact_name = os.path.basename(self.get_artifact_path(name))
+        for file_name in os.listdir(self.checkpoint_path):
+            if pattern.fullmatch(file_name) and file_name != artifact_name:
+                os.remove(f"{self.checkpoint_path}/{file_name}")
+
+    def set_result(self, name, result):
+        """
+        Keep result while later stages need it, release results of inputs this stage was the last consumer of.
+        """
+        if self.consumers[name]:
+            self.results[name] = result
+        for input_name in self.stages[name].inputs:
+            self.consumers[input_name].discard(name)
+            if not self.consumers[input_name]:
+                self.results.pop(input_name, None)
+
+    def run(self, name):
+        """
+        Get result of stage, run its input stages first if needed.
+        """
+        self.validate()
+        if name in self.results:
+            return self.results[name]
+        stage = self.stages[name]
+        if self.is_in(name, self.skip_stages):
+            logging.info(f"Stage {name} skipped.")
+            result = self.run(stage.inputs[0]) if stage.inputs else None
+            self.set_result(name, result)
+            return result
+        persisted = stage.persist and self.checkpoint_path
+        if persisted and not self.is_forced(name) and os.path.exists(self.get_artifact_path(name)):
+            logging.info(f"Stage {name} loaded from checkpoint {self.get_artifact_path(name)}")
+            with open(self.get_artifact_path(name), "rb") as stream:
+                result = pickle.load(stream)
+        else:
+            inputs = [self.run(i) for i in stage.inputs]
+            start_time = time.time()
+            result = stage.function(*inputs)
+            logging.info(f"Stage {name} done, taking {time.time() - start_time} seconds")
+            if persisted:
+                artifact_path = self.get_artifact_path(name)
+                with open(f"{artifact_path}.tmp", "wb") as stream:
+                    pickle.dump(result, stream, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(f"{artifact_path}.tmp", artifact_path)
+                self.remove_superseded(name)
+        self.set_result(name, result)
+        return result
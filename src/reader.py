@@ -0,0 +1,182 @@
+import logging
+import os
+import tempfile
+
+import numpy
+import osmium
+
+from src.config import get_config
+from src.executor import get_executor
+from src.models import FeatureTable
+
+LOCATION_DTYPE = numpy.dtype([("id", "<u8"), ("x", "<i4"), ("y", "<i4")])  # Entry of osmium sparse_file_array.
+
+
+def read_varint(data: bytes, position: int) -> tuple:
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, position
+        shift += 7
+
+
+def get_blob_type(header: bytes) -> tuple:
+    """
+    Type and data size of a BlobHeader message, other fields are skipped.
+    """
+    position, blob_type, size = 0, None, 0
+    while position < len(header):
+        key, position = read_varint(header, position)
+        field, wire_type = key >> 3, key & 0x07
+        if wire_type == 0:
+            value, position = read_varint(header, position)
+            if field == 3:
+                size = value
+        elif wire_type == 2:
+            length, position = read_varint(header, position)
+            if field == 1:
+                blob_type = header[position:position + length].decode("utf-8")
+            position += length
+        else:
+            raise ValueError(f"Unexpected wire type {wire_type} in BlobHeader.")
+    return blob_type, size
+
+
+def get_blocks(input_path) -> tuple:
+    """
+    Byte range of OSMHeader block and byte ranges of OSMData blocks, each with its length prefix and BlobHeader.
+    """
+    header, blocks = None, []
+    with open(input_path, "rb") as stream:
+        start = 0
+        while True:
+            prefix = stream.read(4)
+            if len(prefix) < 4:
+                break
+            blob_type, size = get_blob_type(stream.read(int.from_bytes(prefix, "big")))
+            end = stream.tell() + size
+            stream.seek(end)
+            if blob_type == "OSMHeader":
+                header = (start, end)
+            elif blob_type == "OSMData":
+                blocks.append((start, end))
+            start = end
+    if header is None:
+        raise ValueError(f"{input_path} has no OSMHeader block.")
+    return header, blocks
+
+
+def get_ranges(blocks, count) -> list:
+    """
+    Split blocks into at most count contiguous byte ranges of about the same size.
+    """
+    if not blocks:
+        return []
+    ends = numpy.array([end for _, end in blocks])
+    bounds = numpy.searchsorted(ends, numpy.linspace(blocks[0][0], blocks[-1][1], count + 1)[1:-1], side="left")
+    ranges, first = [], 0
+    for last in list(bounds) + [len(blocks) - 1]:
+        if last >= first:
+            ranges.append((blocks[first][0], blocks[last][1]))
+            first = last + 1
+    return ranges
+
+
+def build_location_index(input_path, index_path):
+    """
+    Node locations of the whole file into a sparse_file_array at index_path, sorted by id for look up.
+    Workers only read it, ways and relations never add nodes, so it is shared through page cache.
+    """
+    index = osmium.index.create_map(f"sparse_file_array,{index_path}")
+    osmium.apply(osmium.io.Reader(input_path, osmium.osm.NODE), osmium.NodeLocationsForWays(index))
+    del index
+    locations = numpy.memmap(index_path, dtype=LOCATION_DTYPE, mode="r+")
+    locations.sort(order="id", kind="stable")  # Unused capacity is id 0 and goes first, never looked up.
+    locations.flush()
+    del locations
+
+
+def apply_file(handler, input_path, spill_path=None):
+    """
+    Apply handler on file with node locations, in the index type of location_index config.
+    File based index types are kept in a temporary file under spill_path, removed after use.
+    """
+    index_type = get_config().get("location_index") or "flex_mem"
+    if not index_type.endswith("_file_array"):
+        handler.apply_file(input_path, idx=index_type, locations=True)
+        return handler
+    spill_path = spill_path or get_config().get("spill_path")
+    if spill_path and not os.path.isdir(spill_path):
+        os.makedirs(spill_path)
+    fd, index_path = tempfile.mkstemp(prefix="locations_", dir=spill_path)
+    os.close(fd)
+    try:
+        handler.apply_file(input_path, idx=f"{index_type},{index_path}", locations=True)
+    finally:
+        os.remove(index_path)
+    return handler
+
+
+def read_range(input_path, header, start, end, index_path, handler_class, arguments: dict, fields) -> dict:
+    """
+    Apply a new handler_class(**arguments) on ways and relations of blocks in [start, end), fields of the handler are returned.
+    """
+    with open(input_path, "rb") as stream:
+        stream.seek(header[0])
+        data = stream.read(header[1] - header[0])
+        stream.seek(start)
+        data += stream.read(end - start)
+    handler = handler_class(**arguments)
+    locations = osmium.NodeLocationsForWays(osmium.index.create_map(f"sparse_file_array,{index_path}"))
+    locations.ignore_errors()
+    reader = osmium.io.Reader(osmium.io.FileBuffer(data, "pbf"), osmium.osm.WAY | osmium.osm.RELATION)
+    try:
+        osmium.apply(reader, locations, handler)
+    finally:
+        reader.close()
+    return {field: getattr(handler, field) for field in fields}
+
+
+def merge_fields(results) -> dict:
+    """
+    Fields of range results in file order, tables are concatenated, dicts, sets and lists are combined.
+    """
+    merged = dict(results[0])
+    for result in results[1:]:
+        for field, value in result.items():
+            if isinstance(value, FeatureTable):
+                merged[field].append_table(value)
+            elif isinstance(value, (dict, set)):
+                merged[field].update(value)
+            else:
+                merged[field].extend(value)
+    return merged
+
+
+def apply_parallel(input_path, handler_class, arguments: dict, fields, spill_path=None) -> dict:
+    """
+    Apply handler_class on way and relation callbacks, in parallel over byte ranges of PBF blocks, return fields of the handler.
+    Handlers with area callbacks are not supported, multipolygons need member ways of other ranges.
+    Without parallel workers, the handler is applied on the whole file in this process.
+    """
+    executor = get_executor()
+    if executor.serial or executor.workers == 1:
+        handler = apply_file(handler_class(**arguments), input_path, spill_path)
+        return {field: getattr(handler, field) for field in fields}
+    header, blocks = get_blocks(input_path)
+    ranges = get_ranges(blocks, executor.workers * 4)
+    if spill_path and not os.path.isdir(spill_path):
+        os.makedirs(spill_path)
+    fd, index_path = tempfile.mkstemp(prefix="locations_", dir=spill_path)
+    os.close(fd)
+    try:
+        build_location_index(input_path, index_path)
+        logging.info(f"Reading {len(blocks)} blocks in {len(ranges)} ranges with {executor.workers} workers.")
+        results = executor.starmap(read_range, [(input_path, header, start, end, index_path, handler_class, arguments, fields) for start, end in ranges],
+                                   task_memory=max(end - start for start, end in ranges) * 10)
+    finally:
+        os.remove(index_path)
+    return merge_fields(results)
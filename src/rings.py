@@ -1,6 +1,5 @@
 import math
 import os
-import sys
 import time
 from itertools import repeat
 
@@ -10,48 +9,63 @@ import numpy
 import osmium
 import geopandas
 import pandas
-import multiprocessing
-from src.utils import RingUtils, MPUtils, LimitAreaUtils
-from src.models import HofnData, RelationMember, Way
+from src.utils import RingUtils, MPUtils, LimitAreaUtils, ExtractRelationHandler, BoxFilter, SimplifyUtils, HilbertUtils, TagUtils, is_tags_matched
+from src.models import FeatureTable, RelationMember
+from src.pipeline import Pipeline
+from src.executor import get_executor, SharedGeometries
+from src.reader import apply_file
+from src.writer import get_writer
 from typing import Dict, List
-from shapely import wkt, ops
+from shapely import ops, wkb
 from src.enum import HofnType
 
 # https://stackoverflow.com/questions/20625582/how-to-deal-with-settingwithcopywarning-in-pandas
 pandas.options.mode.chained_assignment = None  # default='warn'
-wktfab = osmium.geom.WKTFactory()
-cpu_count = int(numpy.where(multiprocessing.cpu_count() > 20, 20, multiprocessing.cpu_count() - 1))
+wkbfab = osmium.geom.WKBFactory()
 
 
 # RING_ID -> Using WAY id
 class RingHandler(osmium.SimpleHandler):
-    def __init__(self, tags, mode):
+    def __init__(self, tags, mode, memory_budget=None, spill_path=None, member_ids=None, box_filter=None, keep_tags=False):
         super().__init__()
+        # With keep_tags, tags are matched as is_tags_matched and their values are kept, tag:<key> columns of ways, relation_tags of relations.
+        self.keep_tags = keep_tags
+        tag_columns = TagUtils.get_columns(tags) if keep_tags else []
         # from way
-        self.way_rings = []
+        self.way_rings = FeatureTable(columns=("POLYGON_NAME", *tag_columns), constants={"HOFN_TYPE": HofnType[mode].value, "ROAD_LEVEL": 0},
+                                      memory_budget=memory_budget, spill_path=spill_path)
         self.relation_dict: Dict[List[Dict]] = dict()  # RelationID: [{ID,ROLE,TYPE}]
-        self.way_dict: Dict[Dict] = dict()
+        self.relation_tags = dict()  # RelationID: {key: value} of tags, with keep_tags.
+        self.way_dict = FeatureTable(columns=("POLYGON_NAME",))  # Look up by id, get Way view.
         self.mode = mode
         self.tags = tags
+        self.member_ids = member_ids  # If set, only keep relation member ways in way_dict.
+        self.box_filter = box_filter  # Reject ways and areas outside limit area boxes before creating geometry.
 
     # Tags: 1. Value 2. list 3. "" (purely take all the tags)
+    def is_matched(self, tags) -> bool:
+        if self.keep_tags:
+            return is_tags_matched(tags, self.tags)
+        return any([tags.get(key) in value if type(value) == list else tags.get(key) == value if value != "" else tags.get("key") for key, value in self.tags.items()])
+
     def area(self, area):
         try:
-            if any([area.tags.get(key) in value if type(value) == list else area.tags.get(key) == value if value != "" else area.tags.get("key") for key, value in self.tags.items()]):
-                ring_id = area.orig_id()
-                ring_name = area.tags.get("name") if area.tags.get("name") else "UNKNOWN"  # create new string object
-                ring_geometry = wkt.loads(wktfab.create_multipolygon(area))
-                if ring_geometry.area * 6371000 * math.pi / 180 * 6371000 * math.pi / 180 > 200 * 200:
-                    if area.from_way():
-                        # All area from way is one polygon (len(geometry) == 1)
-                        ring_geometry = list(ring_geometry)[0]  # Extract polygon from multipolygon
-                        self.way_rings.append(HofnData(ring_id, ring_name, HofnType[self.mode].value, 0 ,ring_geometry))
+            if self.is_matched(area.tags):
+                if area.from_way():
+                    if self.box_filter is not None and not self.box_filter.is_area_inside(area):
+                        return
+                    ring_id = area.orig_id()
+                    ring_name = area.tags.get("name") if area.tags.get("name") else "UNKNOWN"  # create new string object
+                    # Area filtering and polygon extraction are done on whole table after reading.
+                    tag_values = TagUtils.get_values(area.tags, self.tags) if self.keep_tags else dict()
+                    self.way_rings.append(ring_id, bytes.fromhex(wkbfab.create_multipolygon(area)), POLYGON_NAME=ring_name, **tag_values)
         except:
             pass
 
-    # Tags: 1. Value 2. list 3. "" (purely take all the tags)
     def relation(self, relation):
-        if any([relation.tags.get(key) in value if type(value) == list else relation.tags.get(key) == value if value != "" else relation.tags.get("key") for key, value in self.tags.items()]):
+        if self.is_matched(relation.tags):
+            if self.keep_tags:
+                self.relation_tags[relation.id] = {key: relation.tags.get(key) for key in self.tags.keys()}
             for member in relation.members:
                 if member.type == "w":
                     if not self.relation_dict.get(relation.id, False):
@@ -59,124 +73,318 @@ class RingHandler(osmium.SimpleHandler):
                     self.relation_dict[relation.id].append(RelationMember(member.ref, member.type, member.role))
 
     def way(self, way):
-        way_geometry = wkt.loads(wktfab.create_linestring(way))
+        if self.member_ids is not None and way.id not in self.member_ids:
+            return
+        if self.box_filter is not None and not self.box_filter.is_way_inside(way):
+            return
         try:
-            processed = list(ops.polygonize(way_geometry))[0]
+            way_wkb = bytes.fromhex(wkbfab.create_linestring(way))
+        except:
+            return
+        try:
+            processed = list(ops.polygonize(wkb.loads(way_wkb)))[0]
             if processed.area * 6371000 * math.pi / 180 * 6371000 * math.pi / 180 > 200 * 200:
-                self.way_dict[way.id] = Way(way.id, way.tags.get("name") if way.tags.get("name") else "UNKNOWN", way_geometry)
+                self.way_dict.append(way.id, way_wkb, POLYGON_NAME=way.tags.get("name") if way.tags.get("name") else "UNKNOWN")
         except:
             # If cannot be polygonized, it should be a slice of linestring, just add to merge it later.
-            self.way_dict[way.id] = Way(way.id, way.tags.get("name") if way.tags.get("name") else "UNKNOWN", way_geometry)
+            self.way_dict.append(way.id, way_wkb, POLYGON_NAME=way.tags.get("name") if way.tags.get("name") else "UNKNOWN")
 
 
 ##################################################################
 
-# %%
-def main(input_path, output_path, nation, limit_relation_id, mode, tags, DEBUGGING=False, ALL_OFFLINE=False):
-    IS_VILLAGE = True if mode == "village" else False
-    IS_WATER = True if mode == "water" else False
-    island_output_path = f"data/output/{nation}/island/"
-    if not os.path.isdir(island_output_path):
-        os.makedirs(island_output_path)
-    #######################################################################################
-    # 1. Get coastlines data from osm.pbf file
-    logging.info(f"Start extracting rings ...")
-    logging.info(f"[1/4] Loading data from {input_path}, tags: {tags}")
-
+def read(input_path, tags, mode, limit_area=None) -> tuple:
+    """
+    Read rings from way, relations and all the ways for relation members from osm.pbf file.
+    """
     start_time = time.time()
-    area_handler = RingHandler(tags, mode)
-    area_handler.apply_file(input_path, idx="flex_mem", locations=True)
+    area_handler = read_tables(input_path, tags, mode, limit_area=limit_area)
+    way_rings = filter_way_rings(area_handler.way_rings.to_geodataframe())
     logging.debug(f"Get data completed, taking {time.time() - start_time} seconds")
-    #######################################################################################
-    # 2. Get data prepared
-    logging.info(f"[2/4] Preparing data with intersecting with relation id {limit_relation_id}")
-    way_rings = geopandas.GeoDataFrame([vars(i) for i in area_handler.way_rings])
-    relation_dict = area_handler.relation_dict
-    way_dict = area_handler.way_dict
-    
-
-    # Prepare data with limit area and free memory
-    del area_handler
-    if ALL_OFFLINE:
-        logging.debug("Detect all offline mode on, using offline file to load limit area")
-        limit_area = LimitAreaUtils.get_limit_relation_geom(input_path, limit_relation_id)
-    else:
-        logging.debug("Detect all offline mode off, using api to load limit area")
-        limit_area = LimitAreaUtils.get_relation_polygon_with_overpy(limit_relation_id)
+    return way_rings, area_handler.relation_dict, area_handler.way_dict
+
+
+def read_tables(input_path, tags, mode, memory_budget=None, spill_path=None, limit_area=None, keep_tags=False) -> RingHandler:
+    """
+    With memory_budget, way rings are spilled to disk and only relation member ways are kept for look up,
+    which takes one more pass on relations. With limit_area, ways and areas outside its boxes are skipped.
+    With keep_tags, values of tags are kept for filtering in memory, see RingHandler.
+    """
+    member_ids = None
+    if memory_budget:
+        relation_handler = ExtractRelationHandler(tags, set())
+        relation_handler.apply_file(input_path)
+        member_ids = relation_handler.way_ids
+    box_filter = BoxFilter.from_limit_area(limit_area) if limit_area is not None else None
+    area_handler = RingHandler(tags, mode, memory_budget, spill_path, member_ids, box_filter, keep_tags)
+    apply_file(area_handler, input_path, spill_path)
+    return area_handler
 
+
+HEADER = ["POLYGON_ID", "POLYGON_NAME", "HOFN_TYPE", "ROAD_LEVEL", "geometry"]
+OUTPUT_HEADER = ["POLYGON_ID", "POLYGON_NAME", "geometry", "HOFN_TYPE", "ROAD_LEVEL"]  # Column order of output files, whichever path made the rings.
+
+
+def get_output_columns(data) -> geopandas.GeoDataFrame:
+    if data.empty:
+        return geopandas.GeoDataFrame(columns=OUTPUT_HEADER, geometry="geometry")
+    return data[OUTPUT_HEADER]
+
+
+def filter_way_rings(way_rings, columns=()) -> geopandas.GeoDataFrame:
+    way_rings = way_rings[HEADER + list(columns)]
+    # All area from way is one polygon (len(geometry) == 1)
+    way_rings["geometry"] = way_rings.geometry.apply(lambda geometry: geometry.geoms[0])  # Extract polygon from multipolygon
+    return way_rings[way_rings.geometry.area * 6371000 * math.pi / 180 * 6371000 * math.pi / 180 > 200 * 200]
+
+
+def prepare(way_rings, relation_dict, way_dict, limit_area, hilbert_order=False) -> tuple:
+    """
+    Limit rings from way and relation members with limit area, restructure relation members for merging.
+    With hilbert_order, way rings are sorted by Hilbert index of their bbox centers first, so row ranges of workers are spatially compact.
+    """
     logging.info("Preparing way data.")
-    pool = multiprocessing.Pool(cpu_count)
-    way_sub_rings = numpy.array_split(way_rings, cpu_count)
-    result_list = pool.starmap(LimitAreaUtils.prepare_data, zip(way_sub_rings, repeat(limit_area.wkt)))
-    pool.close()
-    way_rings = geopandas.GeoDataFrame()
-    for result in result_list:
-        way_rings = pandas.concat([way_rings, result])
-    way_rings.to_file(f"{output_path}/way_water.geojson", driver="GeoJSON", encoding="utf-8")
+    way_rings = HilbertUtils.sort(way_rings) if hilbert_order else way_rings
+    executor = get_executor()
+    # Geometries are passed to workers in shared memory, only row ranges go in and row positions come back.
+    geometries = SharedGeometries(way_rings.geometry.values)
+    try:
+        ranges = [(rows[0], rows[-1] + 1) for rows in numpy.array_split(numpy.arange(len(way_rings)), executor.workers) if len(rows)]
+        result_list = executor.starmap(LimitAreaUtils.get_intersects_indices, [(geometries, start, end, limit_area.wkt) for start, end in ranges])
+    finally:
+        geometries.close()
+    way_rings = way_rings.iloc[numpy.concatenate(result_list)] if result_list else way_rings.iloc[:0]
+    return way_rings, prepare_relations(relation_dict, way_dict, limit_area)
 
+
+def prepare_relations(relation_dict, way_dict, limit_area) -> dict:
     logging.info("Preparing relation data.")
     # Prepare relation data.
     relation_members: list = RingUtils.get_relation_member_data(relation_dict, way_dict, tags=["outer", "inner", ""])
+    if not relation_members:  # No relations in small subsets, an empty GeoDataFrame has no geometry column.
+        return dict()
     # Intersect with limit area to limit geometries.
     relation_member_data: geopandas.GeoDataFrame = geopandas.GeoDataFrame(relation_members)
     relation_member_data = LimitAreaUtils.prepare_data(relation_member_data, limit_area.wkt)
     # Restructure as dict for iteration.
     relation_member_dict = relation_member_data.to_dict("index")
-    relation_member_dict = RingUtils.restructure(relation_member_dict)
-    #######################################################################################
-    # 3.Merging rings
-    logging.info(f"[3/4] Merging rings with outer and inner rings, and extract inner rings as islands.")
-    pool = multiprocessing.Pool(cpu_count)
-    manager = multiprocessing.Manager()
-    polygon_id_used_table = manager.list()
+    return RingUtils.restructure(relation_member_dict)
 
-    # Avoid duplicate POLYGON_ID (WAY_ID)
-    polygon_id_used_table += list(way_rings["POLYGON_ID"].values)
 
+def merge(way_rings, relation_member_dict, mode) -> tuple:
+    """
+    Merge relation outer rings, and inner rings as islands in water mode.
+    Relations are merged in workers, POLYGON_ID are chosen after in relation order, so they do not depend on workers.
+    """
+    executor = get_executor()
+    relation_member_sub_dicts = [item for item in MPUtils.chunks(relation_member_dict, max(int(len(relation_member_dict) / executor.workers), 1))]
+    merged_chunks = executor.starmap(RingUtils.get_rings_merged_results, zip(relation_member_sub_dicts, repeat(mode)))
+
+    # Avoid duplicate POLYGON_ID (WAY_ID)
+    used_ids = set(way_rings["POLYGON_ID"].values)
     # Results with rings and islands
-    relation_result = manager.list()
-    islands = manager.list()
+    relation_result, islands = [], []
+    for merged_chunk in merged_chunks:
+        for is_island, merged_ids, candidates in merged_chunk:
+            rings = RingUtils.choose_polygon_ids(merged_ids, candidates, used_ids)
+            if is_island:
+                RingUtils.islands_extracting(rings, islands)
+            else:
+                relation_result += rings
+    return relation_result, islands
 
-    relation_member_sub_dicts = [item for item in MPUtils.chunks(relation_member_dict, int(len(relation_member_dict) / cpu_count))]
-    pool.starmap(RingUtils.get_rings_merged_results, zip(relation_member_sub_dicts, repeat(relation_result), repeat(islands), repeat(polygon_id_used_table), repeat(mode)))
-    pool.close()
-    islands = list(islands)
-    relation_result = list(relation_result)
 
-    logging.debug("outer and inner merge process completed.")
-    #######################################################################################
-    # 4. polygonized data and output.
-    logging.info("[4/4] Polygonizing data and output.")
+def polygonize(way_rings, relation_result, islands, mode) -> tuple:
+    """
+    Polygonize rings and islands, remove unpolygonizable and small ones.
+    """
+    IS_WATER = True if mode == "water" else False
     if IS_WATER:
-        remove_id_list = []
-        islands = geopandas.GeoDataFrame(islands)
-        islands["geometry"] = islands.apply(lambda row: RingUtils.polygonize_with_try_catch(row, remove_id_list), axis=1)
-        islands = islands[~islands.POLYGON_ID.isin(remove_id_list)]
-        logging.debug(f"Remove {remove_id_list}  due to unpolygonizable issue.")
+        islands = geopandas.GeoDataFrame(islands) if len(islands) else geopandas.GeoDataFrame(columns=HEADER, geometry="geometry")  # Written with header.
+        if not islands.empty:
+            islands, rejected = RingUtils.polygonize_rings(islands, area_threshold=200 * 200)
+            log_rejected(rejected)
         logging.debug("islands polygonized done")
-        islands = islands[islands.geometry.area * 6371000 * math.pi / 180 * 6371000 * math.pi / 180 > 200 * 200]
-        if DEBUGGING:
-            islands.to_file(f"{island_output_path}/island.geojson", driver="GeoJSON", encoding="utf-8")
-        else:
-            islands.to_csv(f"{island_output_path}/island.tsv", sep="\t", index=False)
-            islands.to_file(f"{island_output_path}/island.geojson", driver="GeoJSON", encoding="utf-8")
-
-    remove_id_list = []
-    rings = geopandas.GeoDataFrame(relation_result)
-    rings = pandas.concat([rings, way_rings])
-    rings["geometry"] = rings.apply(lambda row: RingUtils.polygonize_with_try_catch(row, remove_id_list), axis=1)
-    rings = rings[~rings["POLYGON_ID"].isin(remove_id_list)]
-    logging.debug(f"Remove {remove_id_list}  due to unpolygonizable issue.")
+    else:
+        islands = None
+
+    rings = polygonize_rings(pandas.concat([geopandas.GeoDataFrame(relation_result), way_rings]))
+    return rings, islands
+
+
+def polygonize_rings(rings) -> geopandas.GeoDataFrame:
+    if rings.empty:
+        return rings
+    rings, rejected = RingUtils.polygonize_rings(rings, area_threshold=200 * 200)
+    log_rejected(rejected)
     logging.debug("rings polygonized done.")
+    return rings
 
-    rings = rings[(rings["geometry"].area * 6371000 * math.pi / 180 * 6371000 * math.pi / 180) > 200 * 200]
 
+def log_rejected(rejected):
+    for reason, group in rejected.groupby("reason"):
+        logging.debug(f"Remove {list(group['POLYGON_ID'])} due to {reason}.")
 
+
+def simplify(rings, islands, mode, SIMPLIFY=None) -> tuple:
+    """
+    Simplify rings and islands with tolerance of mode and of island in SIMPLIFY, meters.
+    """
+    return SimplifyUtils.simplify(rings, SimplifyUtils.get_tolerance(SIMPLIFY, mode), mode), \
+        SimplifyUtils.simplify(islands, SimplifyUtils.get_tolerance(SIMPLIFY, "island"), "island")
+
+
+def output(rings, islands, output_path, island_output_path, mode, DEBUGGING=False, append=False, hilbert_order=False):
+    """
+    With append, rings are appended to the output files written before, used in streaming mode.
+    Islands are only produced by relations, always written at once.
+    With hilbert_order, rings and islands are written in Hilbert order of their bbox centers.
+    Files are written in background by the artifact writer, flush it before reading them.
+    """
+    write_mode = "a" if append else "w"
+    rings = get_output_columns(rings)
+    if hilbert_order:
+        rings, islands = HilbertUtils.sort(rings), HilbertUtils.sort(islands)
+    if islands is not None:
+        output_islands(islands, island_output_path, DEBUGGING)
+
+    writer = get_writer()
     if DEBUGGING:
-        rings.to_file(f"{output_path}/{mode}.geojson", driver="GeoJSON", encoding="utf-8")
+        writer.to_file(rings, f"{output_path}/{mode}.geojson", driver="GeoJSON", encoding="utf-8", mode=write_mode)
     else:
-        rings.to_csv(f"{output_path}/{mode}.tsv", sep="\t", index=False)
-        rings.to_file(f"{output_path}/{mode}.geojson", driver="GeoJSON", encoding="utf-8")
+        writer.to_csv(rings, f"{output_path}/{mode}.tsv", sep="\t", index=False, mode=write_mode, header=not append)
+        writer.to_file(rings, f"{output_path}/{mode}.geojson", driver="GeoJSON", encoding="utf-8", mode=write_mode)
+
 
+def output_islands(islands, island_output_path, DEBUGGING=False):
+    islands = get_output_columns(islands)
+    writer = get_writer()
+    if DEBUGGING:
+        writer.to_file(islands, f"{island_output_path}/island.geojson", driver="GeoJSON", encoding="utf-8")
+    else:
+        writer.to_csv(islands, f"{island_output_path}/island.tsv", sep="\t", index=False)
+        writer.to_file(islands, f"{island_output_path}/island.geojson", driver="GeoJSON", encoding="utf-8")
+
+
+def stream(input_path, output_path, island_output_path, limit_area, mode, tags, DEBUGGING=False, MEMORY_BUDGET=None, SPILL_PATH=None, SIMPLIFY=None,
+           HILBERT_ORDER=False):
+    """
+    Limit, polygonize and output way rings chunk by chunk, then merge relations and append them.
+    """
+    area_handler = read_tables(input_path, tags, mode, MEMORY_BUDGET, SPILL_PATH, limit_area)
+    logging.info(f"Way rings spilled into {len(area_handler.way_rings.chunks)} chunks.")
+    way_ring_ids = []
+    appended = False
+    for way_rings in area_handler.way_rings.iter_geodataframes():
+        way_rings = LimitAreaUtils.prepare_data(filter_way_rings(way_rings), limit_area.wkt)
+        way_ring_ids += list(way_rings["POLYGON_ID"].values)
+        rings, _ = simplify(polygonize_rings(way_rings), None, mode, SIMPLIFY)
+        if not rings.empty:
+            output(rings, None, output_path, island_output_path, mode, DEBUGGING, appended, HILBERT_ORDER)
+            appended = True
+    area_handler.way_rings.close()
+    logging.info(f"[3/4] Merging rings with outer and inner rings, and extract inner rings as islands.")
+    relation_member_dict = prepare_relations(area_handler.relation_dict, area_handler.way_dict, limit_area)
+    relation_result, islands = merge(pandas.DataFrame({"POLYGON_ID": way_ring_ids}), relation_member_dict, mode)
+    logging.info("[4/4] Polygonizing data and output.")
+    rings, islands = simplify(*polygonize(geopandas.GeoDataFrame(), relation_result, islands, mode), mode, SIMPLIFY)
+    if not rings.empty or not appended:
+        output(rings, None, output_path, island_output_path, mode, DEBUGGING, appended, HILBERT_ORDER)
+    if islands is not None:
+        output_islands(HilbertUtils.sort(islands) if HILBERT_ORDER else islands, island_output_path, DEBUGGING)
+
+
+# %%
+def main(input_path, output_path, nation, limit_relation_id, mode, tags, DEBUGGING=False, ALL_OFFLINE=False, MEMORY_BUDGET=None, SPILL_PATH=None,
+         CHECKPOINT_PATH=None, FORCE_STAGES=None, SKIP_STAGES=None, SIMPLIFY=None, HILBERT_ORDER=False, WITHIN=None):
+    island_output_path = f"data/output/{nation}/island/"
+    if not os.path.isdir(island_output_path):
+        os.makedirs(island_output_path)
+    if MEMORY_BUDGET:
+        logging.info(f"Start extracting rings in streaming mode ...")
+        logging.info(f"[1/4] Loading data from {input_path}, tags: {tags}")
+        limit_area = LimitAreaUtils.get_limit_area(input_path, limit_relation_id, ALL_OFFLINE, WITHIN)
+        logging.info(f"[2/4] Preparing and output way rings chunk by chunk with relation id {limit_relation_id}")
+        stream(input_path, output_path, island_output_path, limit_area, mode, tags, DEBUGGING, MEMORY_BUDGET, SPILL_PATH, SIMPLIFY, HILBERT_ORDER)
+        logging.info("rings process completed.")
+        return
+    # Stages are checkpointed under CHECKPOINT_PATH, a rerun resumes from the first changed stage.
+    pipeline = Pipeline(input_path, CHECKPOINT_PATH, FORCE_STAGES, SKIP_STAGES, name=f"{mode}.{limit_relation_id}")
+    simplified = bool(SimplifyUtils.get_tolerance(SIMPLIFY, mode) or SimplifyUtils.get_tolerance(SIMPLIFY, "island"))  # Otherwise simplify passes through, nothing to save.
+    #######################################################################################
+    # 1. Get coastlines data from osm.pbf file
+    logging.info(f"Start extracting rings ...")
+    logging.info(f"[1/4] Loading data from {input_path}, tags: {tags}")
+    pipeline.add("limit_area", lambda: LimitAreaUtils.get_limit_area(input_path, limit_relation_id, ALL_OFFLINE, WITHIN),  # Its boxes filter ways and areas when reading.
+                 params={"limit_relation_id": limit_relation_id, "ALL_OFFLINE": ALL_OFFLINE, "WITHIN": WITHIN})
+    pipeline.add("read", lambda limit_area: read(input_path, tags, mode, limit_area), inputs=["limit_area"], params={"tags": tags, "mode": mode})
+    #######################################################################################
+    # 2. Get data prepared
+    def prepare_stage(read_result, limit_area):
+        logging.info(f"[2/4] Preparing data with intersecting with relation id {limit_relation_id}")
+        way_rings, relation_member_dict = prepare(*read_result, limit_area, HILBERT_ORDER)
+        if DEBUGGING:
+            get_writer().to_file(way_rings, f"{output_path}/way_water.geojson", driver="GeoJSON", encoding="utf-8")
+        return way_rings, relation_member_dict
+    pipeline.add("prepare", prepare_stage, inputs=["read", "limit_area"], params={"HILBERT_ORDER": HILBERT_ORDER})
+    #######################################################################################
+    # 3.Merging rings
+    def merge_stage(prepared):
+        logging.info(f"[3/4] Merging rings with outer and inner rings, and extract inner rings as islands.")
+        return merge(*prepared, mode)
+    pipeline.add("merge", merge_stage, inputs=["prepare"], params={"mode": mode})
+    #######################################################################################
+    # 4. polygonized data and output.
+    def polygonize_stage(prepared, merged):
+        logging.info("[4/4] Polygonizing data and output.")
+        return polygonize(prepared[0], *merged, mode)
+    pipeline.add("polygonize", polygonize_stage, inputs=["prepare", "merge"], params={"mode": mode})
+    # Optional topology-preserving simplification, tolerance per mode in SIMPLIFY.
+    pipeline.add("simplify", lambda polygonized: simplify(*polygonized, mode, SIMPLIFY), inputs=["polygonize"], params={"mode": mode, "SIMPLIFY": SIMPLIFY},
+                 persist=simplified, skippable=True)
+    pipeline.add("output", lambda simplified: output(*simplified, output_path, island_output_path, mode, DEBUGGING, hilbert_order=HILBERT_ORDER), inputs=["simplify"],
+                 params={"output_path": output_path, "DEBUGGING": DEBUGGING, "HILBERT_ORDER": HILBERT_ORDER}, persist=False, skippable=True)
+    pipeline.run("output")
     logging.info("rings process completed.")
-    sys.exit(0)
+
+
+def main_nations(input_path, nations: dict, mode, tags, DEBUGGING=False, ALL_OFFLINE=False, CHECKPOINT_PATH=None, FORCE_STAGES=None, SKIP_STAGES=None,
+                 SIMPLIFY=None, HILBERT_ORDER=False, WITHIN=None):
+    """
+    Extract rings of several nations, nation -> (limit relation id, output path), from one pass on a large file.
+    Way rings are routed to nations by their limit areas, relation members are limited per nation.
+    """
+    limit_relation_ids = {nation: limit_relation_id for nation, (limit_relation_id, _) in nations.items()}
+    pipeline = Pipeline(input_path, CHECKPOINT_PATH, FORCE_STAGES, SKIP_STAGES, name=f"{mode}.{'-'.join(nations.keys())}")
+    simplified = bool(SimplifyUtils.get_tolerance(SIMPLIFY, mode) or SimplifyUtils.get_tolerance(SIMPLIFY, "island"))  # Otherwise simplify passes through, nothing to save.
+    logging.info(f"Start extracting rings of {list(nations.keys())} ...")
+    logging.info(f"[1/4] Loading data from {input_path}, tags: {tags}")
+    pipeline.add("limit_area", lambda: LimitAreaUtils.get_limit_areas(input_path, limit_relation_ids, ALL_OFFLINE, WITHIN),
+                 params={"limit_relation_ids": limit_relation_ids, "ALL_OFFLINE": ALL_OFFLINE, "WITHIN": WITHIN})
+    pipeline.add("read", lambda limit_areas: read(input_path, tags, mode, LimitAreaUtils.get_combined_area(limit_areas)), inputs=["limit_area"],
+                 params={"tags": tags, "mode": mode})
+    pipeline.add("route", lambda read_result, limit_areas: LimitAreaUtils.get_nation_indices(read_result[0].geometry.values, limit_areas),
+                 inputs=["read", "limit_area"])
+    for nation, (_, output_path) in nations.items():
+        island_output_path = f"data/output/{nation}/island/"
+        if not os.path.isdir(island_output_path):
+            os.makedirs(island_output_path)
+
+        def prepare_stage(read_result, limit_areas, routed, nation=nation, output_path=output_path):
+            logging.info(f"[2/4] Preparing data of {nation}.")
+            way_rings, relation_dict, way_dict = read_result
+            way_rings = HilbertUtils.sort(way_rings.iloc[routed[nation]]) if HILBERT_ORDER else way_rings.iloc[routed[nation]]
+            if DEBUGGING:
+                get_writer().to_file(way_rings, f"{output_path}/way_water.geojson", driver="GeoJSON", encoding="utf-8")
+            return way_rings, prepare_relations(relation_dict, way_dict, limit_areas[nation])
+        pipeline.add(f"prepare.{nation}", prepare_stage, inputs=["read", "limit_area", "route"], params={"HILBERT_ORDER": HILBERT_ORDER})
+        pipeline.add(f"merge.{nation}", lambda prepared: merge(*prepared, mode), inputs=[f"prepare.{nation}"], params={"mode": mode})
+        pipeline.add(f"polygonize.{nation}", lambda prepared, merged: polygonize(prepared[0], *merged, mode), inputs=[f"prepare.{nation}", f"merge.{nation}"],
+                     params={"mode": mode})
+        pipeline.add(f"simplify.{nation}", lambda polygonized: simplify(*polygonized, mode, SIMPLIFY), inputs=[f"polygonize.{nation}"],
+                     params={"mode": mode, "SIMPLIFY": SIMPLIFY}, persist=simplified, skippable=True)
+        pipeline.add(f"output.{nation}", lambda simplified, output_path=output_path, island_output_path=island_output_path:
+                     output(*simplified, output_path, island_output_path, mode, DEBUGGING, hilbert_order=HILBERT_ORDER), inputs=[f"simplify.{nation}"],
+                     params={"output_path": output_path, "DEBUGGING": DEBUGGING, "HILBERT_ORDER": HILBERT_ORDER}, persist=False, skippable=True)
+    for nation in nations.keys():
+        logging.info(f"[3/4] Merging rings of {nation}, [4/4] polygonizing and output.")
+        pipeline.run(f"output.{nation}")
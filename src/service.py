@@ -0,0 +1,243 @@
+"""
+Resident extraction service, keep feature tables, limit area and spatial indexes of one nation in memory,
+answer extraction requests over local HTTP or Unix socket.
+
+POST /extract  {"hofn_type": "7", "tags": {"highway": ["motorway"]}, "divide": ["123"]}
+POST /load     {"hofn_types": ["1", "7"]}
+GET  /status
+"""
+import json
+import logging
+import os
+import socketserver
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src.config import get_config
+from src.enum import HofnType, Tag
+from src.writer import get_writer
+
+
+class ExtractionService:
+    def __init__(self, input_path, nation, limit_relation_id, ALL_OFFLINE=True, DEBUGGING=False, EXTRACT_CACHE=False):
+        config = get_config()
+        self.input_path = input_path
+        self.nation = nation
+        self.limit_relation_id = limit_relation_id
+        self.ALL_OFFLINE = ALL_OFFLINE
+        self.DEBUGGING = DEBUGGING
+        self.EXTRACT_CACHE = EXTRACT_CACHE
+        self.output_root = f"{config.get('path').get('output')}/{nation}"
+        self.rings_mode = config.get("mode").get("rings")
+        self.lines_mode = config.get("mode").get("lines")
+        self.highways_level = config.get("highways")
+        self.snap_distance = config.get("snap_distance")
+        self.tile_size = config.get("tile_size")
+        self.simplify = config.get("simplify")  # Outputs are simplified and ordered as get_data does under the same config.
+        self.hilbert_order = config.get("hilbert_order")
+        self.limit_area = None
+        # mode -> (superset tags, prepared tables with tag values), read once with the union of default and requested tags.
+        self.supersets = dict()
+        # (mode, tags) -> prepared tables filtered from superset, geopandas keeps built sindex on the GeoDataFrame.
+        self.prepared = dict()
+        # (mode, tags) -> merged lines, base of DIVIDE.
+        self.merged = dict()
+        self.lock = threading.Lock()  # Stages use process pools, run one request at a time.
+
+    @staticmethod
+    def get_key(mode, tags):
+        return mode, json.dumps(tags, sort_keys=True)
+
+    def get_limit_area(self):
+        if self.limit_area is None:
+            from src.utils import LimitAreaUtils
+            self.limit_area = LimitAreaUtils.get_limit_area(self.input_path, self.limit_relation_id, self.ALL_OFFLINE)
+        return self.limit_area
+
+    def get_input_path(self, mode, tags):
+        if not self.EXTRACT_CACHE:
+            return self.input_path
+        from src.utils import ExtractUtils
+        return ExtractUtils.get_filtered_extract(self.input_path, mode, tags, [self.limit_relation_id])
+
+    def get_superset(self, mode, tags):
+        """
+        Tables of mode read with the union of default tags, tags and the loaded superset, keeping tag values.
+        The file is read again only when tags allow a key or value outside the loaded superset.
+        """
+        from src.utils import TagUtils
+        loaded, prepared = self.supersets.get(mode, (dict(), None))
+        superset = TagUtils.get_superset([Tag[mode].value, tags, loaded])
+        if superset == loaded:
+            return superset, prepared
+        start_time = time.time()
+        input_path = self.get_input_path(mode, superset)
+        limit_area = self.get_limit_area()
+        if mode in self.rings_mode:
+            import src.rings as rings
+            area_handler = rings.read_tables(input_path, superset, mode, limit_area=limit_area, keep_tags=True)
+            way_rings = rings.filter_way_rings(area_handler.way_rings.to_geodataframe(), TagUtils.get_columns(superset))
+            prepared = (*rings.prepare(way_rings, area_handler.relation_dict, area_handler.way_dict, limit_area, self.hilbert_order), area_handler.relation_tags)
+        elif mode in self.lines_mode:
+            import src.lines as lines
+            lines_table, relation_member_dict, relation_tags = lines.read_table(input_path, mode, superset, self.highways_level if mode == "highway" else None,
+                                                                                limit_area=limit_area, keep_tags=True)
+            lines_df = lines_table.to_geodataframe()[lines.HEADER + TagUtils.get_columns(superset)]
+            prepared = (*lines.prepare(lines_df, relation_member_dict, limit_area, mode, self.hilbert_order), relation_tags)
+        else:
+            raise ValueError(f"Mode {mode} is not supported.")
+        self.supersets[mode] = superset, prepared
+        self.prepared = {key: value for key, value in self.prepared.items() if key[0] != mode}
+        logging.info(f"Loaded {mode} with tags {superset}, taking {time.time() - start_time} seconds")
+        return superset, prepared
+
+    def get_prepared(self, mode, tags):
+        """
+        Prepared tables of mode matching tags, filtered in memory from the superset of mode. Buildings are not read by tags, one per mode.
+        """
+        key = self.get_key(mode, dict() if mode == "building" else tags)
+        if key in self.prepared:
+            return self.prepared[key]
+        start_time = time.time()
+        if mode == "building":
+            import src.buildings as buildings
+            limit_area = self.get_limit_area()
+            way_buildings, relation_dict, way_dict = buildings.read(self.get_input_path(mode, Tag[mode].value), limit_area=limit_area)
+            prepared = buildings.prepare(way_buildings, relation_dict, way_dict, limit_area)
+        else:
+            from src.utils import TagUtils, is_tags_matched
+            superset, (data, relations, relation_tags) = self.get_superset(mode, tags)
+            columns = [column for column in data.columns if not column.startswith("tag:")]
+            data = data[TagUtils.get_mask(data, tags)][columns]
+            relations = {relation_id: relation for relation_id, relation in relations.items() if is_tags_matched(relation_tags.get(relation_id, dict()), tags)}
+            if mode in self.lines_mode:  # Member lines of highway relations also match tags.
+                relations = {relation_id: relation[TagUtils.get_mask(relation, tags)][columns].reset_index(drop=True) for relation_id, relation in relations.items()}
+                relations = {relation_id: relation for relation_id, relation in relations.items() if len(relation)}
+            prepared = data, relations
+        self.prepared[key] = prepared
+        logging.info(f"Prepared {mode} with tags {tags}, taking {time.time() - start_time} seconds")
+        return prepared
+
+    def load(self, hofn_types):
+        with self.lock:
+            for hofn_type in hofn_types:
+                mode = HofnType(hofn_type).name
+                self.get_prepared(mode, Tag[mode].value)
+
+    def extract(self, hofn_type, tags=None, divide=None) -> dict:
+        mode = HofnType(hofn_type).name
+        tags = Tag.group_arguments(tags) if isinstance(tags, list) else tags or Tag[mode].value
+        output_path = f"{self.output_root}/{mode}"
+        if not os.path.isdir(output_path):
+            os.makedirs(output_path)
+        with self.lock:
+            start_time = time.time()
+            prepared = self.get_prepared(mode, tags)
+            if mode in self.rings_mode:
+                import src.rings as rings
+                island_output_path = f"{self.output_root}/island"
+                if not os.path.isdir(island_output_path):
+                    os.makedirs(island_output_path)
+                way_rings, relation_member_dict = prepared
+                relation_result, islands = rings.merge(way_rings, relation_member_dict, mode)
+                result, islands = rings.simplify(*rings.polygonize(way_rings, relation_result, islands, mode), mode, self.simplify)
+                rings.output(result, islands, output_path, island_output_path, mode, self.DEBUGGING, hilbert_order=self.hilbert_order)
+            elif mode in self.lines_mode:
+                import src.lines as lines
+                key = self.get_key(mode, tags)
+                data_from_way, relations = prepared
+                if key not in self.merged or not divide:
+                    levels = Tag.get_levels(mode, self.highways_level) if mode == "highway" else [0]
+                    self.merged[key] = lines.merge(data_from_way, relations, mode, levels, self.snap_distance)
+                result = self.merged[key]
+                if divide:
+                    result = lines.divide(result, data_from_way, divide)
+                result = lines.simplify(result, mode, self.simplify)
+                lines.output(result, output_path, mode, self.DEBUGGING, hilbert_order=self.hilbert_order)
+            else:
+                import pandas
+                import src.buildings as buildings
+                way_buildings_gdf, relation_member_dict = prepared
+                result = pandas.concat([way_buildings_gdf, buildings.merge(relation_member_dict)], ignore_index=True)
+                partition_writer = buildings.PartitionWriter(output_path, self.DEBUGGING, self.tile_size, self.hilbert_order)
+                partition_writer.write_tiles(result)
+                partition_writer.close()
+            get_writer().flush()  # Outputs are complete when answering.
+            return {"mode": mode, "tags": tags, "output_path": output_path, "rows": len(result), "seconds": time.time() - start_time}
+
+    def status(self) -> dict:
+        return {"input": self.input_path, "nation": self.nation, "limit_relation_id": self.limit_relation_id,
+                "limit_area_loaded": self.limit_area is not None,
+                "loaded": [{"mode": mode, "tags": json.loads(tags)} for mode, tags in self.prepared.keys()],
+                "supersets": {mode: superset for mode, (superset, _) in self.supersets.items()}}
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def get_handler_class(service: ExtractionService):
+    class Handler(BaseHTTPRequestHandler):
+        def _respond(self, status, body: dict):
+            data = json.dumps(body, default=str).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _read_json(self) -> dict:
+            length = int(self.headers.get("Content-Length", 0))
+            return json.loads(self.rfile.read(length) or b"{}")
+
+        def do_GET(self):
+            if self.path == "/status":
+                self._respond(200, service.status())
+            else:
+                self._respond(404, {"error": f"{self.path} not found"})
+
+        def do_POST(self):
+            try:
+                body = self._read_json()
+                if self.path == "/extract":
+                    self._respond(200, service.extract(body["hofn_type"], body.get("tags"), body.get("divide")))
+                elif self.path == "/load":
+                    service.load(body.get("hofn_types", []))
+                    self._respond(200, service.status())
+                else:
+                    self._respond(404, {"error": f"{self.path} not found"})
+            except (KeyError, ValueError) as e:
+                self._respond(400, {"error": repr(e)})
+            except Exception as e:
+                logging.error(traceback.format_exc())
+                self._respond(500, {"error": repr(e)})
+
+        def address_string(self):
+            return self.client_address[0] if self.client_address else "unix"
+
+        def log_message(self, format, *args):
+            logging.debug(f"{self.address_string()} - {format % args}")
+
+    return Handler
+
+
+def serve(service: ExtractionService, host="127.0.0.1", port=8765, socket_path=None):
+    handler = get_handler_class(service)
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        httpd = UnixHTTPServer(socket_path, handler)
+        logging.info(f"Extraction service listening on unix socket {socket_path}")
+    else:
+        httpd = ThreadingHTTPServer((host, port), handler)
+        logging.info(f"Extraction service listening on http://{host}:{port}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
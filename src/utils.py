@@ -1,38 +1,64 @@
+import hashlib
+import json
 import logging
 import math
 import multiprocessing
+import os
 import time
 from itertools import islice
 from typing import Dict, List
 import geopandas
 import numpy
-import overpy
 import pandas
+import shapely
 import shapely.ops
 import osmium
+from osmium.index import IdSet
 from shapely.geometry import LineString, Polygon, Point, MultiPolygon
 from shapely.ops import linemerge, unary_union, polygonize
 from shapely import wkt
-from src.models import HofnData
+from src.models import FeatureTable, HofnData, RelationMember, to_fixed_lines, from_fixed_lines, COORDINATE_PRECISION
 from src.enum import HofnType
+from src.overpass import get_client
+from src.reader import apply_file
 
 
-def reverse_linestring_coords(geometry):
+# Tags: 1. Value 2. list 3. "" (purely take all the tags)
+def is_tags_matched(osm_tags, tags: dict) -> bool:
+    for key, value in tags.items():
+        tag_value = osm_tags.get(key)
+        if tag_value is None:
+            continue
+        if type(value) == list:
+            if tag_value in value:
+                return True
+        elif value == "" or tag_value == value:
+            return True
+    return False
+
 
-    reverse = geometry
-    reverse.coords = list(reverse.coords)[::-1]
-    return reverse
+# Lines are LineString, or int32 (N, 2) fixed-point coords array while merging.
+def get_endpoints(line) -> tuple:
+    if isinstance(line, numpy.ndarray):
+        return line[0].tobytes(), line[-1].tobytes()  # exact and hashable
+    return line.coords[0], line.coords[-1]
+
+
+def reverse_linestring_coords(geometry):
+    if isinstance(geometry, numpy.ndarray):
+        return geometry[::-1]
+    return LineString(list(geometry.coords)[::-1])  # geometries are immutable
 
 
 def is_continuous(line1, line2):
-    head, tail = line1.coords[0], line1.coords[-1]
-    compare_head, compare_tail = line2.coords[0], line2.coords[-1]
+    head, tail = get_endpoints(line1)
+    compare_head, compare_tail = get_endpoints(line2)
     return head == compare_tail or tail == compare_head
 
 
 def is_reverse_needed(line1, line2):
-    head, tail = line1.coords[0], line1.coords[-1]
-    compare_head, compare_tail = line2.coords[0], line2.coords[-1]
+    head, tail = get_endpoints(line1)
+    compare_head, compare_tail = get_endpoints(line2)
     return head == compare_head or tail == compare_tail
 
 
@@ -41,6 +67,9 @@ def lonlat_length_in_km(geom):
 
 
 def linemerge_by_wkt(line1, line2) -> LineString:
+    if isinstance(line1, numpy.ndarray):
+        source, target = (line1, line2) if get_endpoints(line1)[1] == get_endpoints(line2)[0] else (line2, line1)
+        return numpy.concatenate([source[:-1], target])
     line1_coords = line1.coords[:]
     line2_coords = line2.coords[:]
     source, target = (line1, line2) if line1_coords[-1] == line2_coords[0] else (line2, line1)
@@ -60,54 +89,54 @@ def brute_force_merge(line1,line2,from_tail=True) -> LineString:
 
 class LineUtils:
 
-    def merge_by_intersects(unmerged_level_roads:geopandas.GeoDataFrame,id_used_list=False):    
-        unmerged_way = unmerged_level_roads.copy(deep=True) # copy to avoid changing original data, original data will used to check what id is used
-        unmerged_way = unmerged_way.reset_index(drop=True) # reset index for loc issue, sindex intersects will check for labeled index. 
-        result = [] # Generate geodataframe result
-        
-        # Prepare init iteration
-        processing, unmerged_way = unmerged_way.iloc[-1], unmerged_way.iloc[:-1] # pop row to processing
-        index_used_list = [processing.name] # init index used list with init line
-        if unmerged_way.empty: # if unmerged_way is empty, return processing
-            result.append(processing)
-            return result
-
-
-        while len(unmerged_way) > 0:
-            
-            got_merged = False # Flag to check if line is merged
-
-            possible_matches_index = unmerged_way.sindex.query(processing.geometry, predicate='intersects') # Get a list of labeled index that intersect with processing line
-            precise_matches_index = [i for i in possible_matches_index if i not in index_used_list]
-            precise_matches = unmerged_way.loc[precise_matches_index] # Using labeled index to find precise matches
-            precise_matches = precise_matches.to_dict("index") # convert into dict to apply performance.
-            
-            # Merge the lines that intersect with the processing line
-            for row_index,row in precise_matches.items():
-                row_geometry = row["geometry"]
-                if is_reverse_needed(processing.geometry, row_geometry):
-                    row_geometry = reverse_linestring_coords(row_geometry)
-                if is_continuous(processing.geometry, row_geometry):
-                    processing.geometry = linemerge_by_wkt(processing.geometry, row_geometry)
-
-                    index_used_list.append(row_index)
-                    got_merged = True
-
-            if got_merged: 
-                continue  # If the processing line is merged, continue to the next loop
-            
-            # If the processing line is not merged, add it to the result
-            result.append(processing)   
-            unmerged_way = unmerged_way[~unmerged_way.index.isin(index_used_list)]
-            
-            # If there are lines to process, continue with last element
-            if not unmerged_way.empty:
-                processing, unmerged_way = unmerged_way.iloc[-1], unmerged_way.iloc[:-1] # pop last row to processing
-                index_used_list.append(processing.name)
-
-        id_used_list += list(unmerged_level_roads[~unmerged_level_roads.index.isin(unmerged_way.index)]["POLYGON_ID"].values) # Add the id of the used line to the id_used_list
+    @staticmethod
+    def merge_by_intersects(unmerged_level_roads:geopandas.GeoDataFrame,id_used_list=None):
+        """
+        Merge continuous lines of one level, lines are merged as fixed-point coords and converted back to LineString for result.
+        """
+        unmerged_way = unmerged_level_roads.reset_index(drop=True) # reset index for positional rows
+        merged = LineUtils.merge_fixed_lines(to_fixed_lines(unmerged_way.geometry.values))
+        result = unmerged_way.iloc[[index for index, _ in merged]].to_dict("records")
+        for row, geometry in zip(result, from_fixed_lines([line for _, line in merged])):
+            row["geometry"] = geometry
+        if id_used_list is not None:
+            id_used_list += list(unmerged_level_roads["POLYGON_ID"].values) # Add the id of the used line to the id_used_list
+        return result
+
+    @staticmethod
+    def merge_fixed_lines(lines: List[numpy.ndarray]) -> List[tuple]:
+        """
+        Merge continuous int32 fixed-point lines, candidates are found by hashed endpoints, so matching is exact.
+        Lines are taken from the last one, return [(index of the first line, merged coords)].
+        """
+        endpoints = dict()  # endpoint -> line indices
+        for index, line in enumerate(lines):
+            for endpoint in set(get_endpoints(line)):
+                endpoints.setdefault(endpoint, []).append(index)
+        used = [False] * len(lines)
+        result = []
+        for start in range(len(lines) - 1, -1, -1):
+            if used[start]:
+                continue
+            used[start] = True
+            processing = lines[start]
+            got_merged = True # Flag to check if line is merged
+            while got_merged:
+                got_merged = False
+                head, tail = get_endpoints(processing)
+                for index in sorted(set(endpoints.get(head, []) + endpoints.get(tail, []))):
+                    if used[index]:
+                        continue
+                    line = lines[index]
+                    if is_reverse_needed(processing, line):
+                        line = reverse_linestring_coords(line)
+                    if is_continuous(processing, line):
+                        processing = linemerge_by_wkt(processing, line)
+                        used[index] = True
+                        got_merged = True
+            result.append((start, processing))
         return result
-            
+
     @staticmethod
     def get_merged_and_divided(geometry_dict, origin_line, length_threshold):
         unmerged_values = list(geometry_dict.values())
@@ -167,52 +196,78 @@ class LineUtils:
 
     @staticmethod
     def filter_small_island(merged, area_threshold: int):
-        #  filter the small island, where there is no people
-        filtered = merged
-        small_island_list = []
-        index = 0
-        for values in merged:
-            key = values["POLYGON_ID"]
-            geometry = values["geometry"]
-            try:
-                if list(polygonize(geometry))[0].area * 6371000 * math.pi / 180 * 6371000 * math.pi / 180 < area_threshold:
-                    small_island_list.append(index)
-            except:
-                logging.debug(f"POLYGON_ID: {key} cannot be polygonized.")
-            finally:
-                index += 1
-
-        for index in sorted(small_island_list, reverse=True):
-            filtered.pop(index)
-        return filtered
+        #  filter the small island, where there is no people, lines cannot be polygonized are kept as they are
+        _, reasons = RingUtils.polygonize_and_repair([values["geometry"] for values in merged], area_threshold)
+        logging.debug(f"POLYGON_ID: {[values['POLYGON_ID'] for values, reason in zip(merged, reasons) if reason not in ('', 'small area')]} cannot be polygonized.")
+        return [values for values, reason in zip(merged, reasons) if reason != "small area"]
 
     @staticmethod
-    def get_way_geometry_from_overpy(way_id):
-        api = overpy.Overpass()
-        query_message = f"""[out:json][timeout:25]
-            way({way_id}); 
-                        out body;
-                        >;
-                        out skel qt;
-                        """
-        lineStrings = []
-        result = api.query(query_message)
-        for key, way in enumerate(result.ways):
-            linestring_coords = []
-            for node in way.nodes:
-                linestring_coords.append(Point(node.lon, node.lat))
-            lineStrings.append(LineString(linestring_coords))
+    def close_gaps(merged: List[Dict], snap_distance) -> List[Dict]:
+        """
+        Join open chains whose endpoints are within snap_distance meters, nearest endpoint pairs first, gaps are bridged by straight segments.
+        Chains joined in a loop are closed as rings, joined chains keep the row of the first one in merged.
+        """
+        if not merged or not snap_distance:
+            return merged
+        lines = to_fixed_lines([values["geometry"] for values in merged])
+        chains = [index for index, line in enumerate(lines) if len(line) > 1 and not numpy.array_equal(line[0], line[-1])]
+        if not chains:
+            return merged
+        # End 2 * k is head of chain k, 2 * k + 1 is its tail.
+        points = shapely.points(numpy.stack([[lines[index][0], lines[index][-1]] for index in chains]).reshape(-1, 2) / COORDINATE_PRECISION)
+        sources, targets = shapely.STRtree(points).query(points, predicate="dwithin", distance=snap_distance / 6371000 / math.pi * 180)
+        pairs = sources < targets
+        sources, targets = sources[pairs], targets[pairs]
+        links = dict()  # end -> linked end
+        for source, target in zip(*[ends[numpy.argsort(shapely.distance(points[sources], points[targets]), kind="stable")] for ends in (sources, targets)]):
+            if source in links or target in links or (source // 2 == target // 2 and len(lines[chains[source // 2]]) < 3):
+                continue
+            links[source], links[target] = target, source
+        if not links:
+            return merged
+        logging.info(f"Closing {len(links) // 2} gaps within {snap_distance} meters.")
+        joined = dict()  # row of first chain -> joined coords
+        dropped = set()
+        visited = [False] * len(chains)
+        for chain in range(len(chains)):
+            if visited[chain]:
+                continue
+            # Walk back to the free end of the path, or stay at the head if chains are in a loop.
+            entry = 2 * chain
+            while entry in links and links[entry] // 2 != chain:
+                entry = links[entry] ^ 1
+            entry = 2 * chain if entry in links else entry
+            parts, rows, is_loop = [], [], False
+            while True:
+                visited[entry // 2] = True
+                line = lines[chains[entry // 2]]
+                parts.append(line[::-1] if entry % 2 else line)
+                rows.append(chains[entry // 2])
+                exit = entry ^ 1
+                if exit not in links:
+                    break
+                if visited[links[exit] // 2]:
+                    is_loop = True
+                    break
+                entry = links[exit]
+            if len(parts) == 1 and not is_loop:
+                continue
+            coords = numpy.concatenate(parts + [parts[0][:1]] if is_loop else parts)
+            coords = coords[numpy.r_[True, numpy.any(coords[1:] != coords[:-1], axis=1)]]  # Drop repeated points at joints.
+            joined[min(rows)] = coords
+            dropped.update(rows)
+        geometries = dict(zip(joined.keys(), from_fixed_lines(list(joined.values()))))
+        return [dict(values, geometry=geometries[index]) if index in geometries else values
+                for index, values in enumerate(merged) if index not in dropped or index in geometries]
 
-        return lineStrings
+    @staticmethod
+    def get_way_geometry_from_overpy(way_id):
+        return list(get_client().get_ways([way_id]).values())
 
     @staticmethod
-    def polygonize_with_try_catch(row, remove_list):
-        try:
-            return list(shapely.ops.polygonize(row["geometry"]))[0]
-        except:
-            logging.debug(f"{row['POLYGON_ID']} cannot be polygonized, geometry is {row['geometry']}, return origin LINESTRING instead")
-            remove_list.append(row['POLYGON_ID'])
-            return row["geometry"]
+    def get_ways_geometry_from_overpy(way_ids) -> Dict:
+        # Batched and concurrent, {way_id: LineString}
+        return get_client().get_ways(way_ids)
 
     @staticmethod
     def get_relation_data(relation_member, lines_dict):
@@ -233,6 +288,78 @@ class LineUtils:
         id_used_list += list(set(current_id_used_list)-set(original_id_used_list))
         return sum(merged_relation_members, []) # flatten list
 
+    @staticmethod
+    def get_relation_groups(relations: Dict) -> List[List]:
+        """
+        Group relations sharing any way, relations in different groups can be merged independently.
+        """
+        parent = {relation_id: relation_id for relation_id in relations.keys()}
+
+        def find(relation_id):
+            while parent[relation_id] != relation_id:
+                parent[relation_id] = parent[parent[relation_id]]
+                relation_id = parent[relation_id]
+            return relation_id
+
+        way_owner = dict()
+        for relation_id, relation_members in relations.items():
+            for way_id in relation_members["POLYGON_ID"]:
+                if way_id in way_owner:
+                    parent[find(relation_id)] = find(way_owner[way_id])
+                else:
+                    way_owner[way_id] = relation_id
+
+        groups = dict()
+        for relation_id in relations.keys():
+            groups.setdefault(find(relation_id), []).append(relation_id)
+        return list(groups.values())
+
+    @staticmethod
+    def merge_relation_groups(relation_groups: List[List[Dict]], levels) -> tuple:
+        """
+        Worker of highway relation merging, each group is a list of relation coords buffers.
+        Return merged coords buffer and the ids used in these groups.
+        """
+        result = []
+        id_used_list = []
+        for relation_group in relation_groups:
+            # Relations in same group share ways, keep them in order with the same used id list.
+            group_id_used_list = []
+            for relation_buffer in relation_group:
+                relation_members = MPUtils.from_coords_buffer(relation_buffer)
+                result += LineUtils.get_merged_members(relation_members, levels, group_id_used_list)
+            id_used_list += group_id_used_list
+        return MPUtils.to_coords_buffer(geopandas.GeoDataFrame(result)), id_used_list
+
+    @staticmethod
+    def merge_level_buffer(level_buffer: Dict) -> Dict:
+        """
+        Worker of level merging, return merged coords buffer.
+        """
+        merged = LineUtils.merge_fixed_lines(MPUtils.get_fixed_lines(level_buffer))
+        indices = [index for index, _ in merged]
+        lines = [line for _, line in merged]
+        offsets = numpy.zeros(len(lines) + 1, dtype=numpy.int64)
+        offsets[1:] = numpy.cumsum([len(line) for line in lines])
+        return {"POLYGON_ID": level_buffer["POLYGON_ID"][indices],
+                "POLYGON_NAME": [level_buffer["POLYGON_NAME"][i] for i in indices],
+                "HOFN_TYPE": [level_buffer["HOFN_TYPE"][i] for i in indices],
+                "ROAD_LEVEL": [level_buffer["ROAD_LEVEL"][i] for i in indices],
+                "coords": numpy.concatenate(lines) if lines else numpy.empty((0, 2), dtype=numpy.int32),
+                "offsets": offsets}
+
+    @staticmethod
+    def merge_levels(data: geopandas.GeoDataFrame, levels, executor=None) -> List[Dict]:
+        """
+        Merge lines by intersects in each level, levels are independent and run in executor if given.
+        """
+        level_buffers = [MPUtils.to_coords_buffer(data[data["ROAD_LEVEL"] == level]) for level in levels if not data[data["ROAD_LEVEL"] == level].empty]
+        if executor is not None and len(level_buffers) > 1:
+            merged_buffers = executor.map(LineUtils.merge_level_buffer, level_buffers)
+        else:
+            merged_buffers = [LineUtils.merge_level_buffer(level_buffer) for level_buffer in level_buffers]
+        return sum([MPUtils.from_coords_buffer(i).to_dict("records") for i in merged_buffers], []) # flatten list from level1 to level5
+
 #################################################
 class RingUtils:
     @staticmethod
@@ -275,12 +402,39 @@ class RingUtils:
                       "ROAD_LEVEL": "0"}
             islands.append(append)
 
-    # TODO: Optimize
     @staticmethod
     def get_merged_rings(rings: list, polygon_id_used_table: list, mode) -> List[Dict]:
+        merged_ids, candidates = RingUtils.get_merged_ring_candidates(rings, mode)
+        result = RingUtils.choose_polygon_ids(merged_ids, candidates, set(polygon_id_used_table))
+        polygon_id_used_table += [ring["POLYGON_ID"] for ring in result]
+        return result
+
+    @staticmethod
+    def choose_polygon_ids(merged_ids, candidates, used_ids: set) -> List[Dict]:
+        """
+        POLYGON_ID of each candidate (count, ring) is the first of the first count merged ids not used yet, added to used_ids.
+        A ring whose ids are all used is dropped.
+        """
+        result = []
+        for count, ring in candidates:
+            for merged_id in merged_ids[:count]:
+                if merged_id not in used_ids:
+                    logging.debug(f"{merged_id} is choosed as polygon id.")
+                    result.append({"POLYGON_ID": merged_id, **ring})
+                    used_ids.add(merged_id)
+                    break
+        return result
+
+    # TODO: Optimize
+    @staticmethod
+    def get_merged_ring_candidates(rings: list, mode) -> tuple:
+        """
+        Merge rings, return way ids in merging order and [(count, ring)] without POLYGON_ID, see choose_polygon_ids,
+        so ids are chosen after merging, in the parent when relations are merged in workers.
+        """
         def get_merged_line(ring, merging_candidates: list, current_merged_ids) -> LineString:
             # Avoid merge with self
-            current_merged_ids.append(ring["polygon_id"])
+            current_merged_ids.append(ring["way_id"])
 
             merging_line = ring.get("geometry")
 
@@ -289,9 +443,9 @@ class RingUtils:
             while merging_index < len(merging_candidates):
                 candidate = merging_candidates[merging_index]
                 candidate_line = candidate.get("geometry")
-                candidate_id = candidate.get("polygon_id")
+                candidate_id = candidate.get("way_id")
                 try:
-                    if candidate.get('polygon_id') in current_merged_ids:
+                    if candidate.get('way_id') in current_merged_ids:
                         merging_index += 1
                     else:
                         if is_reverse_needed(merging_line, candidate_line):
@@ -299,7 +453,7 @@ class RingUtils:
                             logging.debug(f"candidate {candidate_id} reversed.")
                             candidate_line = reverse_linestring_coords(candidate_line)
                         if is_continuous(merging_line, candidate_line):
-                            logging.debug(f"{ring.get('polygon_id')} merge with {candidate_id}")
+                            logging.debug(f"{ring.get('way_id')} merge with {candidate_id}")
                             # merge and start new round of iteration.
                             merging_line = linemerge_by_wkt(merging_line, candidate_line)
                             current_merged_ids.append(candidate_id)
@@ -318,53 +472,115 @@ class RingUtils:
         current_merged_ids = []
         for ring in rings:
             # If being merged, skip it
-            if ring.get('polygon_id') in current_merged_ids:
+            if ring.get('way_id') in current_merged_ids:
                 continue
 
-            logging.debug(f"WAY:{ring.get('polygon_id')} start doing merge.")
+            logging.debug(f"WAY:{ring.get('way_id')} start doing merge.")
             merged_line = get_merged_line(ring, merging_candidate, current_merged_ids)
 
             # Choose way_id from merged line.
-            for merged_id in current_merged_ids:
-                if merged_id not in polygon_id_used_table:
-                    logging.debug(f"{merged_id} is choosed as polygon id.")
-                    result.append({'POLYGON_ID': merged_id, "POLYGON_NAME": ring.get("name"), "geometry": merged_line, "HOFN_TYPE": HofnType[mode].value, "ROAD_LEVEL": 0})
-                    polygon_id_used_table.append(merged_id)
-                    break
+            result.append((len(current_merged_ids), {"POLYGON_NAME": ring.get("name"), "geometry": merged_line, "HOFN_TYPE": HofnType[mode].value, "ROAD_LEVEL": 0}))
 
-        return result
+        return current_merged_ids, result
 
     @staticmethod
-    def polygonize_with_try_catch(row, remove_list):
-        try:
-            return list(shapely.ops.polygonize(row["geometry"]))[0]
-        except:
-            logging.debug(f"{row['POLYGON_ID']} cannot be polygonized, geometry is {row['geometry']}, return origin LINESTRING instead")
-            remove_list.append(row['POLYGON_ID'])
-            return row["geometry"]
+    def polygonize_and_repair(geometries, area_threshold=None) -> tuple:
+        """
+        Polygonize each ring geometry to its first polygon in one pass, invalid rings and polygons are repaired by make_valid.
+        Return polygons (None if rejected) and rejection reasons ("" if kept), area_threshold in square meters.
+        """
+        geometries = numpy.asarray(geometries, dtype=object)
+        reasons = numpy.full(len(geometries), "", dtype=object)
+        if not len(geometries):
+            return numpy.empty(0, dtype=object), reasons
+        polygons, cuts, dangles, invalid_rings = shapely.polygonize_full(geometries.reshape(-1, 1), axis=1)
+        result = shapely.get_geometry(polygons, 0)
+        # Repair self-intersecting rings, keep the largest part.
+        for index in numpy.flatnonzero(shapely.is_missing(result) & ~shapely.is_empty(invalid_rings)):
+            ring = shapely.get_geometry(invalid_rings[index], 0)
+            if len(ring.coords) >= 4:
+                result[index] = RingUtils.get_largest_polygon(shapely.make_valid(Polygon(ring.coords)))
+        for index in numpy.flatnonzero(~shapely.is_missing(result) & ~shapely.is_valid(result)):
+            result[index] = RingUtils.get_largest_polygon(shapely.make_valid(result[index]))
+        missing = shapely.is_missing(result)
+        reasons[missing] = "no ring"
+        reasons[missing & ~shapely.is_empty(invalid_rings)] = "invalid ring"
+        reasons[missing & ~shapely.is_empty(cuts)] = "cut edge"
+        reasons[missing & ~shapely.is_empty(dangles)] = "dangle"
+        if area_threshold is not None:
+            small = ~missing & (shapely.area(result) * 6371000 * math.pi / 180 * 6371000 * math.pi / 180 < area_threshold)
+            reasons[small] = "small area"
+            result[small] = None
+        return result, reasons
 
     @staticmethod
-    def get_rings_merged_results(relation_member_dict, relation_result, islands, polygon_id_used_table, mode) -> tuple:
+    def get_largest_polygon(geometry):
+        polygons = [part for part in shapely.get_parts(shapely.get_parts(geometry)) if part.geom_type == "Polygon" and not part.is_empty]
+        return max(polygons, key=lambda polygon: polygon.area) if polygons else None
+
+    @staticmethod
+    def polygonize_rings(data: geopandas.GeoDataFrame, area_threshold=None) -> tuple:
+        """
+        Polygonize and repair rings of GeoDataFrame, return kept rows with polygons and rejected POLYGON_IDs with reasons.
+        """
+        polygons, reasons = RingUtils.polygonize_and_repair(data["geometry"].values, area_threshold)
+        kept = reasons == ""
+        rejected = pandas.DataFrame({"POLYGON_ID": data["POLYGON_ID"].values[~kept], "reason": reasons[~kept]})
+        result = data[kept].copy()
+        result["geometry"] = polygons[kept]
+        return geopandas.GeoDataFrame(result, geometry="geometry"), rejected
+
+    @staticmethod
+    def get_rings_merged_results(relation_member_dict, mode) -> List[tuple]:
+        """
+        Worker of relation merging, return [(is_island, merged ids, candidates)] in merging order, POLYGON_ID is chosen after.
+        """
+        result = []
         # Outer then inner
         for relation_id, relation in relation_member_dict.items():
             logging.debug(f"Relation: {relation_id} doing merge.")
 
             outers = relation.get("outer")
             if outers:
-                outers = RingUtils.get_merged_rings(outers, polygon_id_used_table, mode)
-                relation_member_dict[relation_id] = outers
-                for outer in outers:
-                    relation_result.append(outer)
-            
+                result.append((False, *RingUtils.get_merged_ring_candidates(outers, mode)))
 
             # Remove inner as islands.
             if mode == "water":
                 inners = relation.get("inner")
                 if inners:
-                    inners = RingUtils.get_merged_rings(inners, polygon_id_used_table, "island")
-                    RingUtils.islands_extracting(inners, islands)
+                    result.append((True, *RingUtils.get_merged_ring_candidates(inners, "island")))
+        return result
 
 class MPUtils:
+    # Line data <-> compact int32 fixed-point coords buffer, only numpy arrays and plain lists are pickled to workers.
+    @staticmethod
+    def to_coords_buffer(data: geopandas.GeoDataFrame) -> Dict:
+        if data.empty:
+            return {"POLYGON_ID": numpy.empty(0, dtype=numpy.int64), "POLYGON_NAME": [], "HOFN_TYPE": [], "ROAD_LEVEL": [],
+                    "coords": numpy.empty((0, 2), dtype=numpy.int32), "offsets": numpy.zeros(1, dtype=numpy.int64)}
+        coords = to_fixed_lines(data["geometry"].values)
+        offsets = numpy.zeros(len(coords) + 1, dtype=numpy.int64)
+        offsets[1:] = numpy.cumsum([len(i) for i in coords])
+        return {"POLYGON_ID": data["POLYGON_ID"].to_numpy(dtype=numpy.int64),
+                "POLYGON_NAME": list(data["POLYGON_NAME"]),
+                "HOFN_TYPE": list(data["HOFN_TYPE"]),
+                "ROAD_LEVEL": list(data["ROAD_LEVEL"]),
+                "coords": numpy.concatenate(coords),
+                "offsets": offsets}
+
+    @staticmethod
+    def get_fixed_lines(buffer: Dict) -> List[numpy.ndarray]:
+        return numpy.split(buffer["coords"], buffer["offsets"][1:-1])
+
+    @staticmethod
+    def from_coords_buffer(buffer: Dict) -> geopandas.GeoDataFrame:
+        geometries = from_fixed_lines(MPUtils.get_fixed_lines(buffer)) if len(buffer["POLYGON_ID"]) else []
+        return geopandas.GeoDataFrame({"POLYGON_ID": buffer["POLYGON_ID"],
+                                       "POLYGON_NAME": buffer["POLYGON_NAME"],
+                                       "HOFN_TYPE": buffer["HOFN_TYPE"],
+                                       "ROAD_LEVEL": buffer["ROAD_LEVEL"],
+                                       "geometry": geometries}, geometry="geometry")
+
     # Dict divided to subdict
     @staticmethod
     def chunks(data, size):
@@ -383,69 +599,120 @@ class MPUtils:
 
 
 #####
-wktfab = osmium.geom.WKTFactory()
+wkbfab = osmium.geom.WKBFactory()
 
 
 class LimitRelationAreaHanlder(osmium.SimpleHandler):
-    def __init__(self, relation_id):
+    def __init__(self, relation_ids):
         super().__init__()
-        self.way_dict: Dict[Dict] = dict()
-        self.relation_id = relation_id
+        self.way_dict = FeatureTable(columns=("POLYGON_NAME",))  # Look up by id, get Way view.
+        self.relation_ids = {int(relation_id) for relation_id in relation_ids}
         self.relation_dict = dict()
 
     def relation(self, relation):
-        if relation.id == int(self.relation_id):
+        if relation.id in self.relation_ids:
             for member in relation.members:
                 if member.ref in self.way_dict and member.role == "outer" and member.type == "w":
 
                     if not self.relation_dict.get(relation.id, False):
                         self.relation_dict[relation.id] = []
-                    self.relation_dict[relation.id].append({"id": member.ref, "role": member.role, "type": member.type})
+                    self.relation_dict[relation.id].append(RelationMember(member.ref, member.type, member.role))
 
     def way(self, way):
-        way_geometry = wkt.loads(wktfab.create_linestring(way))
-        self.way_dict[way.id] = {"id": way.id, "name": way.tags.get("name"), "geometry": way_geometry}
+        try:
+            self.way_dict.append(way.id, bytes.fromhex(wkbfab.create_linestring(way)), POLYGON_NAME=way.tags.get("name"))
+        except:
+            pass
 
 
 class LimitAreaUtils:
     @staticmethod
     def get_limit_relation_geom(filepath, relation_id):
-        handler = LimitRelationAreaHanlder(relation_id)
-        handler.apply_file(filepath, idx="flex_mem", locations=True)
+        return LimitAreaUtils.get_limit_relation_geoms(filepath, [relation_id])[int(relation_id)]
+
+    @staticmethod
+    def get_limit_relation_geoms(filepath, relation_ids) -> dict:
+        """
+        Limit areas of several relations in one pass on file, relation id -> MultiPolygon of merged outer rings.
+        """
+        handler = LimitRelationAreaHanlder(relation_ids)
+        apply_file(handler, filepath)
         way_dict = handler.way_dict
         relation_dict = handler.relation_dict
         relation_member_dict = RingUtils.get_relation_member_data(relation_dict=relation_dict, way_dict=way_dict, tags=["outer", "inner", ""])
         relation_member_data: geopandas.GeoDataFrame = geopandas.GeoDataFrame(relation_member_dict)
         relation_member_dict = relation_member_data.to_dict("index")
         relation_member_dict = RingUtils.restructure(relation_member_dict)
-        relation_result = []
-        polygon_id_used_table = []
+        relation_result = {int(relation_id): [] for relation_id in relation_ids}
         for relation_id, relation in relation_member_dict.items():
             logging.debug(f"Relation: {relation_id} doing merge.")
 
             outers = relation.get("outer")
             if outers:
-                outers = RingUtils.get_merged_rings(outers, polygon_id_used_table, "water")
+                outers = RingUtils.get_merged_rings(outers, [], "water")  # Neighbouring nations share border ways.
                 relation_member_dict[relation_id] = outers
                 for outer in outers:
-                    relation_result.append(outer)
+                    relation_result[int(relation_id)].append(outer)
 
-        geom = MultiPolygon([Polygon(i.get("geometry")) for i in relation_result])
+        geoms = {relation_id: MultiPolygon([Polygon(i.get("geometry")) for i in outers]) for relation_id, outers in relation_result.items()}
 
         logging.debug("Get limit relation area geometry completed.")
-        return geom
+        return geoms
+
+    @staticmethod
+    def get_limit_area(input_path, limit_relation_id, ALL_OFFLINE=True, within=None):
+        logging.info("Loading limit area geometry.")
+        if ALL_OFFLINE:
+            logging.info("Detect all offline mode on, using offline file to load limit area")
+            limit_area = LimitAreaUtils.get_limit_relation_geom(input_path, limit_relation_id)
+        else:
+            logging.info("Detect all offline mode off, using api to load limit area")
+            limit_area = LimitAreaUtils.get_relation_polygon_with_overpy(limit_relation_id)
+        return LimitAreaUtils.get_clipped_area(limit_area, within) if within else limit_area
+
+    @staticmethod
+    def get_limit_areas(input_path, limit_relation_ids: dict, ALL_OFFLINE=True, within=None) -> dict:
+        """
+        Limit areas of several nations, nation -> limit relation id in, nation -> limit area out, offline areas are read in one pass.
+        """
+        logging.info(f"Loading limit area geometry of {list(limit_relation_ids.keys())}.")
+        if ALL_OFFLINE:
+            geoms = LimitAreaUtils.get_limit_relation_geoms(input_path, limit_relation_ids.values())
+            limit_areas = {nation: geoms[int(relation_id)] for nation, relation_id in limit_relation_ids.items()}
+        else:
+            limit_areas = {nation: LimitAreaUtils.get_relation_polygon_with_overpy(relation_id) for nation, relation_id in limit_relation_ids.items()}
+        return {nation: LimitAreaUtils.get_clipped_area(limit_area, within) for nation, limit_area in limit_areas.items()} if within else limit_areas
+
+    @staticmethod
+    def get_clipped_area(limit_area, within: str) -> MultiPolygon:
+        """
+        Limit area within WKT polygon of a subset, so reading boxes, limit-area filtering and output only cover the subset.
+        """
+        clipped = limit_area.intersection(shapely.from_wkt(within))
+        polygons = [geom for geom in getattr(clipped, "geoms", [clipped]) if isinstance(geom, Polygon) and not geom.is_empty]
+        if not polygons:
+            logging.warning("Subset does not intersect limit area, nothing will be extracted.")
+        return MultiPolygon(polygons)
+
+    @staticmethod
+    def get_combined_area(limit_areas: dict) -> MultiPolygon:
+        """
+        Polygons of all limit areas without union, for filtering boxes when reading.
+        """
+        return MultiPolygon([polygon for limit_area in limit_areas.values() for polygon in (limit_area.geoms if hasattr(limit_area, "geoms") else [limit_area])])
+
+    @staticmethod
+    def get_nation_indices(geometries, limit_areas: dict) -> dict:
+        """
+        Route features to every nation whose limit area they intersect, nation -> row positions in index order as prepare_data.
+        One spatial index over features is shared by all nations, each limit area is queried once as a prepared geometry.
+        """
+        tree = shapely.STRtree(numpy.asarray(geometries, dtype=object))
+        return {nation: tree.query(limit_area, predicate="intersects") for nation, limit_area in limit_areas.items()}
 
     @staticmethod
     def get_relation_polygon_with_overpy(rel_id: str) -> MultiPolygon:
-        api = overpy.Overpass()
-        query_msg = f"""
-        [out:json][timeout:25];
-        rel({rel_id});
-        out body;
-        >;
-        out skel qt; 
-        """
-        result = api.query(query_msg)
+        result = get_client().get_relation(rel_id)
         lineStrings = []
         for key, way in enumerate(result.ways):
             linestring_coords = []
@@ -461,13 +728,286 @@ class LimitAreaUtils:
     @staticmethod
     def prepare_data(data_df: geopandas.GeoDataFrame, intersection_polygon_wkt: str) -> geopandas.GeoDataFrame:
         intersects_geom = wkt.loads(intersection_polygon_wkt)
-        if intersects_geom.type == "LineString":
+        if intersects_geom.geom_type == "LineString":
             intersects_geom = intersects_geom.buffer(1/6371000/math.pi*180)
         intersects_series = geopandas.GeoSeries(intersects_geom)
-        intersects_indices = list(data_df.sindex.query_bulk(intersects_series, predicate="intersects")[1])
+        intersects_indices = list(data_df.sindex.query(intersects_series, predicate="intersects")[1])
         data_df = data_df.iloc[intersects_indices]
         return data_df
 
+    @staticmethod
+    def get_intersects_indices(geometries, start, end, intersection_polygon_wkt: str) -> numpy.ndarray:
+        """
+        Worker of prepare_data on rows start to end of SharedGeometries, return positions of rows intersecting the polygon.
+        """
+        intersects_geom = wkt.loads(intersection_polygon_wkt)
+        if intersects_geom.geom_type == "LineString":
+            intersects_geom = intersects_geom.buffer(1/6371000/math.pi*180)
+        return start + shapely.STRtree(geometries.get_geometries(start, end)).query(intersects_geom, predicate="intersects")
+
+    @staticmethod
+    def get_limit_boxes(limit_area) -> List[tuple]:
+        """
+        Bounding box of each limit area polygon as fixed-point (min_x, min_y, max_x, max_y), rounded outwards.
+        """
+        polygons = limit_area.geoms if hasattr(limit_area, "geoms") else [limit_area]
+        return [(math.floor(min_x * COORDINATE_PRECISION), math.floor(min_y * COORDINATE_PRECISION),
+                 math.ceil(max_x * COORDINATE_PRECISION), math.ceil(max_y * COORDINATE_PRECISION))
+                for min_x, min_y, max_x, max_y in (polygon.bounds for polygon in polygons if not polygon.is_empty)]
+
+
+class BoxFilter:
+    """
+    Check node locations of ways and areas with limit area boxes before any geometry is created,
+    object is kept if its bounding box overlaps one, so any node in a box keeps it.
+    Boxes are checked only when the object overlaps the bounds of all boxes, through a coarse grid of cells.
+    """
+    GRID_SIZE = 64
+
+    def __init__(self, boxes: List[tuple]):
+        self.boxes = boxes
+        self.bounds = (min(box[0] for box in boxes), min(box[1] for box in boxes), max(box[2] for box in boxes), max(box[3] for box in boxes)) \
+            if boxes else None
+        self.grid = dict()  # (column, row) -> boxes overlapping the cell
+        if self.bounds:
+            self.cell_width = max((self.bounds[2] - self.bounds[0]) / self.GRID_SIZE, 1)
+            self.cell_height = max((self.bounds[3] - self.bounds[1]) / self.GRID_SIZE, 1)
+            for box in boxes:
+                columns, rows = self.get_cells(*box)
+                for column in columns:
+                    for row in rows:
+                        self.grid.setdefault((column, row), []).append(box)
+
+    def get_cells(self, min_x, min_y, max_x, max_y) -> tuple:
+        """
+        Columns and rows of cells covering the bbox, clipped to the grid, edges of the bounds are in the last cells.
+        """
+        def get_index(value, start, size):
+            return min(max(int((value - start) // size), 0), self.GRID_SIZE - 1)
+        return range(get_index(min_x, self.bounds[0], self.cell_width), get_index(max_x, self.bounds[0], self.cell_width) + 1), \
+            range(get_index(min_y, self.bounds[1], self.cell_height), get_index(max_y, self.bounds[1], self.cell_height) + 1)
+
+    def is_overlapped(self, min_x, min_y, max_x, max_y) -> bool:
+        bounds = self.bounds
+        if bounds is None or min_x > bounds[2] or max_x < bounds[0] or min_y > bounds[3] or max_y < bounds[1]:
+            return False
+        columns, rows = self.get_cells(min_x, min_y, max_x, max_y)
+        if len(columns) * len(rows) > len(self.boxes):
+            boxes = self.boxes
+        else:
+            boxes = (box for column in columns for row in rows for box in self.grid.get((column, row), ()))
+        return any(min_x <= box[2] and max_x >= box[0] and min_y <= box[3] and max_y >= box[1] for box in boxes)
+
+    @classmethod
+    def from_limit_area(cls, limit_area):
+        return cls(LimitAreaUtils.get_limit_boxes(limit_area))
+
+    def is_inside(self, node_refs) -> bool:
+        min_x = min_y = 2 ** 31
+        max_x = max_y = -2 ** 31
+        for node_ref in node_refs:
+            location = node_ref.location
+            if not location.valid():
+                continue
+            x, y = location.x, location.y
+            if x < min_x:
+                min_x = x
+            if x > max_x:
+                max_x = x
+            if y < min_y:
+                min_y = y
+            if y > max_y:
+                max_y = y
+        if min_x > max_x:
+            return True  # No valid location, leave it to geometry creation.
+        return self.is_overlapped(min_x, min_y, max_x, max_y)
+
+    def is_way_inside(self, way) -> bool:
+        return self.is_inside(way.nodes)
+
+    def is_area_inside(self, area) -> bool:
+        return any(self.is_inside(ring) for ring in area.outer_rings())
+
+
+class ExtractRelationHandler(osmium.SimpleHandler):
+    """
+    First pass of extract, collect matched relations and their way members.
+    Way ids are an osmium IdSet, a bit per id, pass a set as way_ids when they are sent to workers, IdSet can not be pickled.
+    """
+    def __init__(self, tags, keep_relation_ids, inside_way_ids=None, way_ids=None):
+        super().__init__()
+        self.tags = tags
+        self.keep_relation_ids = keep_relation_ids
+        self.inside_way_ids = inside_way_ids  # Of subset, matched relations need a way member inside.
+        self.relation_ids = set()
+        self.way_ids = way_ids if way_ids is not None else IdSet()
+        self.add_way_id = self.way_ids.set if isinstance(self.way_ids, IdSet) else self.way_ids.add
+
+    def is_inside(self, relation) -> bool:
+        return self.inside_way_ids is None or any(member.type == "w" and member.ref in self.inside_way_ids for member in relation.members)
+
+    def relation(self, relation):
+        if relation.id in self.keep_relation_ids or (is_tags_matched(relation.tags, self.tags) and self.is_inside(relation)):
+            self.relation_ids.add(relation.id)
+            for member in relation.members:
+                if member.type == "w":
+                    self.add_way_id(member.ref)
+
+
+class ExtractWayHandler(osmium.SimpleHandler):
+    """
+    Second pass of extract, collect matched ways and the nodes they referenced, into IdSet of ExtractRelationHandler and a new one.
+    """
+    def __init__(self, tags, way_ids: IdSet, inside_way_ids=None):
+        super().__init__()
+        self.tags = tags
+        self.way_ids = way_ids
+        self.inside_way_ids = inside_way_ids
+        self.node_ids = IdSet()  # Set of python ints takes about 70 bytes per id, too much for nodes of a large nation.
+
+    def way(self, way):
+        if way.id in self.way_ids or (is_tags_matched(way.tags, self.tags) and (self.inside_way_ids is None or way.id in self.inside_way_ids)):
+            self.way_ids.set(way.id)
+            for node in way.nodes:
+                self.node_ids.set(node.ref)
+
+
+class ExtractSubsetHandler(osmium.SimpleHandler):
+    """
+    Pass before extract of a subset, collect ways with a node in the subset boxes, reading needs node locations.
+    """
+    def __init__(self, box_filter):
+        super().__init__()
+        self.box_filter = box_filter
+        self.way_ids = IdSet()
+
+    def way(self, way):
+        if self.box_filter.is_way_inside(way):
+            self.way_ids.set(way.id)
+
+
+class ExtractWriterHandler(osmium.SimpleHandler):
+    """
+    Last pass of extract, write all the collected objects into filtered osm.pbf.
+    """
+    def __init__(self, writer, node_ids, way_ids, relation_ids):
+        super().__init__()
+        self.writer = writer
+        self.node_ids = node_ids
+        self.way_ids = way_ids
+        self.relation_ids = relation_ids
+
+    def node(self, node):
+        if node.id in self.node_ids:
+            self.writer.add_node(node)
+
+    def way(self, way):
+        if way.id in self.way_ids:
+            self.writer.add_way(way)
+
+    def relation(self, relation):
+        if relation.id in self.relation_ids:
+            self.writer.add_relation(relation)
+
+
+class TagUtils:
+    """
+    Tag values kept as tag:<key> columns of feature tables, so one table read with the union of several tags is filtered by each of them in memory.
+    Missing tags are kept as empty string, categories of columns can not be null.
+    """
+    @staticmethod
+    def get_superset(tags_list) -> dict:
+        """
+        Union of the values of each key, "" (any value) if any of tags allows any value.
+        """
+        values = dict()
+        for tags in tags_list:
+            for key, value in tags.items():
+                if value == "" or values.get(key) == "":
+                    values[key] = ""
+                else:
+                    values.setdefault(key, set()).update(value if type(value) == list else [value])
+        return {key: value if value == "" else sorted(value) for key, value in sorted(values.items())}
+
+    @staticmethod
+    def get_columns(tags) -> list:
+        return [f"tag:{key}" for key in tags.keys()]
+
+    @staticmethod
+    def get_values(osm_tags, tags) -> dict:
+        return {f"tag:{key}": osm_tags.get(key, "") for key in tags.keys()}
+
+    @staticmethod
+    def get_mask(data, tags) -> numpy.ndarray:
+        """
+        Rows of data whose tag columns match tags, as is_tags_matched.
+        """
+        mask = numpy.zeros(len(data), dtype=bool)
+        for key, value in tags.items():
+            column = data[f"tag:{key}"]
+            if type(value) == list:
+                mask |= column.isin(value).values
+            elif value == "":
+                mask |= (column != "").values
+            else:
+                mask |= (column == value).values
+        return mask
+
+
+class ExtractUtils:
+    @staticmethod
+    def get_extract_path(input_path, name, tags, keep_relation_ids, within=None) -> str:
+        # Keyed by source file identity, changing the file, tag rule or subset will generate new extract.
+        stat = os.stat(input_path)
+        identity = {"path": os.path.abspath(input_path), "size": stat.st_size, "mtime": stat.st_mtime_ns,
+                    "tags": tags, "keep_relation_ids": sorted(keep_relation_ids)}
+        if within:
+            identity["within"] = within
+        identity = json.dumps(identity, sort_keys=True, default=str)
+        digest = hashlib.sha1(identity.encode("utf-8")).hexdigest()[:12]
+        base = input_path[:-len(".osm.pbf")] if input_path.endswith(".osm.pbf") else os.path.splitext(input_path)[0]
+        return f"{base}.{name}.{digest}.osm.pbf"
+
+    @staticmethod
+    def get_filtered_extract(input_path, name, tags, keep_relation_ids=None, within=None) -> str:
+        """
+        Get path of filtered osm.pbf which only contains the objects matching tags, their referenced ways and nodes.
+        With within, a WKT polygon of a subset, matched objects also need a way with a node in the boxes of the subset.
+        Build it when there is no cached one next to the input.
+        """
+        keep_relation_ids = {int(i) for i in keep_relation_ids} if keep_relation_ids else set()
+        extract_path = ExtractUtils.get_extract_path(input_path, name, tags, keep_relation_ids, within)
+        if os.path.exists(extract_path):
+            logging.info(f"Using cached extract {extract_path}")
+            return extract_path
+
+        start_time = time.time()
+        logging.info(f"Building filtered extract of {name} from {input_path}")
+        inside_way_ids = None
+        if within:
+            subset_handler = ExtractSubsetHandler(BoxFilter.from_limit_area(shapely.from_wkt(within)))
+            apply_file(subset_handler, input_path)
+            inside_way_ids = subset_handler.way_ids
+        relation_handler = ExtractRelationHandler(tags, keep_relation_ids, inside_way_ids)
+        relation_handler.apply_file(input_path)
+        way_handler = ExtractWayHandler(tags, relation_handler.way_ids, inside_way_ids)
+        way_handler.apply_file(input_path)
+
+        # Write into temporary file first, avoid broken extract being cached when interrupted.
+        tmp_path = f"{extract_path[:-len('.osm.pbf')]}.tmp.osm.pbf"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        writer = osmium.SimpleWriter(tmp_path)
+        try:
+            writer_handler = ExtractWriterHandler(writer, way_handler.node_ids, way_handler.way_ids, relation_handler.relation_ids)
+            writer_handler.apply_file(input_path)
+        finally:
+            writer.close()
+        os.replace(tmp_path, extract_path)
+        logging.info(f"Extract {extract_path} completed, taking {time.time() - start_time} seconds")
+        return extract_path
+
+
 class BuildingUtils:
 
     @staticmethod
@@ -556,4 +1096,78 @@ class BuildingUtils:
                     polygon_id_used_table.append(merged_id)
                     break
 
-        return result
\ No newline at end of file
+        return result
+
+class SimplifyUtils:
+    @staticmethod
+    def get_tolerance(simplify_config, name) -> float:
+        return float((simplify_config or dict()).get(name) or 0)
+
+    @staticmethod
+    def simplify(data: geopandas.GeoDataFrame, tolerance, name) -> geopandas.GeoDataFrame:
+        """
+        Topology-preserving simplification of all geometries at once with tolerance in meters.
+        A geometry which comes out empty, invalid (polygon) or not simple (line) keeps its original vertices.
+        """
+        if not tolerance or data is None or data.empty:
+            return data
+        geometries = numpy.asarray(data.geometry.values, dtype=object)
+        simplified = shapely.simplify(geometries, tolerance / 6371000 / math.pi * 180, preserve_topology=True)
+        polygonal = numpy.isin(shapely.get_type_id(simplified), [3, 6])
+        kept = shapely.is_empty(simplified) | ~numpy.where(polygonal, shapely.is_valid(simplified), shapely.is_simple(simplified))
+        simplified[kept] = geometries[kept]
+        before, after = int(shapely.get_num_coordinates(geometries).sum()), int(shapely.get_num_coordinates(simplified).sum())
+        logging.info(f"Simplify {name} with tolerance {tolerance} m: {before} -> {after} vertices "
+                     f"({(before - after) / before * 100 if before else 0:.1f}% less), {int(kept.sum())} geometries kept as is.")
+        data = data.copy()
+        data["geometry"] = geopandas.GeoSeries(simplified, index=data.index)
+        return data
+
+
+class HilbertUtils:
+    @staticmethod
+    def get_distances(x: numpy.ndarray, y: numpy.ndarray, level=16) -> numpy.ndarray:
+        """
+        Distances along the Hilbert curve of integer cells x, y in [0, 2 ** level), vectorized.
+        """
+        x, y = x.astype(numpy.int64), y.astype(numpy.int64)
+        side = 1 << level
+        distances = numpy.zeros(len(x), dtype=numpy.int64)
+        s = side >> 1
+        while s:
+            rx, ry = (x & s) > 0, (y & s) > 0
+            distances += s * s * ((3 * rx.astype(numpy.int64)) ^ ry.astype(numpy.int64))
+            # Rotate the quadrant so the curve of the next level starts and ends at its right corners.
+            flip = rx & ~ry
+            x, y = numpy.where(flip, side - 1 - x, x), numpy.where(flip, side - 1 - y, y)
+            x, y = numpy.where(ry, x, y), numpy.where(ry, y, x)
+            s >>= 1
+        return distances
+
+    @staticmethod
+    def get_order(geometries, total_bounds=None, level=16) -> numpy.ndarray:
+        """
+        Positions of geometries sorted by Hilbert distance of their bbox centers on a 2 ** level grid over total_bounds,
+        bounds of the centers by default. Empty and missing geometries go last, ties keep their order.
+        """
+        bounds = shapely.bounds(numpy.asarray(geometries, dtype=object)).reshape(-1, 4)
+        x, y = (bounds[:, 0] + bounds[:, 2]) / 2, (bounds[:, 1] + bounds[:, 3]) / 2
+        valid = ~numpy.isnan(x)
+        if not valid.any():
+            return numpy.arange(len(bounds))
+        min_x, min_y, max_x, max_y = total_bounds if total_bounds is not None else (x[valid].min(), y[valid].min(), x[valid].max(), y[valid].max())
+        cells = (1 << level) - 1
+        cell_x = numpy.clip((x[valid] - min_x) / ((max_x - min_x) or 1) * cells, 0, cells)
+        cell_y = numpy.clip((y[valid] - min_y) / ((max_y - min_y) or 1) * cells, 0, cells)
+        distances = numpy.full(len(bounds), numpy.iinfo(numpy.int64).max)
+        distances[valid] = HilbertUtils.get_distances(cell_x, cell_y, level)
+        return numpy.argsort(distances, kind="stable")
+
+    @staticmethod
+    def sort(data: geopandas.GeoDataFrame, total_bounds=None) -> geopandas.GeoDataFrame:
+        """
+        Rows of data in Hilbert order of their bbox centers, index labels are kept.
+        """
+        if data is None or data.empty:
+            return data
+        return data.iloc[HilbertUtils.get_order(data.geometry.values, total_bounds)]
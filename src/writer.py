@@ -0,0 +1,56 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+writer = None
+
+
+class ArtifactWriter:
+    """
+    Write finished tables on one background thread, overlapping with later stages.
+    Writes run in submission order, so appends to the same file stay ordered. Tables are shallow copied,
+    do not modify their values after submitting. Call flush before reading the files or exiting, errors are raised there.
+    """
+    def __init__(self):
+        self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="artifact_writer")
+        self.futures = []
+
+    def submit(self, function, *args, **kwargs):
+        self.futures.append(self.pool.submit(function, *args, **kwargs))
+
+    def to_file(self, data, path, **kwargs):
+        self.submit(data.copy(deep=False).to_file, path, **kwargs)
+
+    def to_csv(self, data, path, **kwargs):
+        self.submit(data.copy(deep=False).to_csv, path, **kwargs)
+
+    def flush(self):
+        """
+        Wait for all submitted writes, raise the first error.
+        """
+        futures, self.futures = self.futures, []
+        errors = [future.exception() for future in futures]
+        errors = [error for error in errors if error is not None]
+        for error in errors[1:]:
+            logging.error(f"Writing artifact failed: {error}")
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.pool.shutdown(wait=True)
+
+
+def get_writer() -> ArtifactWriter:
+    global writer
+    if writer is None:
+        writer = ArtifactWriter()
+    return writer
+
+
+def close_writer():
+    global writer
+    if writer is not None:
+        writer.close()
+    writer = None
@@ -0,0 +1,80 @@
+import json
+import os
+
+import pytest
+
+import src.overpass as overpass
+from src.overpass import OverpassClient, OverpassError
+from src.overpass_server import OverpassStandInServer
+
+QUERY = "[out:json];way(1);out body;>;out skel qt;"
+
+
+def get_elements(ways=5):
+    elements = []
+    for way_id in range(1, ways + 1):
+        node_ids = [way_id * 10, way_id * 10 + 1]
+        elements += [{"type": "node", "id": node_id, "lat": 23.0 + node_id / 1000, "lon": 120.0 + node_id / 1000} for node_id in node_ids]
+        elements.append({"type": "way", "id": way_id, "nodes": node_ids, "tags": {"highway": "primary"}})
+    return elements
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+    monkeypatch.setattr(overpass.time, "sleep", delays.append)
+    return delays
+
+
+def test_retry_after_fail_first(sleeps):
+    with OverpassStandInServer(get_elements(), fail_first=2) as server:
+        data = OverpassClient(server.url, max_retries=3, backoff=0.5).query_raw(QUERY)
+    assert len(server.queries) == 3
+    assert [element["id"] for element in json.loads(data)["elements"]] == [1, 10, 11]
+    # Exponential backoff with up to half of the delay as jitter.
+    assert len(sleeps) == 2
+    assert 0.5 <= sleeps[0] < 0.75 and 1.0 <= sleeps[1] < 1.5
+
+
+def test_retry_exhausted(sleeps):
+    with OverpassStandInServer(get_elements(), fail_first=10) as server:
+        with pytest.raises(OverpassError):
+            OverpassClient(server.url, max_retries=2, backoff=0.5).query_raw(QUERY)
+    assert len(server.queries) == 3
+    assert len(sleeps) == 2
+
+
+def test_runtime_remark_retried_and_not_cached(sleeps, tmp_path):
+    with OverpassStandInServer(get_elements(), remark_first=1) as server:
+        data = OverpassClient(server.url, cache_dir=str(tmp_path), max_retries=2).query_raw(QUERY)
+    assert len(server.queries) == 2
+    assert "remark" not in json.loads(data)
+    cached = [path for path in os.listdir(tmp_path)]
+    assert len(cached) == 1
+    with open(tmp_path / cached[0], "rb") as stream:
+        assert stream.read() == data
+
+
+def test_runtime_remark_exhausted_not_cached(sleeps, tmp_path):
+    with OverpassStandInServer(get_elements(), remark_first=10) as server:
+        with pytest.raises(OverpassError):
+            OverpassClient(server.url, cache_dir=str(tmp_path), max_retries=1).query_raw(QUERY)
+    assert len(server.queries) == 2
+    assert os.listdir(tmp_path) == []
+
+
+def test_get_ways_batched():
+    pytest.importorskip("overpy")
+    with OverpassStandInServer(get_elements()) as server:
+        ways = OverpassClient(server.url, batch_size=2).get_ways([5, 1, 3, 2, 4, 6])
+    assert len(server.queries) == 3
+    assert list(ways.keys()) == [5, 1, 3, 2, 4]  # Order of requested ids, missing ways left out.
+    assert list(ways[1].coords) == [(120.01, 23.01), (120.011, 23.011)]
+
+
+def test_cache_hit_with_server_down(tmp_path):
+    with OverpassStandInServer(get_elements()) as server:
+        data = OverpassClient(server.url, cache_dir=str(tmp_path)).query_raw(QUERY)
+    assert len(server.queries) == 1
+    # Server is stopped, the query is answered from cache without connecting.
+    assert OverpassClient(server.url, cache_dir=str(tmp_path), max_retries=0).query_raw(QUERY) == data